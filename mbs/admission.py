@@ -0,0 +1,256 @@
+__author__ = 'abdul'
+
+import os
+import time
+import logging
+import multiprocessing
+
+from threading import Lock
+
+import psutil
+
+from base import MBSObject
+from globals import State
+from target import FileReference
+from backup import Backup
+from date_utils import date_now
+from utils import dir_size
+from mbs import get_mbs
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+DEFAULT_WORKSPACE_HEADROOM_PERCENTAGE = 10
+DEFAULT_MAX_CPU_LOAD = 1.0
+
+# minimum seconds between two samples used to compute the outbound rate
+MIN_NETWORK_SAMPLE_INTERVAL = 1
+
+###############################################################################
+# AdmissionController
+###############################################################################
+class AdmissionController(MBSObject):
+    """
+        Decides if an engine has the resources to start a task. A task is
+        admitted when its estimated workspace usage fits in the free space of
+        the workspace dir minus what running tasks reserved but did not write
+        yet, and cpu load and
+        outbound bandwidth are under their limits. Limits are only enforced
+        when there are running tasks so that a task that would never fit
+        still runs on an idle engine
+    """
+    ###########################################################################
+    def __init__(self):
+        MBSObject.__init__(self)
+        self._workspace_headroom_percentage = \
+            DEFAULT_WORKSPACE_HEADROOM_PERCENTAGE
+        self._max_cpu_load = DEFAULT_MAX_CPU_LOAD
+        self._max_outbound_mb_per_second = None
+        self._reservations = {}
+        self._lock = Lock()
+        self._network_sample = None
+        self._outbound_bytes_per_second = 0
+
+    ###########################################################################
+    @property
+    def workspace_headroom_percentage(self):
+        """
+            Percentage of the workspace disk that is never reserved
+        """
+        return self._workspace_headroom_percentage
+
+    @workspace_headroom_percentage.setter
+    def workspace_headroom_percentage(self, val):
+        self._workspace_headroom_percentage = val
+
+    ###########################################################################
+    @property
+    def max_cpu_load(self):
+        """
+            Max 1 minute load average per core to admit tasks
+        """
+        return self._max_cpu_load
+
+    @max_cpu_load.setter
+    def max_cpu_load(self, val):
+        self._max_cpu_load = val
+
+    ###########################################################################
+    @property
+    def max_outbound_mb_per_second(self):
+        """
+            Max outbound network rate to admit tasks. None disables the check
+        """
+        return self._max_outbound_mb_per_second
+
+    @max_outbound_mb_per_second.setter
+    def max_outbound_mb_per_second(self, val):
+        self._max_outbound_mb_per_second = val
+
+    ###########################################################################
+    def reserve(self, task, force=False):
+        """
+            Reserves resources for the task if it fits. Returns None if
+            admitted or the reason why it was not
+        """
+        workspace_size = self.estimate_workspace_size(task)
+        with self._lock:
+            if not force and self._reservations:
+                budget = self._get_budget()
+                reason = self._check_budget(budget, workspace_size)
+                if reason:
+                    return reason
+
+            self._reservations[task.id] = {
+                "taskType": task.type_name,
+                "taskId": task.id,
+                "workspaceBytes": workspace_size,
+                "workspaceDir": self._get_task_workspace_dir(task),
+                "reservedDate": date_now()
+            }
+
+    ###########################################################################
+    def release(self, task):
+        with self._lock:
+            self._reservations.pop(task.id, None)
+
+    ###########################################################################
+    def _check_budget(self, budget, workspace_size):
+        if workspace_size > budget["availableWorkspaceBytes"]:
+            return ("estimated workspace size %s bytes exceeds available "
+                    "workspace %s bytes" %
+                    (workspace_size, budget["availableWorkspaceBytes"]))
+
+        if budget["cpuLoad"] > self.max_cpu_load:
+            return ("cpu load %s exceeds max %s" %
+                    (budget["cpuLoad"], self.max_cpu_load))
+
+        if (self.max_outbound_mb_per_second and
+                budget["outboundMBPerSecond"] > self.max_outbound_mb_per_second):
+            return ("outbound rate %s MB/s exceeds max %s MB/s" %
+                    (budget["outboundMBPerSecond"],
+                     self.max_outbound_mb_per_second))
+
+    ###########################################################################
+    def _get_budget(self):
+        disk = os.statvfs(self._get_workspace_dir())
+        total = disk.f_blocks * disk.f_frsize
+        free = disk.f_bavail * disk.f_frsize
+        headroom = total * self.workspace_headroom_percentage / 100
+        # free space already reflects what running tasks wrote
+        reserved = sum(self._get_unwritten_bytes(r)
+                       for r in self._reservations.values())
+
+        return {
+            "freeWorkspaceBytes": free,
+            "reservedWorkspaceBytes": reserved,
+            "availableWorkspaceBytes": max(0, free - headroom - reserved),
+            "cpuLoad": round(os.getloadavg()[0] /
+                             multiprocessing.cpu_count(), 2),
+            "outboundMBPerSecond": round(self._get_outbound_rate() /
+                                         (1024 * 1024), 2)
+        }
+
+    ###########################################################################
+    def _get_unwritten_bytes(self, reservation):
+        workspace_bytes = reservation["workspaceBytes"]
+        if not workspace_bytes or not reservation["workspaceDir"]:
+            return workspace_bytes
+        try:
+            written = dir_size(reservation["workspaceDir"])
+        except OSError:
+            # files removed while walking the workspace
+            written = 0
+        return max(0, workspace_bytes - written)
+
+    ###########################################################################
+    def _get_outbound_rate(self):
+        now = time.time()
+        bytes_sent = psutil.net_io_counters().bytes_sent
+        if self._network_sample:
+            last_time, last_bytes_sent = self._network_sample
+            if now - last_time < MIN_NETWORK_SAMPLE_INTERVAL:
+                return self._outbound_bytes_per_second
+            self._outbound_bytes_per_second = \
+                (bytes_sent - last_bytes_sent) / (now - last_time)
+
+        self._network_sample = (now, bytes_sent)
+        return self._outbound_bytes_per_second
+
+    ###########################################################################
+    def _get_workspace_dir(self):
+        workspace_dir = get_mbs().default_backup_assistant.temp_dir
+        # the workspace dir may not exist before the first task
+        while workspace_dir and not os.path.exists(workspace_dir):
+            workspace_dir = os.path.dirname(workspace_dir)
+        return workspace_dir or "/"
+
+    ###########################################################################
+    def _get_task_workspace_dir(self, task):
+        return get_mbs().default_backup_assistant.get_task_workspace_dir(task)
+
+    ###########################################################################
+    def estimate_workspace_size(self, task):
+        """
+            Estimates the bytes the task writes to its workspace (dump +
+            archive) from the last successful backup of the same plan (or
+            the source backup of restores). 0 when unknown
+        """
+        if isinstance(task, Backup):
+            # streamed dumps do not use the workspace
+            if getattr(task.strategy, "stream_to_target", False):
+                return 0
+            backup = self._get_previous_plan_backup(task)
+            stream_archive = False
+        else:
+            backup = task.source_backup
+            stream_archive = task.strategy and task.strategy.stream_restore
+
+        # snapshot backups do not use the workspace
+        if not backup or not isinstance(backup.target_reference,
+                                        FileReference):
+            return 0
+
+        dump_size = (backup.source_stats or {}).get("dataSize") or 0
+        archive_size = backup.target_reference.file_size or 0
+        if stream_archive:
+            archive_size = 0
+        return dump_size + archive_size
+
+    ###########################################################################
+    def _get_previous_plan_backup(self, backup):
+        if not backup.plan:
+            return None
+
+        q = {
+            "plan._id": backup.plan.id,
+            "state": State.SUCCEEDED
+        }
+        return get_mbs().backup_collection.find_one(q, sort=[("createdDate", -1)])
+
+    ###########################################################################
+    def get_status(self):
+        with self._lock:
+            return {
+                "budget": self._get_budget(),
+                "reservations": self._reservations.values()
+            }
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = {
+            "_type": "AdmissionController",
+            "workspaceHeadroomPercentage": self.workspace_headroom_percentage,
+            "maxCpuLoad": self.max_cpu_load
+        }
+
+        if self.max_outbound_mb_per_second is not None:
+            doc["maxOutboundMBPerSecond"] = self.max_outbound_mb_per_second
+
+        return doc
@@ -106,9 +106,13 @@ class BackupSystemApiServer(ApiServer):
         no_index_restore = arg_json.get('noIndexRestore')
         no_users_restore = arg_json.get('noUsersRestore')
         no_roles_restore = arg_json.get('noRolesRestore')
+        stream_restore = arg_json.get('streamRestore')
         tags = arg_json.get('tags')
         source_database_name = arg_json.get('sourceDatabaseName')
+        point_in_time = arg_json.get('pointInTime')
         try:
+            if point_in_time:
+                point_in_time = date_utils.utc_str_to_datetime(point_in_time)
             bs = self.backup_system
             r = bs.schedule_backup_restore(backup_id,
                                            destination_uri,
@@ -116,6 +120,8 @@ class BackupSystemApiServer(ApiServer):
                                            no_index_restore=no_index_restore,
                                            no_users_restore=no_users_restore,
                                            no_roles_restore=no_roles_restore,
+                                           stream_restore=stream_restore,
+                                           point_in_time=point_in_time,
                                            tags=tags)
             return str(r)
         except Exception, e:
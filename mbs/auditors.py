@@ -187,7 +187,7 @@ class PlanScheduleAuditor(BackupAuditor):
         warned_audits = []
         total_audits = 0
         total_warnings = 0
-        for plan_occurrence in plan.schedule.natural_occurrences_as_of(
+        for plan_occurrence in plan.schedule.iter_natural_occurrences_as_of(
                 audit_date):
             # skip occurrences before plan's created date
             if plan.created_date and plan_occurrence < plan.created_date:
@@ -343,8 +343,8 @@ class PlanRetentionAuditor(BackupAuditor):
         logger.info("Finding all occurrences for plan '%s' be retained as "
                     "of %s" % (plan.id, audit_date))
 
-        for occurrence in rp.get_plan_occurrences_to_retain_as_of(plan,
-                                                                  audit_date):
+        for occurrence in rp.iter_plan_occurrences_to_retain_as_of(plan,
+                                                                   audit_date):
             logger.info("Auditing occurrence '%s' " % occurrence)
             # skip occurrences before plan's created date
             if plan.created_date and occurrence < plan.created_date:
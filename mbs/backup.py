@@ -25,6 +25,11 @@ class Backup(MBSTask):
         self._deleted_date = None
         self._data_stats = {}
         self._cluster_stats = None
+        self._multipart_uploads = None
+        self._base_backup_id = None
+        self._previous_backup_id = None
+        self._oplog_start_ts = None
+        self._oplog_end_ts = None
 
 
 ###########################################################################
@@ -214,6 +219,83 @@ class Backup(MBSTask):
     def data_stats(self, val):
         self._data_stats = val
 
+    ###########################################################################
+    @property
+    def multipart_uploads(self):
+        """
+            List of MultipartUploadState for in progress multipart uploads of
+            the backup file (one per target)
+        """
+        return self._multipart_uploads
+
+    @multipart_uploads.setter
+    def multipart_uploads(self, val):
+        self._multipart_uploads = val
+
+    ###########################################################################
+    @property
+    def base_backup_id(self):
+        """
+            For incremental backups, id of the full backup the incremental
+            chain starts with
+        """
+        return self._base_backup_id
+
+    @base_backup_id.setter
+    def base_backup_id(self, val):
+        self._base_backup_id = val
+
+    ###########################################################################
+    @property
+    def previous_backup_id(self):
+        """
+            For incremental backups, id of the backup (full or incremental)
+            whose oplog this one continues
+        """
+        return self._previous_backup_id
+
+    @previous_backup_id.setter
+    def previous_backup_id(self, val):
+        self._previous_backup_id = val
+
+    ###########################################################################
+    @property
+    def oplog_start_ts(self):
+        """
+            For incremental backups, oplog entries after this timestamp are
+            captured
+        """
+        return self._oplog_start_ts
+
+    @oplog_start_ts.setter
+    def oplog_start_ts(self, val):
+        self._oplog_start_ts = val
+
+    ###########################################################################
+    @property
+    def oplog_end_ts(self):
+        """
+            Timestamp of the last oplog entry covered by the backup. Next
+            incremental backups continue from here
+        """
+        return self._oplog_end_ts
+
+    @oplog_end_ts.setter
+    def oplog_end_ts(self, val):
+        self._oplog_end_ts = val
+
+    ###########################################################################
+    def is_incremental(self):
+        return self.base_backup_id is not None
+
+    ###########################################################################
+    def get_multipart_upload(self, container_name, destination_path):
+        if self.multipart_uploads:
+            for upload_state in self.multipart_uploads:
+                if (upload_state.container_name == container_name and
+                        upload_state.destination_path == destination_path):
+                    return upload_state
+
     ###########################################################################
     def to_document(self, display_only=False):
 
@@ -262,4 +344,21 @@ class Backup(MBSTask):
         if self.data_stats:
             doc["dataStats"] = self.data_stats
 
+        if self.multipart_uploads:
+            doc["multipartUploads"] = \
+                map(lambda mu: mu.to_document(display_only=display_only),
+                    self.multipart_uploads)
+
+        if self.base_backup_id:
+            doc["baseBackupId"] = self.base_backup_id
+
+        if self.previous_backup_id:
+            doc["previousBackupId"] = self.previous_backup_id
+
+        if self.oplog_start_ts:
+            doc["oplogStartTs"] = self.oplog_start_ts
+
+        if self.oplog_end_ts:
+            doc["oplogEndTs"] = self.oplog_end_ts
+
         return doc
@@ -3,13 +3,18 @@ __author__ = 'abdul'
 import os
 import shutil
 import logging
+import subprocess
+import time
+import re
+import json
 
-from utils import ensure_dir, which, execute_command, execute_command_wrapper, listify, list_dir_subdirs
+from utils import ensure_dir, which, execute_command, execute_command_wrapper, listify, list_dir_subdirs, dir_size
 import errors
 from subprocess import CalledProcessError
-from target import multi_target_upload_file
+from target import multi_target_upload_file, TargetStreamUploader, TargetStreamDownloader
 from errors import MBSError, ExtractError, RestoreError
 from mongo_uri_tools import mask_mongo_uri
+from compression import get_codec
 from base import MBSObject
 from backup import Backup
 from restore import Restore
@@ -39,16 +44,24 @@ class BackupAssistant(MBSObject):
     def dump_backup(self, backup, uri, destination, log_file_name, options=None):
         pass
 
+    ####################################################################################################################
+    def stream_dump_backup(self, backup, uri, dump_dir, log_file_name, target, destination_path, options=None):
+        pass
+
+    ####################################################################################################################
+    def dump_oplog(self, backup, uri, destination, log_file_name, start_ts, end_ts, options=None):
+        pass
+
     ####################################################################################################################
     def upload_backup_log_file(self, backup, file_name, dump_dir, target, destination_path=None):
         pass
 
     ####################################################################################################################
-    def tar_backup(self, backup, dump_dir, file_name):
+    def tar_backup(self, backup, dump_dir, file_name, compression=None):
         pass
 
     ####################################################################################################################
-    def upload_backup(self, backup, file_name, target, destination_path=None):
+    def upload_backup(self, backup, file_name, target, destination_path=None, upload_states=None):
         pass
 
     ####################################################################################################################
@@ -67,6 +80,10 @@ class BackupAssistant(MBSObject):
     def extract_restore_source_backup(self, restore):
         pass
 
+    ####################################################################################################################
+    def stream_extract_restore_source_backup(self, restore):
+        pass
+
     ####################################################################################################################
     def run_mongo_restore(self, restore, destination_uri, dump_dir, source_database_name,
                           log_file_name, dump_log_file_name,
@@ -76,6 +93,14 @@ class BackupAssistant(MBSObject):
                           options=None):
         pass
 
+    ####################################################################################################################
+    def run_mongo_archive_restore(self, restore, destination_uri, archive_file_name, log_file_name, options=None):
+        pass
+
+    ####################################################################################################################
+    def stream_mongo_archive_restore(self, restore, destination_uri, log_file_name, options=None):
+        pass
+
     ####################################################################################################################
     def is_connector_local_to_assistant(self, mongo_connector, backup):
         pass
@@ -156,18 +181,123 @@ class LocalBackupAssistant(BackupAssistant):
         workspace = self.get_task_workspace_dir(backup)
         log_path = os.path.join(workspace, destination, log_file_name)
         last_error_line = {"line": ""}
+        collection_timer = DumpCollectionTimer()
 
-        def capture_last_error(line):
+        def process_dump_line(line):
             if is_mongo_error_log_line(line):
                 last_error_line["line"] = line
+            collection_timer.process_line(line)
+
         # execute dump command
         return_code = execute_command_wrapper(dump_cmd, cwd=workspace, output_path=log_path,
-                                             on_output=capture_last_error)
+                                             on_output=process_dump_line)
 
         # raise an error if return code is not 0
         if return_code:
             errors.raise_dump_error(return_code, last_error_line["line"])
 
+        return {
+            "dumpCollectionDurations": collection_timer.get_durations()
+        }
+
+    ####################################################################################################################
+    def stream_dump_backup(self, backup, uri, dump_dir, log_file_name, target, destination_path, options=None):
+        """
+        Runs mongodump with --archive writing into a named pipe that is uploaded to the target while the dump is
+        running. Nothing but the dump log is written to the workspace.
+        Returns a dict with the target reference and stream stats
+        """
+        mongoctl_exe = which("mongoctl")
+        if not mongoctl_exe:
+            raise MBSError("mongoctl exe not found in PATH")
+
+        workspace = self.get_task_workspace_dir(backup)
+        ensure_dir(os.path.join(workspace, dump_dir))
+        log_path = os.path.join(workspace, dump_dir, log_file_name)
+
+        pipe_path = os.path.join(workspace, "%s.pipe" % dump_dir)
+        if os.path.exists(pipe_path):
+            os.remove(pipe_path)
+        os.mkfifo(pipe_path)
+
+        dump_cmd = [mongoctl_exe, "--noninteractive", "dump", uri, "--archive=%s" % pipe_path]
+
+        if options:
+            dump_cmd.extend(options)
+
+        dump_cmd_display = dump_cmd[:]
+        # mask mongo uri
+        dump_cmd_display[3] = mask_mongo_uri(uri)
+
+        metadata = {
+            "Content-Type": "application/x-compressed"
+        }
+        uploader = TargetStreamUploader(target, pipe_path, destination_path, metadata=metadata)
+        uploader.start()
+
+        logger.info("Running streaming dump command: %s" % " ".join(dump_cmd_display))
+
+        last_error_line = {"line": ""}
+        collection_timer = DumpCollectionTimer()
+
+        def process_dump_line(line):
+            if is_mongo_error_log_line(line):
+                last_error_line["line"] = line
+            collection_timer.process_line(line)
+
+        dump_error = None
+        try:
+            return_code = execute_command_wrapper(dump_cmd, cwd=workspace, output_path=log_path,
+                                                  on_output=process_dump_line)
+            if return_code:
+                errors.raise_dump_error(return_code, last_error_line["line"])
+        except Exception, e:
+            dump_error = e
+            raise
+        finally:
+            uploader.finish(error=dump_error)
+            uploader.join()
+            os.remove(pipe_path)
+
+        if uploader.error:
+            raise uploader.error
+
+        stream = uploader.stream
+        return {
+            "targetReference": uploader.target_reference,
+            "streamedBytes": stream.bytes_read,
+            "streamDurationInSeconds": stream.duration_in_seconds,
+            "dumpCollectionDurations": collection_timer.get_durations()
+        }
+
+    ####################################################################################################################
+    def dump_oplog(self, backup, uri, destination, log_file_name, start_ts, end_ts, options=None):
+        """
+        Dumps oplog entries in (start_ts, end_ts] into <destination>/oplog.bson which is the layout that
+        mongorestore --oplogReplay expects
+        """
+        oplog_query = {
+            "ts": {
+                "$gt": {"$timestamp": {"t": start_ts.time, "i": start_ts.inc}},
+                "$lte": {"$timestamp": {"t": end_ts.time, "i": end_ts.inc}}
+            }
+        }
+        oplog_options = [
+            "--db", "local",
+            "--collection", "oplog.rs",
+            "--query", json.dumps(oplog_query)
+        ]
+        oplog_options.extend(options or [])
+
+        dump_info = self.dump_backup(backup, uri, destination, log_file_name, options=oplog_options)
+
+        workspace = self.get_task_workspace_dir(backup)
+        local_dir = os.path.join(workspace, destination, "local")
+        os.rename(os.path.join(local_dir, "oplog.rs.bson"), os.path.join(workspace, destination, "oplog.bson"))
+        shutil.rmtree(local_dir)
+
+        return dump_info
+
     ####################################################################################################################
     def upload_backup_log_file(self, backup, file_name, dump_dir, target, destination_path=None):
         workspace = self.get_task_workspace_dir(backup)
@@ -175,30 +305,42 @@ class LocalBackupAssistant(BackupAssistant):
         return target.put_file(file_path, destination_path=destination_path)
 
     ####################################################################################################################
-    def tar_backup(self, backup, dump_dir, file_name):
-        tar_exe = which("tar")
-
-        tar_cmd = [tar_exe, "-cvzf", file_name, dump_dir]
+    def tar_backup(self, backup, dump_dir, file_name, compression=None):
+        """
+        Tars the dump dir using the specified compression codec.
+        Returns a dict with dump/archive sizes and tar duration
+        """
+        tar_cmd = get_codec(compression).tar_create_command(file_name, dump_dir)
         cmd_display = " ".join(tar_cmd)
         workspace = self.get_task_workspace_dir(backup)
         try:
+            dump_size = dir_size(os.path.join(workspace, dump_dir))
             logger.info("Running tar command: %s" % cmd_display)
+            start = time.time()
             execute_command(tar_cmd, cwd=workspace)
+            duration = time.time() - start
             self._delete_dump_dir(backup, dump_dir)
         except CalledProcessError, e:
             last_log_line = e.output.split("\n")[-1]
             errors.raise_archive_error(e.returncode, last_log_line)
 
+        return {
+            "dumpSize": dump_size,
+            "archiveSize": os.path.getsize(os.path.join(workspace, file_name)),
+            "durationInSeconds": duration
+        }
+
 
     ####################################################################################################################
-    def upload_backup(self, backup, file_name, target, destination_path=None):
+    def upload_backup(self, backup, file_name, target, destination_path=None, upload_states=None):
         targets = listify(target)
         workspace = self.get_task_workspace_dir(backup)
         file_path = os.path.join(workspace, file_name)
         metadata = {
             "Content-Type": "application/x-compressed"
         }
-        uploaders = multi_target_upload_file(targets, file_path, destination_path=destination_path, metadata=metadata)
+        uploaders = multi_target_upload_file(targets, file_path, destination_path=destination_path, metadata=metadata,
+                                             upload_states=upload_states)
 
         errored_uploaders = filter(lambda uploader: uploader.error is not None,
                                    uploaders)
@@ -254,11 +396,7 @@ class LocalBackupAssistant(BackupAssistant):
         file_reference = restore.source_backup.target_reference
         logger.info("Extracting tar file '%s'" % file_reference.file_name)
 
-        tarx_cmd = [
-            which("tar"),
-            "-xf",
-            file_reference.file_name
-        ]
+        tarx_cmd = get_codec(file_reference.compression).tar_extract_command(file_reference.file_name)
 
         logger.info("Running tar extract command: %s" % tarx_cmd)
         try:
@@ -267,6 +405,41 @@ class LocalBackupAssistant(BackupAssistant):
             logger.error("Failed to execute extract command: %s" % tarx_cmd)
             raise ExtractError(cause=cpe)
 
+    ####################################################################################################################
+    def stream_extract_restore_source_backup(self, restore):
+        """
+        Downloads the source backup file straight into tar's stdin so that download and extract overlap.
+        Returns a dict with stream stats
+        """
+        working_dir = self.get_task_workspace_dir(restore)
+        backup = restore.source_backup
+        file_reference = backup.target_reference
+
+        tarx_cmd = get_codec(file_reference.compression).tar_extract_command("-")
+
+        logger.info("Streaming '%s' into tar extract command: %s" % (file_reference.file_name, tarx_cmd))
+
+        start = time.time()
+        tar_process = subprocess.Popen(tarx_cmd, stdin=subprocess.PIPE, cwd=working_dir)
+        try:
+            downloaded_bytes = backup.target.download_to_stream(file_reference, tar_process.stdin)
+            tar_process.stdin.close()
+        except Exception:
+            logger.error("Streaming download of '%s' failed. Killing tar" % file_reference.file_name)
+            tar_process.kill()
+            tar_process.wait()
+            raise
+
+        returncode = tar_process.wait()
+        if returncode:
+            logger.error("Failed to execute extract command: %s" % tarx_cmd)
+            raise ExtractError(cause=CalledProcessError(returncode, tarx_cmd))
+
+        return {
+            "downloadedBytes": downloaded_bytes,
+            "durationInSeconds": time.time() - start
+        }
+
     ####################################################################################################################
     def run_mongo_restore(self, restore, destination_uri, dump_dir, source_database_name,
                           log_file_name, dump_log_file_name,
@@ -326,6 +499,90 @@ class LocalBackupAssistant(BackupAssistant):
         if returncode:
             raise RestoreError(returncode, last_log_line)
 
+    ####################################################################################################################
+    def run_mongo_archive_restore(self, restore, destination_uri, archive_file_name, log_file_name, options=None):
+        """
+        Restores a gzipped mongodump archive. Collections to skip are passed as --nsExclude options since archives
+        cannot be edited like dump directories
+        """
+        workspace = self.get_task_workspace_dir(restore)
+        archive_path = os.path.join(workspace, archive_file_name)
+
+        self._run_mongoctl_archive_restore(restore, destination_uri, archive_path, log_file_name, options=options)
+
+    ####################################################################################################################
+    def stream_mongo_archive_restore(self, restore, destination_uri, log_file_name, options=None):
+        """
+        Restores a gzipped mongodump archive by downloading it into a named pipe that mongorestore reads from, so the
+        archive is never written to the workspace.
+        Returns a dict with stream stats
+        """
+        workspace = self.get_task_workspace_dir(restore)
+        backup = restore.source_backup
+
+        pipe_path = os.path.join(workspace, "%s.archive.pipe" % restore.id)
+        if os.path.exists(pipe_path):
+            os.remove(pipe_path)
+        os.mkfifo(pipe_path)
+
+        downloader = TargetStreamDownloader(backup.target, backup.target_reference, pipe_path)
+        start = time.time()
+        downloader.start()
+        restore_error = None
+        try:
+            self._run_mongoctl_archive_restore(restore, destination_uri, pipe_path, log_file_name, options=options)
+        except RestoreError, e:
+            restore_error = e
+        finally:
+            downloader.finish()
+            downloader.join()
+            os.remove(pipe_path)
+
+        # a failed download truncates the archive so it is the root cause of the restore failure
+        if downloader.error:
+            raise downloader.error
+        if restore_error:
+            raise restore_error
+
+        return {
+            "downloadedBytes": downloader.downloaded_bytes,
+            "durationInSeconds": time.time() - start
+        }
+
+    ####################################################################################################################
+    def _run_mongoctl_archive_restore(self, restore, destination_uri, archive_path, log_file_name, options=None):
+        workspace = self.get_task_workspace_dir(restore)
+        log_path = os.path.join(workspace, log_file_name)
+
+        restore_cmd = [
+            which("mongoctl"),
+            "restore",
+            destination_uri,
+            "--archive=%s" % archive_path,
+            "--gzip"
+        ]
+
+        if options:
+            restore_cmd.extend(options)
+
+        restore_cmd_display = restore_cmd[:]
+
+        restore_cmd_display[restore_cmd_display.index("restore") + 1] = mask_mongo_uri(destination_uri)
+
+        logger.info("Running mongoctl archive restore command: %s" %
+                    " ".join(restore_cmd_display))
+
+        returncode = execute_command_wrapper(restore_cmd,
+                                             output_path=log_path,
+                                             cwd=workspace)
+
+        # read the last restore log line
+        last_line_tail_cmd = [which('tail'), '-1', log_path]
+        last_log_line = execute_command(last_line_tail_cmd)
+
+        if returncode:
+            raise RestoreError(returncode, last_log_line)
+
     ####################################################################################################################
     def _delete_system_users_from_dump(self, restore, restore_source_dir):
         """
@@ -386,6 +643,46 @@ class LocalBackupAssistant(BackupAssistant):
         return os.path.join(self.temp_dir, subdir, str(task.id))
 
 
+####################################################################################################################
+# DumpCollectionTimer
+####################################################################################################################
+class DumpCollectionTimer(object):
+    """
+    Measures how long each collection took to dump by watching mongodump "writing <ns>" and "done dumping <ns>"
+    output lines as they are produced
+    """
+    ####################################################################################################################
+    def __init__(self):
+        self._start_times = {}
+        self._durations = {}
+
+    ####################################################################################################################
+    def process_line(self, line, now=None):
+        now = now or time.time()
+        m = re.search("writing ([^.\s]*)\.(\S*) to ", line)
+        if m:
+            self._start_times[m.groups()] = now
+            return
+
+        m = re.search("done dumping ([^.\s]*)\.(\S*) \(", line)
+        if m and m.groups() in self._start_times:
+            self._durations[m.groups()] = now - self._start_times.pop(m.groups())
+
+    ####################################################################################################################
+    def get_durations(self):
+        """
+        Returns {dbname: [{"name": collection_name, "durationInSeconds": seconds}]} with slowest collections first
+        """
+        result = {}
+        for (dbname, collection_name), duration in sorted(self._durations.items(), key=lambda item: -item[1]):
+            result.setdefault(dbname, []).append({
+                "name": collection_name,
+                "durationInSeconds": round(duration, 2)
+            })
+
+        return result
+
+
 ####################################################################################################################
 def is_mongo_error_log_line(line):
     if line:
@@ -35,6 +35,9 @@ from target import BackupTarget
 from source import BackupSource
 from datetime import datetime
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
 import persistence
 
 from flask import Flask
@@ -67,6 +70,9 @@ BACKUP_SYSTEM_STATUS_STOPPING = "stopping"
 BACKUP_SYSTEM_STATUS_STOPPED = "stopped"
 
 DEFAULT_BACKUP_SYSTEM_PORT = 8899
+
+# mongo error code of unique index violations
+DUPLICATE_KEY_ERROR_CODE = 11000
 ###############################################################################
 # BackupSystem
 ###############################################################################
@@ -262,8 +268,9 @@ class BackupSystem(Thread):
             raise BackupSystemError(msg)
 
         self.info("Rescheduling backup %s" % backup._id)
-        props = ["state", "tags", "nextRetryDate"]
+        props = ["state", "tags", "nextRetryDate", "priorityDate"]
         backup.state = State.SCHEDULED
+        backup.reset_priority_date()
         # clear out next retry date
         backup.next_retry_date = None
 
@@ -271,9 +278,12 @@ class BackupSystem(Thread):
         # if force is set then clear backup log
         if force:
             backup.logs = []
+            # archived events would still count as logged otherwise
+            backup.archived_event_counts = {}
             backup.try_count = 0
             backup.engine_guid = None
-            props.extend(["logs", "tryCount", "engineGuid"])
+            props.extend(["logs", "archivedEventCounts", "tryCount",
+                          "engineGuid"])
 
         if reset_try_count or force:
             backup.try_count = 0
@@ -309,16 +319,20 @@ class BackupSystem(Thread):
             raise BackupSystemError(msg)
 
         self.info("Rescheduling restore %s" % restore.id)
-        props = ["state", "tags"]
+        props = ["state", "tags", "priorityDate"]
         restore.state = State.SCHEDULED
+        restore.reset_priority_date()
 
         rc = get_mbs().restore_collection
         # if force is set then clear restore log
         if force:
             restore.logs = []
+            # archived events would still count as logged otherwise
+            restore.archived_event_counts = {}
             restore.try_count = 0
             restore.engine_guid = None
-            props.extend(["logs", "tryCount", "engineGuid"])
+            props.extend(["logs", "archivedEventCounts", "tryCount",
+                          "engineGuid"])
 
 
         rc.update_task(restore, properties=props,
@@ -328,6 +342,106 @@ class BackupSystem(Thread):
     def schedule_plan_backup(self, plan, one_time=False):
         self.info("Scheduling plan '%s'" % plan.id)
 
+        plan_occurrence = plan.next_occurrence
+        try:
+            try:
+                backup = self.schedule_backup(**self._plan_backup_args(plan, one_time=one_time))
+            except BackupSchedulingError, e:
+                if not isinstance(e.cause, DuplicateKeyError):
+                    raise
+                # the occurrence was already scheduled (e.g. by another scheduler)
+                self.info("Plan '%s' current occurrence is already scheduled" % plan.id)
+                backup = None
+
+            if not one_time:
+                #  update the plans next occurrence
+                self._save_plan_next_occurrence(plan)
+        except Exception:
+            plan.next_occurrence = plan_occurrence
+            raise
+
+        self._request_plan_retention(plan)
+
+        return backup
+
+    ###########################################################################
+    def schedule_plan_backups(self, plans):
+        """
+            Schedules the current occurrence of each plan with one bulk insert
+            and advances their next occurrences with one bulk write.
+            Occurrences that are already scheduled (unique plan._id +
+            planOccurrence index) are skipped. Plans keep their current
+            occurrence if writing fails. Returns the scheduled backups
+        """
+        plan_backups = []
+        for plan in plans:
+            self.info("Scheduling plan '%s'" % plan.id)
+            plan_occurrence = plan.next_occurrence
+            try:
+                plan_backups.append((plan, self._build_backup(**self._plan_backup_args(plan))))
+            except Exception, e:
+                plan.next_occurrence = plan_occurrence
+                logger.exception("Failed to schedule plan '%s'" % plan.id)
+                get_mbs().notifications.send_error_notification(
+                    "Plan Scheduler Error",
+                    "Error while scheduling plan '%s'. Cause: %s.\n\nStack Trace:\n%s" %
+                    (plan.id, e, traceback.format_exc()))
+
+        if not plan_backups:
+            return []
+
+        try:
+            scheduled = self._write_plan_backups(plan_backups)
+        except Exception:
+            # the plans are due again
+            for plan, backup in plan_backups:
+                plan.next_occurrence = backup.plan_occurrence
+            raise
+
+        for plan, backup in plan_backups:
+            self._scheduler.plan_updated(plan)
+            self._request_plan_retention(plan)
+
+        self.info("Scheduled %s backups for %s plans" % (len(scheduled), len(plan_backups)))
+        return scheduled
+
+    ###########################################################################
+    def _write_plan_backups(self, plan_backups):
+        backup_docs = [backup.to_document() for plan, backup in plan_backups]
+        duplicates = set()
+        try:
+            get_mbs().backup_collection.collection.insert_many(backup_docs, ordered=False)
+        except BulkWriteError, bwe:
+            for write_error in bwe.details["writeErrors"]:
+                if write_error["code"] != DUPLICATE_KEY_ERROR_CODE:
+                    raise
+                duplicates.add(write_error["index"])
+
+        scheduled = []
+        for index, ((plan, backup), backup_doc) in enumerate(zip(plan_backups, backup_docs)):
+            if index in duplicates:
+                self.info("Plan '%s' occurrence '%s' is already scheduled" % (plan.id, backup.plan_occurrence))
+                continue
+            backup.id = backup_doc["_id"]
+            scheduled.append(backup)
+            if backup.state == State.FAILED:
+                trigger_task_finished_event(backup, State.FAILED)
+
+        get_mbs().plan_collection.collection.bulk_write([
+            UpdateOne({"_id": plan.id}, {"$set": {"nextOccurrence": plan.next_occurrence}})
+            for plan, backup in plan_backups
+        ], ordered=False)
+
+        return scheduled
+
+    ###########################################################################
+    def _plan_backup_args(self, plan, one_time=False):
+        """
+            Returns schedule_backup() args for the current occurrence of the
+            plan and advances its next occurrence (unless one_time) so that
+            the backup carries it. Callers set it back to plan_occurrence if
+            writing fails
+        """
         plan_occurrence = None
         backup_plan = None
 
@@ -344,63 +458,22 @@ class BackupSystem(Thread):
         if not strategy.max_lag_seconds and plan_occurrence:
             strategy.max_lag_seconds = plan.schedule.max_acceptable_lag(plan_occurrence)
 
-        backup = self.schedule_backup(strategy=plan.strategy,
-                                      source=plan.source,
-                                      target=plan.target,
-                                      priority=plan.priority,
-                                      tags=tags,
-                                      plan_occurrence=plan_occurrence,
-                                      plan=backup_plan,
-                                      secondary_targets=plan.secondary_targets)
-
-        #  update the plans next occurrence
-        self._save_plan_next_occurrence(plan)
-
-        self._request_plan_retention(plan)
-
-        return backup
+        return {
+            "strategy": plan.strategy,
+            "source": plan.source,
+            "target": plan.target,
+            "priority": plan.priority,
+            "tags": tags,
+            "plan_occurrence": plan_occurrence,
+            "plan": backup_plan,
+            "secondary_targets": plan.secondary_targets
+        }
 
     ###########################################################################
     def schedule_backup(self, **kwargs):
 
         try:
-            backup = Backup()
-            backup.created_date = date_now()
-            backup.strategy = get_validate_arg(kwargs, "strategy",
-                                               expected_type=BackupStrategy)
-            backup.source = get_validate_arg(kwargs, "source", BackupSource)
-            backup.target = get_validate_arg(kwargs, "target", BackupTarget)
-            backup.priority = get_validate_arg(kwargs, "priority",
-                                               expected_type=(int, long,
-                                                              float, complex),
-                                               required=False)
-            backup.plan_occurrence = \
-                get_validate_arg(kwargs, "plan_occurrence",
-                                 expected_type=datetime,
-                                 required=False)
-            backup.plan = get_validate_arg(kwargs, "plan",
-                                           expected_type=BackupPlan,
-                                           required=False)
-
-            backup.secondary_targets = get_validate_arg(kwargs,
-                                                        "secondary_targets",
-                                                        expected_type=list,
-                                                        required=False)
-
-            backup.change_state(State.SCHEDULED)
-            # set tags
-            tags = get_validate_arg(kwargs, "tags", expected_type=dict,
-                                    required=False)
-
-            backup.tags = tags
-
-            bc = get_mbs().backup_collection
-            try:
-                # resolve tags
-
-                self._resolve_task_tags(backup)
-            except Exception, ex:
-                self._task_failed_to_schedule(backup, bc, ex)
+            backup = self._build_backup(**kwargs)
 
             backup_doc = backup.to_document()
             get_mbs().backup_collection.save_document(backup_doc)
@@ -421,6 +494,49 @@ class BackupSystem(Thread):
             logger.error(traceback.format_exc())
             raise BackupSchedulingError(msg=msg, cause=e)
 
+    ###########################################################################
+    def _build_backup(self, **kwargs):
+        backup = Backup()
+        backup.created_date = date_now()
+        backup.strategy = get_validate_arg(kwargs, "strategy",
+                                           expected_type=BackupStrategy)
+        backup.source = get_validate_arg(kwargs, "source", BackupSource)
+        backup.target = get_validate_arg(kwargs, "target", BackupTarget)
+        backup.priority = get_validate_arg(kwargs, "priority",
+                                           expected_type=(int, long,
+                                                          float, complex),
+                                           required=False)
+        backup.plan_occurrence = \
+            get_validate_arg(kwargs, "plan_occurrence",
+                             expected_type=datetime,
+                             required=False)
+        backup.plan = get_validate_arg(kwargs, "plan",
+                                       expected_type=BackupPlan,
+                                       required=False)
+
+        backup.secondary_targets = get_validate_arg(kwargs,
+                                                    "secondary_targets",
+                                                    expected_type=list,
+                                                    required=False)
+
+        backup.change_state(State.SCHEDULED)
+        backup.reset_priority_date()
+        # set tags
+        tags = get_validate_arg(kwargs, "tags", expected_type=dict,
+                                required=False)
+
+        backup.tags = tags
+
+        bc = get_mbs().backup_collection
+        try:
+            # resolve tags
+
+            self._resolve_task_tags(backup)
+        except Exception, ex:
+            self._task_failed_to_schedule(backup, bc, ex)
+
+        return backup
+
 
     ###########################################################################
     def create_backup_plan(self, **kwargs):
@@ -495,6 +611,7 @@ class BackupSystem(Thread):
             }
         }
         get_mbs().plan_collection.update(spec=q, document=u)
+        self._scheduler.plan_updated(plan)
 
     ###########################################################################
     def save_plan(self, plan):
@@ -526,6 +643,8 @@ class BackupSystem(Thread):
                 self.update_existing_plan(plan)
                 self.info("Plan updated successfully")
 
+            self._scheduler.plan_updated(plan)
+
 
         except Exception, e:
             raise BackupSystemError("Error while saving plan %s. %s" %
@@ -545,6 +664,7 @@ class BackupSystem(Thread):
             get_mbs().deleted_plan_collection.save_document(plan.to_document())
             logger.info("Removing plan '%s' from plans" % plan_id)
             get_mbs().plan_collection.remove_by_id(plan_id)
+            self._scheduler.plan_removed(plan_id)
             return True
         else:
             logger.info("No such plan '%s'" % plan_id)
@@ -572,19 +692,22 @@ class BackupSystem(Thread):
     ###########################################################################
     def schedule_backup_restore(self, backup_id, destination_uri,tags=None,
                                 no_index_restore=None, no_users_restore=None, no_roles_restore=None,
-                                source_database_name=None):
+                                source_database_name=None, stream_restore=None, point_in_time=None):
         backup = get_mbs().backup_collection.get_by_id(backup_id)
         destination = build_backup_source(destination_uri)
         logger.info("Scheduling a restore for backup '%s'" % backup.id)
         restore = Restore()
 
         restore.state = State.SCHEDULED
+        restore.reset_priority_date()
         restore.source_backup = backup
         restore.source_database_name = source_database_name
+        restore.point_in_time = point_in_time
         restore.strategy = backup.strategy
         restore.strategy.no_index_restore = no_index_restore
         restore.strategy.no_users_restore = no_users_restore
         restore.strategy.no_roles_restore = no_roles_restore
+        restore.strategy.stream_restore = stream_restore
         restore.destination = destination
         # resolve tags
         tags = tags or restore.source_backup.tags
@@ -0,0 +1,201 @@
+__author__ = 'abdul'
+
+import os
+import time
+import json
+import urllib
+import urllib2
+import logging
+
+from threading import Lock
+
+from globals import Priority
+
+# Engine wide bandwidth scheduling. The engine owns a BandwidthManager and
+# task worker processes ask it (through the engine command server) for
+# permission before transferring data to/from targets
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+# env var that tells task workers where to get bandwidth grants from
+BANDWIDTH_URL_ENV_VAR = "MBS_ENGINE_BANDWIDTH_URL"
+
+# transfers are granted in slices of this size so that the shares of tasks
+# adjust quickly when tasks start/finish or the cap changes
+GRANT_SIZE = 8 * 1024 * 1024
+
+# consumers that did not ask for a grant within this are not sharing the
+# bandwidth anymore
+CONSUMER_IDLE_SECONDS = 5
+
+# seconds to wait for the engine to answer a grant request
+GRANT_REQUEST_TIMEOUT = 10
+
+# don't retry the engine for this long after a failed grant request
+GRANT_FAILURE_BACKOFF = 60
+
+###############################################################################
+def priority_weight(priority):
+    """
+        Share of bandwidth of a task relative to other tasks. HIGH priority
+        tasks get 11 times the share of LOW priority ones
+    """
+    if priority is None:
+        priority = Priority.LOW
+    return max(1, Priority.LOW - priority + 1)
+
+###############################################################################
+# BandwidthManager
+###############################################################################
+class BandwidthManager(object):
+    """
+        Shares max_mb_per_second among the tasks of an engine that are
+        currently transferring data, in proportion to their priority weight.
+        Each consumer has a token bucket refilled at its share of the cap.
+        acquire() takes tokens and returns how long the consumer has to wait
+        until they are available. No cap means grants never wait
+    """
+    ###########################################################################
+    def __init__(self, max_mb_per_second=None):
+        self._max_mb_per_second = max_mb_per_second
+        self._weights = {}
+        self._consumers = {}
+        self._lock = Lock()
+
+    ###########################################################################
+    @property
+    def max_mb_per_second(self):
+        return self._max_mb_per_second
+
+    @max_mb_per_second.setter
+    def max_mb_per_second(self, val):
+        with self._lock:
+            self._max_mb_per_second = float(val) if val else None
+            # start over with the new rate
+            self._consumers = {}
+
+    ###########################################################################
+    def register(self, consumer_id, priority):
+        with self._lock:
+            self._weights[consumer_id] = priority_weight(priority)
+
+    ###########################################################################
+    def unregister(self, consumer_id):
+        with self._lock:
+            self._weights.pop(consumer_id, None)
+            self._consumers.pop(consumer_id, None)
+
+    ###########################################################################
+    def acquire(self, consumer_id, num_bytes):
+        """
+            Returns the number of seconds the consumer has to wait before
+            transferring num_bytes
+        """
+        with self._lock:
+            if not self._max_mb_per_second:
+                return 0
+
+            now = time.time()
+            self._expire_idle_consumers(now)
+            consumer = self._consumers.setdefault(consumer_id, {
+                "nextGrantTime": now
+            })
+            consumer["lastGrantTime"] = now
+
+            rate = self._get_consumer_rate(consumer_id)
+            start = max(now, consumer["nextGrantTime"])
+            consumer["nextGrantTime"] = start + float(num_bytes) / rate
+            return start - now
+
+    ###########################################################################
+    def _get_consumer_rate(self, consumer_id):
+        total_weight = sum(self._get_weight(c) for c in self._consumers)
+        return (self._max_mb_per_second * 1024 * 1024 *
+                self._get_weight(consumer_id) / total_weight)
+
+    ###########################################################################
+    def _get_weight(self, consumer_id):
+        # consumers that were not registered (e.g. started manually) get the
+        # lowest priority
+        return self._weights.get(consumer_id, priority_weight(Priority.LOW))
+
+    ###########################################################################
+    def _expire_idle_consumers(self, now):
+        for consumer_id, consumer in self._consumers.items():
+            if (now - consumer["lastGrantTime"] > CONSUMER_IDLE_SECONDS and
+                    consumer["nextGrantTime"] < now):
+                del self._consumers[consumer_id]
+
+    ###########################################################################
+    def get_status(self):
+        with self._lock:
+            status = {
+                "maxMBPerSecond": self._max_mb_per_second,
+                "activeConsumers": len(self._consumers)
+            }
+            if self._max_mb_per_second and self._consumers:
+                status["consumerMBPerSecond"] = dict(
+                    (str(c), round(self._get_consumer_rate(c) /
+                                   (1024 * 1024), 2))
+                    for c in self._consumers)
+            return status
+
+###############################################################################
+# Task worker side
+###############################################################################
+_consumer_id = None
+_grant_failure_time = None
+
+###############################################################################
+def set_consumer(consumer_id):
+    """
+        Sets the id (task id) that transfers of this process are accounted to
+    """
+    global _consumer_id
+    _consumer_id = consumer_id
+
+###############################################################################
+def consume(num_bytes):
+    """
+        Blocks until the engine grants num_bytes to the current consumer.
+        Does nothing when not running under an engine. Transfers are not
+        throttled if the engine can not be reached
+    """
+    url = os.environ.get(BANDWIDTH_URL_ENV_VAR)
+    if not url or not _consumer_id:
+        return
+
+    while num_bytes > 0:
+        grant_size = min(num_bytes, GRANT_SIZE)
+        wait = _request_grant(url, grant_size)
+        if wait:
+            time.sleep(wait)
+        num_bytes -= grant_size
+
+###############################################################################
+def _request_grant(url, num_bytes):
+    global _grant_failure_time
+    if (_grant_failure_time and
+            time.time() - _grant_failure_time < GRANT_FAILURE_BACKOFF):
+        return 0
+
+    data = urllib.urlencode({
+        "consumerId": _consumer_id,
+        "bytes": num_bytes
+    })
+    try:
+        response = urllib2.urlopen(url, data, timeout=GRANT_REQUEST_TIMEOUT)
+        return json.loads(response.read())["wait"]
+    except Exception, e:
+        logger.warning("Failed to get a bandwidth grant from '%s'. Transfers "
+                       "will not be throttled for %s seconds. Cause: %s" %
+                       (url, GRANT_FAILURE_BACKOFF, e))
+        _grant_failure_time = time.time()
+        return 0
@@ -1,20 +1,123 @@
 __author__ = 'abdul'
 
+import time
+import atexit
+import logging
+
+from threading import Thread, Lock
+from pymongo import UpdateOne
+from bson.dbref import DBRef
+
 from globals import EventType
-from utils import listify
+from errors import MBSError
+from utils import listify, document_key_attribute_name
 from makerpy.object_collection import ObjectCollection
+from object_maker import ObjectMaker
 from mongo_utils import objectiditify
 import traceback
 
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+# max seconds a coalesced task progress update waits before being written
+PROGRESS_FLUSH_INTERVAL = 5
+
 ###############################################################################
 # MBSObjectCollection class
 ###############################################################################
 class MBSObjectCollection(ObjectCollection):
+    """
+        Objects are made with a compiled ObjectMaker.
+        find()/find_one()/find_iter() also take:
+          projection: fields (list or pymongo projection) to load. Objects
+                      only have these set and can not be updated with
+                      update_task() for other fields
+          lazy: typed sub-documents (source, target, plan...) are only made
+                into objects when their property is first accessed
+    """
     ###########################################################################
     def __init__(self, collection, clazz=None, type_bindings=None):
         # call super
         ObjectCollection.__init__(self, collection, clazz=clazz,
                                   type_bindings=type_bindings)
+        self._clazz = clazz
+        self._object_maker = ObjectMaker(type_bindings=type_bindings)
+
+    ###########################################################################
+    def find_iter(self, query=None, projection=None, lazy=False, **kwargs):
+        projection = _object_projection(projection)
+        cursor = self.collection.find(query, projection, **kwargs)
+        for doc in cursor:
+            yield self._make_object(doc, projection, lazy)
+
+    ###########################################################################
+    def find(self, query=None, projection=None, lazy=False, **kwargs):
+        return list(self.find_iter(query=query, projection=projection,
+                                   lazy=lazy, **kwargs))
+
+    ###########################################################################
+    def find_one(self, query=None, projection=None, lazy=False, **kwargs):
+        projection = _object_projection(projection)
+        doc = self.collection.find_one(query, projection, **kwargs)
+        if doc is not None:
+            return self._make_object(doc, projection, lazy)
+
+    ###########################################################################
+    def make_object(self, doc, projection=None, lazy=False):
+        """
+            Makes an object from a document of this collection that was not
+            read by find() (e.g. an aggregation result) and has only the
+            fields of projection
+        """
+        return self._make_object(doc, _object_projection(projection), lazy)
+
+    ###########################################################################
+    def _make_object(self, doc, projection=None, lazy=False):
+        if "_type" not in doc and self._clazz:
+            doc["_type"] = self._clazz.__name__
+
+        # referenced documents (e.g. restore source backups) are made too
+        for key, value in doc.items():
+            if isinstance(value, DBRef):
+                doc[key] = self.collection.database.dereference(value)
+
+        lazy_docs = _pop_typed_documents(doc) if lazy else None
+        obj = self._object_maker.make(doc)
+
+        if lazy_docs:
+            self._defer_documents(obj, lazy_docs)
+
+        if projection is not None:
+            obj._projection = projection
+
+        return obj
+
+    ###########################################################################
+    def _defer_documents(self, obj, lazy_docs):
+        deferred = {}
+        for key, value in lazy_docs.items():
+            attr = document_key_attribute_name(key)
+            prop = getattr(type(obj), attr, None)
+            # only sub-documents backed by a settable property can wait
+            if isinstance(prop, property) and prop.fset:
+                deferred[attr] = value
+            else:
+                setattr(obj, attr, self._make_value(value))
+
+        if deferred:
+            obj.__class__ = _lazy_class(obj.__class__, deferred.keys())
+            obj._lazy_documents = deferred
+            obj._object_collection = self
+
+    ###########################################################################
+    def _make_value(self, value):
+        return self._object_maker.make(value)
 
     ###########################################################################
     def get_by_id(self, object_id):
@@ -34,47 +137,365 @@ class MBSObjectCollection(ObjectCollection):
 ###############################################################################
 class MBSTaskCollection(MBSObjectCollection):
     ###########################################################################
-    def __init__(self, collection, clazz=None, type_bindings=None):
+    def __init__(self, collection, clazz=None, type_bindings=None,
+                 max_log_entries=None):
         # call super
         MBSObjectCollection.__init__(self, collection, clazz=clazz,
                                      type_bindings=type_bindings)
+        # older log entries are moved to the task events collection when
+        # tasks change state (if set)
+        self._max_log_entries = max_log_entries
+        # task id => coalesced update waiting to be written
+        self._pending_updates = {}
+        self._pending_lock = Lock()
+        self._flusher = None
 
     ###########################################################################
     def update_task(self, task, properties=None, event_name=None,
                     event_type=EventType.INFO, message=None, details=None,
-                    error_code=None,
+                    error_code=None, coalesce=False,
                     **update_kwargs):
         """
-            Updates the specified properties of the specified MBSTask object
+            Updates the specified properties of the specified MBSTask object.
+            coalesce=True is for progress updates that can be late: they are
+            written in batches every PROGRESS_FLUSH_INTERVAL seconds, or with
+            the next regular update of the task. State changes are never
+            coalesced and are journaled
         """
-        task_doc = task.to_document()
-        q = {
-            "_id": task.id
-        }
-
-        u = {}
+        properties = listify(properties) if properties else []
+        _validate_loaded(task, properties)
 
+        log_entries = []
         # log the event as needed
         if event_name or message:
-            log_entry = task.log_event(name=event_name, event_type=event_type,message=message, details=details,
-                                       error_code=error_code)
-            # push if "logs" property is not included
-            if not (properties and "logs" in properties):
-                u["$push"] = {"logs": log_entry.to_document()}
-
-        # construct $set operator
-        if properties:
-            properties = listify(properties)
-            u["$set"] = {}
-            for prop in properties:
-                u["$set"][prop] = task_doc.get(prop)
-
-        if not u or ("$set" not in u and "$push" not in u):
+            log_entries.append(
+                task.log_event(name=event_name, event_type=event_type,message=message, details=details,
+                               error_code=error_code))
+
+        if not properties and not log_entries:
             import mbs
             import notification.handler
             mbs.get_mbs().notifications.send_event_notification(
-                "BAD UPDATE", "BAD UPDATE for task %s: %s , %s" % (task.id, u, traceback.format_exc()),
+                "BAD UPDATE", "BAD UPDATE for task %s: %s , %s" % (task.id, properties, traceback.format_exc()),
                 priority=notification.handler.NotificationPriority.CRITICAL)
             raise Exception("BAD UPDATE!!!!!")
 
+        if coalesce and "state" not in properties:
+            self._queue_update(task, properties, log_entries)
+            return
+
+        # write pending progress of the task along so it is not reordered
+        pending = self._pop_pending_update(task.id)
+        if pending:
+            properties = list(pending["properties"].union(properties))
+            log_entries = pending["logEntries"] + log_entries
+
+        if "state" in properties:
+            update_kwargs["j"] = True
+            if self._max_log_entries:
+                self._archive_logs(task)
+
+        q = {
+            "_id": task.id
+        }
+
+        u = _build_task_update(task, properties, log_entries)
+
         self.update(spec=q, document=u, **update_kwargs)
+
+    ###########################################################################
+    def update_tasks(self, tasks, properties=None, event_name=None,
+                     event_type=EventType.INFO, message=None):
+        """
+            Updates the specified (non state) properties of all tasks with one
+            bulk write and logs the event to each
+        """
+        properties = listify(properties) if properties else []
+        if "state" in properties:
+            raise MBSError("State changes can not be bulk updated")
+
+        requests = []
+        for task in tasks:
+            _validate_loaded(task, properties)
+            log_entries = []
+            if event_name or message:
+                log_entries.append(task.log_event(name=event_name,
+                                                  event_type=event_type,
+                                                  message=message))
+            # write pending progress of the task along
+            pending = self._pop_pending_update(task.id)
+            task_properties = properties
+            if pending:
+                task_properties = list(pending["properties"].union(properties))
+                log_entries = pending["logEntries"] + log_entries
+
+            u = _build_task_update(task, task_properties, log_entries)
+            requests.append(UpdateOne({"_id": task.id}, u))
+
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+    ###########################################################################
+    def _archive_logs(self, task):
+        """
+            Moves older log entries of the task to the task events
+            collection. Returns True if logs were archived.
+            Archived entries are $pull-ed by identity rather than $set-ing
+            logs so that entries $push-ed meanwhile by others are kept
+        """
+        # tasks loaded without their logs would lose them
+        if not _is_loaded(task, "logs"):
+            return False
+
+        log_entries = task.get_archivable_logs(self._max_log_entries)
+        if not log_entries:
+            return False
+
+        import mbs
+        events = []
+        for log_entry in log_entries:
+            event = log_entry.to_document()
+            event["taskId"] = objectiditify(task.id)
+            event["taskType"] = task.type_name
+            events.append(event)
+
+        try:
+            mbs.get_mbs().task_events_collection.insert_many(events)
+        except Exception, e:
+            # keep the entries in the task until next time
+            logger.error("Failed to archive %s log entries of task %s: %s" %
+                         (len(events), task.id, e))
+            return False
+
+        u = {
+            "$pull": {
+                "logs": {
+                    "$or": map(_log_entry_identity, log_entries)
+                }
+            }
+        }
+        counts = {}
+        for log_entry in log_entries:
+            if log_entry.name:
+                key = "archivedEventCounts.%s" % log_entry.name
+                counts[key] = counts.get(key, 0) + 1
+        if counts:
+            u["$inc"] = counts
+
+        try:
+            self.update(spec={"_id": task.id}, document=u)
+        except Exception, e:
+            logger.error("Failed to remove %s archived log entries of task "
+                         "%s: %s" % (len(log_entries), task.id, e))
+            return False
+
+        task.archive_logs(log_entries)
+        return True
+
+    ###########################################################################
+    def _queue_update(self, task, properties, log_entries):
+        with self._pending_lock:
+            pending = self._pending_updates.setdefault(task.id, {
+                "properties": set(),
+                "logEntries": []
+            })
+            # values are exported when written so that the latest are used
+            pending["task"] = task
+            pending["properties"].update(properties)
+            pending["logEntries"].extend(log_entries)
+
+            if self._flusher is None:
+                self._flusher = Thread(target=self._flush_periodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+                atexit.register(self.flush_pending_updates)
+
+    ###########################################################################
+    def _pop_pending_update(self, task_id):
+        with self._pending_lock:
+            return self._pending_updates.pop(task_id, None)
+
+    ###########################################################################
+    def _flush_periodically(self):
+        while True:
+            time.sleep(PROGRESS_FLUSH_INTERVAL)
+            self.flush_pending_updates()
+
+    ###########################################################################
+    def flush_pending_updates(self):
+        """
+            Writes all coalesced task updates in one batch
+        """
+        with self._pending_lock:
+            pending_updates = self._pending_updates
+            self._pending_updates = {}
+
+        if not pending_updates:
+            return
+
+        requests = []
+        for task_id, pending in pending_updates.items():
+            u = _build_task_update(pending["task"], pending["properties"],
+                                   pending["logEntries"])
+            requests.append(UpdateOne({"_id": objectiditify(task_id)}, u))
+
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception, e:
+            # progress is best effort. next updates carry the latest values
+            logger.error("Failed to write %s coalesced task updates: %s" %
+                         (len(requests), e))
+
+###############################################################################
+def _log_entry_identity(log_entry):
+    """
+        Query matching the specified log entry within the task logs array
+    """
+    return {
+        "date": log_entry.date,
+        "eventType": log_entry.event_type,
+        "state": log_entry.state,
+        "name": log_entry.name
+    }
+
+###############################################################################
+def _build_task_update(task, properties, log_entries):
+    u = {}
+    # push if "logs" property is not included
+    if log_entries and "logs" not in properties:
+        u["$push"] = {
+            "logs": {
+                "$each": [entry.to_document() for entry in log_entries]
+            }
+        }
+
+    # construct $set operator
+    if properties:
+        u["$set"] = task.export_properties(properties)
+
+    return u
+
+###############################################################################
+# Partial/lazy loading helpers
+###############################################################################
+# sub-documents that are never loaded lazily. Task logs are indexed as soon
+# as they are set
+EAGER_FIELDS = ["logs"]
+
+# class => subclass with lazy properties, per set of lazy fields
+_LAZY_CLASSES = {}
+_MISSING = object()
+
+###############################################################################
+def _object_projection(projection):
+    """
+        Returns the pymongo projection for the specified fields. Inclusion
+        projections also get the _type of the objects in the projected paths
+        so that the right classes are made
+    """
+    if projection is None:
+        return None
+
+    if isinstance(projection, dict):
+        spec = dict(projection)
+    else:
+        spec = dict((field, 1) for field in listify(projection))
+
+    if _is_exclusion(spec):
+        return spec
+
+    spec["_type"] = 1
+    for field in spec.keys():
+        parts = field.split(".")
+        for i in range(1, len(parts)):
+            prefix = ".".join(parts[:i])
+            # sub-document is loaded whole already
+            if prefix in spec:
+                break
+            spec.setdefault(prefix + "._type", 1)
+
+    return spec
+
+###############################################################################
+def _is_exclusion(projection):
+    return not any(v for f, v in projection.items() if f != "_id")
+
+###############################################################################
+def _pop_typed_documents(doc):
+    """
+        Removes typed sub-documents (or lists of them) from doc and returns
+        them
+    """
+    return dict((key, doc.pop(key)) for key, value in doc.items()
+                if key not in EAGER_FIELDS and _is_typed_document(value))
+
+###############################################################################
+def _is_typed_document(value):
+    if isinstance(value, list):
+        return bool(value) and all(_is_typed_document(v) for v in value)
+    return isinstance(value, dict) and "_type" in value
+
+###############################################################################
+def _lazy_class(clazz, attrs):
+    """
+        Returns a subclass of clazz (same name, so objects still report their
+        type) whose specified properties make their objects on first access
+    """
+    key = (clazz, frozenset(attrs))
+    lazy_class = _LAZY_CLASSES.get(key)
+    if lazy_class is None:
+        members = {
+            "__module__": clazz.__module__
+        }
+        for attr in attrs:
+            members[attr] = _lazy_property(attr, getattr(clazz, attr))
+        members["__reduce_ex__"] = _reduce_lazy_object
+        lazy_class = type(clazz.__name__, (clazz,), members)
+        _LAZY_CLASSES[key] = lazy_class
+
+    return lazy_class
+
+###############################################################################
+def _lazy_property(attr, base_property):
+    def getter(obj):
+        lazy_doc = obj._lazy_documents.pop(attr, _MISSING)
+        if lazy_doc is not _MISSING:
+            base_property.fset(obj, obj._object_collection._make_value(lazy_doc))
+        return base_property.fget(obj)
+
+    def setter(obj, value):
+        obj._lazy_documents.pop(attr, None)
+        base_property.fset(obj, value)
+
+    return property(getter, setter, doc=base_property.__doc__)
+
+###############################################################################
+def _reduce_lazy_object(obj, protocol):
+    # lazy classes can not be pickled by name so objects are pickled fully
+    # made as their base class
+    for attr in obj._lazy_documents.keys():
+        getattr(obj, attr)
+    state = obj.__dict__.copy()
+    state.pop("_lazy_documents", None)
+    state.pop("_object_collection", None)
+    return _new_object, (type(obj).__bases__[0],), state
+
+###############################################################################
+def _new_object(clazz):
+    return clazz.__new__(clazz)
+
+###############################################################################
+def _is_loaded(obj, field):
+    projection = getattr(obj, "_projection", None)
+    if projection is None:
+        return True
+    if _is_exclusion(projection):
+        return projection.get(field, 1)
+    return projection.get(field, 0)
+
+###############################################################################
+def _validate_loaded(task, properties):
+    missing = [p for p in properties if not _is_loaded(task, p)]
+    if missing:
+        raise MBSError("Can not update properties %s of task %s that were "
+                       "not loaded" % (missing, task.id))
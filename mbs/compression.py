@@ -0,0 +1,125 @@
+__author__ = 'abdul'
+
+import multiprocessing
+
+from utils import which
+from errors import ConfigurationError
+
+# Contains compression codecs used for backup archives
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_PIGZ = "pigz"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_LZ4 = "lz4"
+COMPRESSION_NONE = "none"
+
+DEFAULT_COMPRESSION = COMPRESSION_GZIP
+
+###############################################################################
+# CompressionCodec
+###############################################################################
+class CompressionCodec(object):
+    """
+        Describes how a tar archive is compressed/decompressed. Compression
+        and decompression run as a separate program that tar pipes through
+        (tar --use-compress-program)
+    """
+    ###########################################################################
+    def __init__(self, name, extension, exe_name=None, compress_args=None,
+                 decompress_args=None):
+        self._name = name
+        self._extension = extension
+        self._exe_name = exe_name
+        self._compress_args = compress_args or []
+        self._decompress_args = decompress_args or ["-d"]
+
+    ###########################################################################
+    @property
+    def name(self):
+        return self._name
+
+    ###########################################################################
+    @property
+    def extension(self):
+        return self._extension
+
+    ###########################################################################
+    def compress_program(self):
+        """
+            Returns the compress program to pass to tar. None means that tar
+            does not compress
+        """
+        return self._program(self._compress_args)
+
+    ###########################################################################
+    def decompress_program(self):
+        return self._program(self._decompress_args)
+
+    ###########################################################################
+    def tar_create_command(self, file_name, dump_dir):
+        tar_cmd = [which("tar"), "-cvf", file_name]
+        program = self.compress_program()
+        if program:
+            tar_cmd.append("--use-compress-program=%s" % program)
+        tar_cmd.append(dump_dir)
+        return tar_cmd
+
+    ###########################################################################
+    def tar_extract_command(self, file_name):
+        """
+            file_name "-" extracts from stdin
+        """
+        tar_cmd = [which("tar"), "-xf", file_name]
+        program = self.decompress_program()
+        if program:
+            tar_cmd.append("--use-compress-program=%s" % program)
+        return tar_cmd
+
+    ###########################################################################
+    def _program(self, args):
+        if not self._exe_name:
+            return None
+        exe = which(self._exe_name)
+        if not exe:
+            raise ConfigurationError("'%s' compression requires '%s' "
+                                     "exe in PATH" % (self.name,
+                                                      self._exe_name))
+        return " ".join([exe] + args)
+
+###############################################################################
+CODECS = {
+    COMPRESSION_GZIP: CompressionCodec(COMPRESSION_GZIP, "tgz", exe_name="gzip"),
+    # gzip compatible output, compressed using all cores
+    COMPRESSION_PIGZ: CompressionCodec(
+        COMPRESSION_PIGZ, "tgz", exe_name="pigz",
+        compress_args=["-p", str(multiprocessing.cpu_count())]),
+    COMPRESSION_ZSTD: CompressionCodec(
+        COMPRESSION_ZSTD, "tar.zst", exe_name="zstd",
+        compress_args=["-T0", "-q"], decompress_args=["-d", "-q"]),
+    COMPRESSION_LZ4: CompressionCodec(
+        COMPRESSION_LZ4, "tar.lz4", exe_name="lz4",
+        compress_args=["-q"], decompress_args=["-d", "-q"]),
+    COMPRESSION_NONE: CompressionCodec(COMPRESSION_NONE, "tar")
+}
+
+###############################################################################
+def get_codec(name):
+    """
+        Returns the codec with the specified name. None returns the default
+        codec which all backups taken before compression was configurable use
+    """
+    name = name or DEFAULT_COMPRESSION
+    if name not in CODECS:
+        raise ConfigurationError("Unknown compression '%s'. Valid values are"
+                                 " %s" % (name, sorted(CODECS.keys())))
+    return CODECS[name]
+
+###############################################################################
+def strip_extension(file_name, codec):
+    suffix = ".%s" % codec.extension
+    if file_name.endswith(suffix):
+        return file_name[:-len(suffix)]
+    return file_name
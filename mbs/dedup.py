@@ -0,0 +1,194 @@
+__author__ = 'abdul'
+
+import math
+import time
+import zlib
+import logging
+
+from pymongo.errors import DuplicateKeyError
+
+from date_utils import date_now, date_minus_seconds
+from errors import ChunkLockedError
+
+# Content-defined chunking and chunk reference counting used by DedupTarget
+
+###############################################################################
+# LOGGER
+###############################################################################
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+DEFAULT_AVERAGE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Chunk boundaries are only considered right after occurrences of the anchor
+# byte so that the scan runs in C (str.find + crc32) instead of hashing every
+# byte in python. Compressed data has an anchor every 256 bytes on average.
+# In uncompressed dumps 0x02 is the BSON string type marker so anchors follow
+# the document structure
+ANCHOR_BYTE = "\x02"
+
+# number of bytes hashed after an anchor to decide if it is a boundary
+ANCHOR_WINDOW = 48
+
+READ_SIZE = 1024 * 1024
+
+# seconds to wait for a chunk that is being deleted before adding a
+# reference to it
+CHUNK_LOCK_WAIT = 2
+CHUNK_LOCK_MAX_WAITS = 60
+
+# chunk deletes that did not complete within this are considered abandoned
+STALE_CHUNK_LOCK_SECONDS = 60 * 60
+
+###############################################################################
+def content_defined_chunks(file_obj, average_size=None):
+    """
+        Generates chunks of the content of file_obj. Boundaries depend on the
+        content only so inserting/removing bytes only changes the chunks
+        around the edit and the rest are deduplicated. Chunks are between
+        average_size / 2 and average_size * 4 bytes
+    """
+    average_size = average_size or DEFAULT_AVERAGE_CHUNK_SIZE
+    min_size = max(1, average_size / 2)
+    max_size = average_size * 4
+    mask = _boundary_mask(average_size - min_size)
+
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        # keep at least max_size bytes ahead of pos unless at the end
+        if not eof and len(buf) - pos < max_size:
+            parts = [buf[pos:]]
+            size = len(parts[0])
+            while size < max_size:
+                data = file_obj.read(READ_SIZE)
+                if not data:
+                    eof = True
+                    break
+                parts.append(data)
+                size += len(data)
+            buf = "".join(parts)
+            pos = 0
+
+        if pos >= len(buf):
+            break
+
+        end = _find_boundary(buf, pos, min_size, max_size, mask)
+        yield buf[pos:end]
+        pos = end
+
+###############################################################################
+def _find_boundary(buf, start, min_size, max_size, mask):
+    limit = min(len(buf), start + max_size)
+    i = buf.find(ANCHOR_BYTE, start + min_size, limit)
+    while i != -1:
+        window = buf[i:i + ANCHOR_WINDOW]
+        if (len(window) == ANCHOR_WINDOW and
+                zlib.crc32(window) & mask == 0):
+            return i + 1
+        i = buf.find(ANCHOR_BYTE, i + 1, limit)
+
+    return limit
+
+###############################################################################
+def _boundary_mask(expected_distance):
+    """
+        Mask that makes one anchor out of expected_distance / 256 a boundary
+    """
+    anchors = max(1, expected_distance / 256)
+    bits = int(round(math.log(anchors, 2)))
+    return (1 << bits) - 1
+
+###############################################################################
+# ChunkIndex
+###############################################################################
+class ChunkIndex(object):
+    """
+        Reference counts chunks stored in targets. Each chunk document lists
+        the manifests that reference it so that adding/removing a reference
+        is idempotent and safe to retry. A chunk that lost its last reference
+        is locked (deletingDate) until its object is deleted so that it can
+        not be referenced again in the meantime
+    """
+    ###########################################################################
+    def __init__(self, collection):
+        self._collection = collection
+
+    ###########################################################################
+    def add_reference(self, chunk_key, manifest_path, size):
+        """
+            Returns True if the chunk is not stored yet and must be uploaded
+        """
+        for i in range(CHUNK_LOCK_MAX_WAITS):
+            try:
+                doc = self._collection.find_and_modify(
+                    query={
+                        "_id": chunk_key,
+                        "deletingDate": None
+                    },
+                    update={
+                        "$addToSet": {"references": manifest_path},
+                        "$setOnInsert": {"size": size}
+                    },
+                    upsert=True,
+                    new=True)
+                return not doc.get("stored")
+            except DuplicateKeyError:
+                # chunk exists but is being deleted
+                logger.info("Chunk '%s' is being deleted. Waiting for delete "
+                            "to finish" % chunk_key)
+                self._unlock_stale(chunk_key)
+                time.sleep(CHUNK_LOCK_WAIT)
+
+        raise ChunkLockedError("Timed out waiting for chunk '%s' to be "
+                               "deleted" % chunk_key)
+
+    ###########################################################################
+    def mark_stored(self, chunk_key):
+        self._collection.update({"_id": chunk_key},
+                                {"$set": {"stored": True}})
+
+    ###########################################################################
+    def remove_reference(self, chunk_key, manifest_path):
+        """
+            Returns True if the chunk is no longer referenced. The chunk is
+            then locked and the caller must delete its object and call
+            chunk_deleted(), or unlock() on failure
+        """
+        self._collection.update({"_id": chunk_key},
+                                {"$pull": {"references": manifest_path}})
+
+        doc = self._collection.find_and_modify(
+            query={
+                "_id": chunk_key,
+                "references": {"$size": 0},
+                "deletingDate": None
+            },
+            update={
+                "$set": {"deletingDate": date_now()}
+            })
+
+        return doc is not None
+
+    ###########################################################################
+    def chunk_deleted(self, chunk_key):
+        self._collection.remove({"_id": chunk_key})
+
+    ###########################################################################
+    def unlock(self, chunk_key):
+        # the object may or may not have been deleted
+        self._collection.update({"_id": chunk_key},
+                                {"$unset": {"deletingDate": 1},
+                                 "$set": {"stored": False}})
+
+    ###########################################################################
+    def _unlock_stale(self, chunk_key):
+        stale_date = date_minus_seconds(date_now(), STALE_CHUNK_LOCK_SECONDS)
+        self._collection.update({"_id": chunk_key,
+                                 "deletingDate": {"$lt": stale_date}},
+                                {"$unset": {"deletingDate": 1},
+                                 "$set": {"stored": False}})
@@ -3,6 +3,9 @@ __author__ = 'abdul'
 
 import traceback
 import os
+import sys
+import json
+import fcntl
 
 import time
 import datetime
@@ -16,7 +19,9 @@ import persistence
 from flask import Flask
 from flask.globals import request
 from globals import State, EventType
-from threading import Thread
+from threading import Thread, Event, Lock
+from pymongo.errors import OperationFailure
+from mongo_utils import objectiditify
 
 
 from errors import (
@@ -38,6 +43,7 @@ from task import (
 
 from backup import Backup
 from restore import Restore
+from bandwidth import BandwidthManager, BANDWIDTH_URL_ENV_VAR, set_consumer
 from mbs_client.client import BackupEngineClient
 
 from task_utils import set_task_retry_info, trigger_task_finished_event
@@ -64,6 +70,24 @@ STATUS_STOPPED = "stopped"
 # Failed one-off max due time (2 hours)
 MAX_FAIL_DUE_TIME = 2 * 60 * 60
 
+# How often (seconds) task processors check if a worker finished while
+# waiting for the next tick
+WORKER_CHECK_INTERVAL = 1
+
+# Seconds to wait before reopening a task change stream that errored
+CHANGE_STREAM_RETRY_INTERVAL = 30
+
+# Scheduled tasks are claimed in this order. Priority dates are delayed by
+# priority so tasks age into getting claimed (see MBSTask.priority_date)
+CLAIM_SORT = [("priorityDate", 1)]
+
+# Number of tasks a pooled worker process runs before it is recycled
+DEFAULT_MAX_TASKS_PER_WORKER = 50
+
+# Number of pooled worker processes tried when starting a task before giving
+# up (a pooled process could die while idle)
+WORKER_POOL_START_ATTEMPTS = 3
+
 ###############################################################################
 # LOGGER
 ###############################################################################
@@ -96,6 +120,10 @@ class BackupEngine(Thread):
         self._backup_processor = None
         self._restore_processor = None
         self._client = None
+        self._use_worker_pool = False
+        self._max_tasks_per_worker = DEFAULT_MAX_TASKS_PER_WORKER
+        self._admission_control = None
+        self._bandwidth_manager = BandwidthManager()
 
 
     ###########################################################################
@@ -139,6 +167,69 @@ class BackupEngine(Thread):
         tags = tags or {}
         self._tags = tags
 
+    ###########################################################################
+    @property
+    def use_worker_pool(self):
+        """
+            Run tasks in a pool of warm worker processes instead of starting
+            a new process per task
+        """
+        return self._use_worker_pool
+
+    @use_worker_pool.setter
+    def use_worker_pool(self, val):
+        self._use_worker_pool = bool(val)
+
+    ###########################################################################
+    @property
+    def max_tasks_per_worker(self):
+        """
+            Pooled worker processes are recycled after running this many tasks
+        """
+        return self._max_tasks_per_worker
+
+    @max_tasks_per_worker.setter
+    def max_tasks_per_worker(self, val):
+        self._max_tasks_per_worker = int(val)
+
+    ###########################################################################
+    @property
+    def admission_control(self):
+        """
+            AdmissionController that decides if there are enough resources
+            to start a task. None admits tasks as long as there are workers
+        """
+        return self._admission_control
+
+    @admission_control.setter
+    def admission_control(self, val):
+        self._admission_control = val
+
+    ###########################################################################
+    @property
+    def bandwidth_manager(self):
+        return self._bandwidth_manager
+
+    ###########################################################################
+    @property
+    def max_bandwidth_mb_per_second(self):
+        """
+            Cap on the combined transfer rate of all tasks to/from targets.
+            Can be changed at runtime through the command server
+        """
+        return self._bandwidth_manager.max_mb_per_second
+
+    @max_bandwidth_mb_per_second.setter
+    def max_bandwidth_mb_per_second(self, val):
+        self._bandwidth_manager.max_mb_per_second = val
+
+    ###########################################################################
+    def get_task_worker_env_vars(self):
+        return {
+            BANDWIDTH_URL_ENV_VAR: "http://0.0.0.0:%s/acquire-bandwidth" %
+                                   self.command_port
+        }
+
     ###########################################################################
     @property
     def command_port(self):
@@ -308,8 +399,8 @@ class BackupEngine(Thread):
         self.info("Stopping engine gracefully. Waiting for %s workers"
                   " to finish" % self.worker_count)
 
-        self.backup_processor._stopped = True
-        self.restore_processor._stopped = True
+        self.backup_processor.stop()
+        self.restore_processor.stop()
         return self.worker_count == 0
 
     ###########################################################################
@@ -318,12 +409,12 @@ class BackupEngine(Thread):
             Gets the status of the engine
         """
         if self.backup_processor._stopped:
-            status = STATUS_STOPPING
+            engine_status = STATUS_STOPPING
         else:
-            status = STATUS_RUNNING
+            engine_status = STATUS_RUNNING
 
-        return {
-            "status": status,
+        status = {
+            "status": engine_status,
             "workers": {
                 "backups": self.backup_processor.worker_count,
                 "restores": self.restore_processor.worker_count
@@ -331,6 +422,13 @@ class BackupEngine(Thread):
             "versionInfo": get_mbs().get_version_info()
         }
 
+        if self.admission_control:
+            status["admissionControl"] = self.admission_control.get_status()
+
+        status["bandwidth"] = self.bandwidth_manager.get_status()
+
+        return status
+
     ###########################################################################
     def _pre_shutdown(self):
         self._stop_command_server()
@@ -380,13 +478,22 @@ class TaskQueueProcessor(Thread):
         self._stopped = False
         self._max_workers = int(max_workers)
         self._tick_count = 0
+        self._poll_count = 0
+        self._last_poll_time = None
+        self._wake_event = Event()
         self._workers = {}
         self._log_file_sweeper = TaskLogFileSweeper(task_type_name)
+        self._task_change_watcher = TaskChangeWatcher(self)
+        self._worker_pool = None
+        self._last_unadmitted_task_id = None
 
     ###########################################################################
     def run(self):
         self._log_file_sweeper.start()
+        if self._engine.use_worker_pool:
+            self._start_worker_pool()
         self._recover()
+        self._task_change_watcher.start()
 
         while not self._stopped:
             try:
@@ -395,10 +502,12 @@ class TaskQueueProcessor(Thread):
                 self.error("Caught an error: '%s'.\nStack Trace:\n%s" %
                            (e, traceback.format_exc()))
             finally:
-                time.sleep(self._sleep_time)
+                self._wait_for_next_tick()
 
         ## wait for all workers to finish (if any)
         self._wait_for_running_workers()
+        if self._worker_pool:
+            self._worker_pool.stop()
         self._log_file_sweeper.stop(True)
         self.info("Exited main loop")
 
@@ -407,21 +516,59 @@ class TaskQueueProcessor(Thread):
         # increase tick_counter
         self._tick_count += 1
 
-        # try to start the next task if there are available workers
-        if self._has_available_workers():
-            self._start_next_task()
-
-        # monitor workers
+        # monitor workers first to free up slots of finished workers
         self._monitor_workers()
 
-        # Check for canceled tasks every minute
+        # start as many tasks as there are available workers
+        self._start_next_tasks()
+
+        # ticks triggered by wake ups can be frequent so periodic checks only
+        # run every sleep_time
+        if not self._is_poll_due():
+            return
+
+        self._poll_count += 1
+        self._last_poll_time = time.time()
+
+        # Check for canceled tasks
         self._monitor_cancel_requests()
 
-        # Cancel a failed task every 40 ticks and there are available
+        # Cancel a failed task every 40 polls and there are available
         # workers
-        if self._tick_count % 40 == 0 and self._has_available_workers():
+        if self._poll_count % 40 == 0 and self._has_available_workers():
             self._clean_next_past_due_failed_task()
 
+    ###########################################################################
+    def _is_poll_due(self):
+        return (self._last_poll_time is None or
+                time.time() - self._last_poll_time >= self._sleep_time)
+
+    ###########################################################################
+    def _wait_for_next_tick(self):
+        """
+            Waits until woken up, a worker finishes or sleep_time passes
+        """
+        deadline = time.time() + self._sleep_time
+        while not self._stopped and time.time() < deadline:
+            if self._wake_event.wait(WORKER_CHECK_INTERVAL):
+                break
+            if self._has_finished_workers():
+                break
+
+        self._wake_event.clear()
+
+    ###########################################################################
+    def wake(self):
+        """
+            Triggers a tick without waiting for sleep_time
+        """
+        self._wake_event.set()
+
+    ###########################################################################
+    def stop(self):
+        self._stopped = True
+        self.wake()
+
     ###########################################################################
     def _wait_for_running_workers(self):
         self.info("Waiting for %s workers to finish" % self.worker_count)
@@ -444,10 +591,59 @@ class TaskQueueProcessor(Thread):
         return self._engine.get_task_collection_by_name(self._task_collection_name)
 
     ###########################################################################
-    def _start_next_task(self):
-        task = self.read_next_task()
-        if task:
-            self._start_task(task)
+    def _start_next_tasks(self):
+        """
+            Claims and starts tasks until all workers are busy or there are
+            no more scheduled tasks
+        """
+        admission_control = self._engine.admission_control
+        while not self._stopped and self._has_available_workers():
+            if admission_control:
+                task = self._admit_next_task(admission_control)
+            else:
+                # each claim is a single atomic round trip
+                task = self.read_next_task()
+            if not task:
+                break
+            try:
+                self._start_task(task)
+            except Exception:
+                # no worker is registered to free them when done
+                if admission_control:
+                    admission_control.release(task)
+                self._engine.bandwidth_manager.unregister(task.id)
+                raise
+
+    ###########################################################################
+    def _admit_next_task(self, admission_control):
+        """
+            Claims the next task only if admission control has the resources
+            for it. Tasks are admitted in claim order so a big task is not
+            starved by smaller ones behind it
+        """
+        query = self._get_scheduled_tasks_query()
+        engine_guid = self._engine.engine_guid
+        while not self._stopped:
+            candidate = peek_next_task(self.task_collection, query,
+                                       engine_guid)
+            if not candidate:
+                return None
+
+            reason = admission_control.reserve(candidate)
+            if reason:
+                if candidate.id != self._last_unadmitted_task_id:
+                    self.info("Not starting %s %s yet: %s" %
+                              (candidate.type_name, candidate.id, reason))
+                    self._last_unadmitted_task_id = candidate.id
+                return None
+
+            task = claim_next_task(self.task_collection, query, engine_guid,
+                                   task_id=candidate.id)
+            if task:
+                return task
+
+            # claimed by another engine in the meantime
+            admission_control.release(candidate)
 
     ###########################################################################
     def _monitor_workers(self):
@@ -470,7 +666,8 @@ class TaskQueueProcessor(Thread):
             "engineGuid": self._engine.engine_guid
         }):
             worker = self._get_task_worker(task_to_cancel)
-            if not isinstance(worker, TaskCleanWorker):
+            # the task is being cleaned up already
+            if not worker or not worker.is_cleaner:
                 logger.info("Found a cancel request for backup: %s" % task_to_cancel.id)
                 logger.info("Cancelling task: %s" % task_to_cancel.id)
                 self.cancel_task(task_to_cancel)
@@ -478,6 +675,9 @@ class TaskQueueProcessor(Thread):
     ###########################################################################
     def _cleanup_worker_resources(self, worker):
         del self._workers[worker.id]
+        if self._engine.admission_control:
+            self._engine.admission_control.release(worker.task)
+        self._engine.bandwidth_manager.unregister(worker.task.id)
 
     ###########################################################################
     def cancel_task(self, task):
@@ -515,14 +715,28 @@ class TaskQueueProcessor(Thread):
         worker = self._start_new_worker(task)
         self.info("Started %s %s (worker %s)" % (task.type_name, task.id, worker.pid))
 
+    ###########################################################################
+    def _start_worker_pool(self):
+        self.info("Starting a pool of %s worker processes" % self._max_workers)
+        self._worker_pool = WorkerProcessPool(
+            self._max_workers, self._engine.max_tasks_per_worker)
+        self._worker_pool.start()
+
     ###########################################################################
     def _start_new_worker(self, task, cleaner=False):
 
-        if not cleaner:
+        if self._worker_pool:
+            worker = PooledTaskWorker(task, self._worker_pool, cleaner=cleaner,
+                                      env_vars=self._engine.get_task_worker_env_vars())
+        elif not cleaner:
             worker = TaskWorker(task, env_vars=self._engine.get_task_worker_env_vars())
         else:
             worker = TaskCleanWorker(task, env_vars=self._engine.get_task_worker_env_vars())
 
+        if not cleaner:
+            self._engine.bandwidth_manager.register(
+                task.id, _get_bandwidth_priority(task))
+
         worker.start()
         self._workers[worker.id] = worker
 
@@ -532,6 +746,13 @@ class TaskQueueProcessor(Thread):
     def _has_available_workers(self):
         return self.worker_count < self._max_workers
 
+    ###########################################################################
+    def _has_finished_workers(self):
+        for worker in self._workers.values():
+            if not worker.is_alive():
+                return True
+        return False
+
     ###########################################################################
     def worker_crashed(self, worker):
         # page immediately
@@ -571,7 +792,7 @@ class TaskQueueProcessor(Thread):
             # update
             self.task_collection.update_task(task, message=msg)
 
-            self._start_task(task)
+            self._start_recovered_task(task)
 
             total_crashed += 1
 
@@ -589,7 +810,7 @@ class TaskQueueProcessor(Thread):
                 task.state = State.IN_PROGRESS
                 self.task_collection.update_task(task, properties="state", message=msg)
 
-                self._start_task(task)
+                self._start_recovered_task(task)
 
                 total_crashed += 1
 
@@ -597,43 +818,17 @@ class TaskQueueProcessor(Thread):
                   total_crashed)
 
     ###########################################################################
-    def read_next_task(self):
-
-        log_entry = state_change_log_entry(State.IN_PROGRESS)
-        q = self._get_scheduled_tasks_query()
-        u = {
-            "$set": {
-                "state": State.IN_PROGRESS,
-                "engineGuid": self._engine.engine_guid
-            },
-            "$push": {
-                "logs": log_entry.to_document()
-            }
-        }
-
-        # Ensure that engines will not pickup tasks that were already processed by other engines
-        if self._tick_count % 2 == 0:
-            q["engineGuid"] = self._engine.engine_guid
-        else:
-            q["engineGuid"] = None
-
-        # sort by priority except every third tick, we sort by created date to
-        # avoid starvation
-        if self._tick_count % 5 == 0:
-            s = [("createdDate", 1)]
-        else:
-            s = [("priority", 1)]
+    def _start_recovered_task(self, task):
+        # recovered tasks were already running so they are always admitted
+        if self._engine.admission_control:
+            self._engine.admission_control.reserve(task, force=True)
+        self._start_task(task)
 
-        c = self.task_collection
-
-        task = c.find_one(query=q, sort=s)
-        if task:
-            if task.engine_guid and task.engine_guid != self._engine.engine_guid:
-                raise Exception("Unexpected error")
-            else:
-                task = c.find_and_modify(query=q, sort=s, update=u, new=True)
-
-        return task
+    ###########################################################################
+    def read_next_task(self):
+        return claim_next_task(self.task_collection,
+                               self._get_scheduled_tasks_query(),
+                               self._engine.engine_guid)
 
     ###########################################################################
     def _read_next_failed_past_due_task(self):
@@ -703,6 +898,106 @@ class TaskQueueProcessor(Thread):
         """
         return None
 
+###############################################################################
+def _get_bandwidth_priority(task):
+    # backups share bandwidth by the priority of their plan
+    if isinstance(task, Backup) and task.plan:
+        return task.plan.priority
+    return task.priority
+
+###############################################################################
+def claim_next_task(collection, query, engine_guid, task_id=None):
+    """
+        Atomically claims the next scheduled task matching query for the
+        specified engine using a single find_and_modify. collection can be
+        a task collection (returns a task) or a pymongo collection (returns
+        a document). Only the specified task is claimed if task_id is set.
+        Returns None if there is no task to claim
+    """
+    q = _claimable_tasks_query(query, engine_guid)
+    if task_id:
+        q["_id"] = objectiditify(task_id)
+
+    log_entry = state_change_log_entry(State.IN_PROGRESS)
+    u = {
+        "$set": {
+            "state": State.IN_PROGRESS,
+            "engineGuid": engine_guid
+        },
+        "$push": {
+            "logs": log_entry.to_document()
+        }
+    }
+
+    return collection.find_and_modify(query=q, sort=CLAIM_SORT, update=u,
+                                      new=True)
+
+###############################################################################
+def peek_next_task(collection, query, engine_guid):
+    """
+        Returns the task that claim_next_task() would claim without
+        claiming it
+    """
+    return collection.find_one(_claimable_tasks_query(query, engine_guid),
+                               sort=CLAIM_SORT)
+
+###############################################################################
+def _claimable_tasks_query(query, engine_guid):
+    q = dict(query)
+    # tasks that were already processed by an engine can only be picked up
+    # by that same engine
+    q["engineGuid"] = {"$in": [engine_guid, None]}
+    return q
+
+###############################################################################
+# TaskChangeWatcher
+###############################################################################
+
+class TaskChangeWatcher(Thread):
+    """
+        Wakes up a task processor as soon as a task gets scheduled (inserted
+        or rescheduled) using a change stream on the task collection.
+        Change streams require a replica set (MongoDB 3.6+). When they are
+        not supported the processor just keeps polling every sleep_time
+    """
+    ###########################################################################
+    def __init__(self, processor):
+        Thread.__init__(self)
+        self.daemon = True
+        self._processor = processor
+
+    ###########################################################################
+    def run(self):
+        pipeline = [
+            {
+                "$match": {
+                    "$or": [
+                        {"operationType": "insert"},
+                        {"updateDescription.updatedFields.state":
+                             State.SCHEDULED}
+                    ]
+                }
+            }
+        ]
+
+        while not self._processor._stopped:
+            try:
+                collection = self._processor.task_collection.collection
+                with collection.watch(pipeline) as stream:
+                    self._processor.info("Watching for scheduled tasks")
+                    for change in stream:
+                        self._processor.wake()
+            except OperationFailure, e:
+                self._processor.warning("Task change streams are not "
+                                        "supported (%s). Falling back to "
+                                        "polling" % e)
+                return
+            except Exception, e:
+                self._processor.error("Error while watching for scheduled "
+                                      "tasks: %s. Retrying in %s seconds" %
+                                      (e, CHANGE_STREAM_RETRY_INTERVAL))
+                time.sleep(CHANGE_STREAM_RETRY_INTERVAL)
+
 ###############################################################################
 # TaskWorker
 ###############################################################################
@@ -714,7 +1009,7 @@ class TaskWorker(object):
         self._task = task
         self._popen = None
         self._id = None
-        self._env_vars = None
+        self._env_vars = env_vars
 
     ###########################################################################
     @property
@@ -738,6 +1033,14 @@ class TaskWorker(object):
         if self._popen:
             return self._popen.pid
 
+    ###########################################################################
+    @property
+    def is_cleaner(self):
+        """
+            True if the worker cleans up the task instead of running it
+        """
+        return False
+
     ###########################################################################
     def get_task_collection(self):
         if isinstance(self._task, Backup):
@@ -799,6 +1102,8 @@ class TaskWorker(object):
     ###########################################################################
     def run(self):
         task = self._task
+        # account transfers of this process to the task
+        set_consumer(task.id)
 
         try:
             # increase # of tries
@@ -919,6 +1224,11 @@ class TaskCleanWorker(TaskWorker):
     def __init__(self, task, env_vars=None):
         TaskWorker.__init__(self, task, env_vars=env_vars)
 
+    ###########################################################################
+    @property
+    def is_cleaner(self):
+        return True
+
     ###########################################################################
     def get_cmd(self):
         return "clean-%s" % self._task.type_name.lower()
@@ -934,6 +1244,312 @@ class TaskCleanWorker(TaskWorker):
     def cleaner_finished(self):
         self.worker_finished(State.CANCELED)
 
+###############################################################################
+# PooledTaskWorker
+###############################################################################
+
+class PooledTaskWorker(TaskWorker):
+    """
+        Runs a task (or its cleanup) in a warm process of a WorkerProcessPool.
+        Behaves like a TaskWorker: pid is the pid of the process running the
+        task (so killing it cancels the task) and a non-zero exit code means
+        that the worker crashed
+    """
+    ###########################################################################
+    def __init__(self, task, pool, cleaner=False, env_vars=None):
+        TaskWorker.__init__(self, task, env_vars=env_vars)
+        self._env_vars = env_vars
+        self._pool = pool
+        self._cleaner = cleaner
+        self._process = None
+        self._exit_code = None
+        self._result_reader = None
+
+    ###########################################################################
+    @property
+    def pid(self):
+        if self._process:
+            return self._process.pid
+
+    ###########################################################################
+    @property
+    def is_cleaner(self):
+        return self._cleaner
+
+    ###########################################################################
+    def start(self):
+        log_file_path = self.get_log_path()
+        ensure_dir(os.path.dirname(log_file_path))
+
+        request = {
+            "taskType": self._task.type_name,
+            "taskId": str(self._task.id),
+            "clean": self._cleaner,
+            "logPath": log_file_path,
+            "envVars": self._env_vars
+        }
+        self._process = self._pool.run_task(request)
+        # pooled processes run many tasks so include the task id
+        self._id = "%s-%s" % (self._process.pid, self._task.id)
+
+        self._result_reader = Thread(target=self._read_result)
+        self._result_reader.daemon = True
+        self._result_reader.start()
+
+    ###########################################################################
+    def _read_result(self):
+        result = self._process.read_result()
+        if result is None:
+            # process died while running the task (crashed or was killed)
+            exit_code = self._process.wait() or 1
+            self._pool.release(self._process, recycle=True)
+        else:
+            exit_code = result["exitCode"]
+            self._pool.release(self._process, recycle=result.get("recycle"))
+
+        self._exit_code = exit_code
+
+    ###########################################################################
+    def join(self):
+        self._result_reader.join()
+
+    ###########################################################################
+    @property
+    def exit_code(self):
+        return self._exit_code
+
+###############################################################################
+# WorkerProcessPool
+###############################################################################
+
+class WorkerProcessPool(object):
+    """
+        A pool of warm 'mbs run-task-worker' processes. Processes are started
+        up front (imports, config, type bindings all loaded) and run one task
+        at a time. A process that exits (recycled, crashed or killed) is
+        replaced with a new one
+    """
+    ###########################################################################
+    def __init__(self, size, max_tasks_per_worker):
+        self._size = size
+        self._max_tasks_per_worker = max_tasks_per_worker
+        self._idle = []
+        self._lock = Lock()
+        self._stopped = False
+
+    ###########################################################################
+    def start(self):
+        with self._lock:
+            for i in range(self._size):
+                self._idle.append(self._spawn())
+
+    ###########################################################################
+    def run_task(self, request):
+        """
+            Sends the task request to an idle process and returns the process
+        """
+        for attempt in range(WORKER_POOL_START_ATTEMPTS):
+            process = self._acquire()
+            try:
+                process.send_request(request)
+                return process
+            except IOError, e:
+                logger.warning("Failed to send task to pooled worker process"
+                               " %s: %s" % (process.pid, e))
+                process.close()
+
+        raise BackupEngineError("Failed to start %s %s on a pooled worker "
+                                "process" % (request["taskType"],
+                                             request["taskId"]))
+
+    ###########################################################################
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                process = self._idle.pop()
+                if process.is_alive():
+                    return process
+                process.close()
+
+            # all processes are busy or died while idle. start a cold one
+            return self._spawn()
+
+    ###########################################################################
+    def release(self, process, recycle=False):
+        with self._lock:
+            if recycle or not process.is_alive():
+                process.close()
+                process = None
+
+            if self._stopped or len(self._idle) >= self._size:
+                if process:
+                    process.close()
+                return
+
+            # replace recycled/dead processes to keep the pool warm
+            self._idle.append(process or self._spawn())
+
+    ###########################################################################
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            for process in self._idle:
+                process.close()
+            self._idle = []
+
+    ###########################################################################
+    def _spawn(self):
+        process = WorkerProcess(self._max_tasks_per_worker)
+        logger.info("Started pooled worker process %s" % process.pid)
+        return process
+
+###############################################################################
+# WorkerProcess
+###############################################################################
+
+class WorkerProcess(object):
+    """
+        Engine side of a pooled worker process. Task requests are written to
+        its stdin and results are read from its stdout, one json per line
+    """
+    ###########################################################################
+    def __init__(self, max_tasks):
+        cmd = [
+            which("mbs"),
+            "--config-path",
+            mbs_config.MBS_CONF_PATH,
+            "run-task-worker",
+            str(max_tasks)
+        ]
+        # close_fds so that processes do not hold other processes' pipes
+        self._popen = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, close_fds=True)
+
+    ###########################################################################
+    @property
+    def pid(self):
+        return self._popen.pid
+
+    ###########################################################################
+    def is_alive(self):
+        return self._popen.poll() is None
+
+    ###########################################################################
+    def send_request(self, request):
+        self._popen.stdin.write(json.dumps(request) + "\n")
+        self._popen.stdin.flush()
+
+    ###########################################################################
+    def read_result(self):
+        """
+            Blocks until the running task finishes. Returns None if the
+            process exited without reporting a result
+        """
+        for line in iter(self._popen.stdout.readline, ""):
+            try:
+                return json.loads(line)
+            except ValueError:
+                # output written before the process redirected its stdout
+                logger.info("Pooled worker process %s: %s" %
+                            (self.pid, line.rstrip()))
+
+    ###########################################################################
+    def wait(self):
+        return self._popen.wait()
+
+    ###########################################################################
+    def close(self):
+        """
+            Closing stdin makes an idle process exit
+        """
+        try:
+            self._popen.stdin.close()
+        except IOError:
+            pass
+
+###############################################################################
+def serve_task_requests(max_tasks):
+    """
+        Main loop of pooled worker processes (mbs run-task-worker). Runs up to
+        max_tasks task requests read from stdin in this process then exits so
+        that the pool replaces it with a fresh process
+    """
+    # keep private copies of the request/result pipes. fds 0/1/2 are used
+    # by tasks and their child processes
+    requests_in = os.fdopen(_private_dup(sys.stdin.fileno()), "r")
+    results_out = os.fdopen(_private_dup(sys.stdout.fileno()), "w", 0)
+
+    pool_log_dir = resolve_path(mbs_config.MBS_LOG_PATH)
+    ensure_dir(pool_log_dir)
+    pool_log = open(os.path.join(pool_log_dir, "task-workers.log"), "a")
+    devnull = open(os.devnull, "r")
+    os.dup2(devnull.fileno(), 0)
+    _redirect_output(pool_log)
+
+    base_env = os.environ.copy()
+    for i in range(max_tasks):
+        line = requests_in.readline()
+        if not line:
+            break
+
+        request = json.loads(line)
+        exit_code = _run_task_request(request, base_env, pool_log)
+        results_out.write(json.dumps({
+            "taskId": request["taskId"],
+            "exitCode": exit_code,
+            "recycle": i == max_tasks - 1
+        }) + "\n")
+
+###############################################################################
+def _run_task_request(request, base_env, pool_log):
+    """
+        Runs the task like 'mbs run-backup' etc would. Returns the exit code
+        that command would have
+    """
+    task_log = open(request["logPath"], "a")
+    _redirect_output(task_log)
+    os.environ.clear()
+    os.environ.update(base_env)
+    if request.get("envVars"):
+        os.environ.update(request["envVars"])
+
+    try:
+        if request["taskType"] == Backup().type_name:
+            task = persistence.get_backup(request["taskId"])
+        else:
+            task = persistence.get_restore(request["taskId"])
+
+        if request.get("clean"):
+            TaskCleanWorker(task).run()
+        else:
+            TaskWorker(task).run()
+        return 0
+    except Exception, e:
+        logger.error("Error while running %s %s: %s\n%s" %
+                     (request["taskType"], request["taskId"], e,
+                      traceback.format_exc()))
+        return 1
+    finally:
+        _redirect_output(pool_log)
+        task_log.close()
+
+###############################################################################
+def _redirect_output(file_obj):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(file_obj.fileno(), 1)
+    os.dup2(file_obj.fileno(), 2)
+
+###############################################################################
+def _private_dup(fd):
+    """
+        Returns a copy of fd that is not inherited by child processes
+    """
+    new_fd = os.dup(fd)
+    flags = fcntl.fcntl(new_fd, fcntl.F_GETFD)
+    fcntl.fcntl(new_fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return new_fd
+
 ###############################################################################
 def task_log_path(task):
     log_dir = task_log_dir(task.type_name.lower())
@@ -1033,6 +1649,38 @@ class EngineCommandServer(Thread):
                     "error": msg
                 })
 
+        ## build acquire-bandwidth method (called by task workers)
+        @flask_server.route('/acquire-bandwidth', methods=['POST'])
+        def acquire_bandwidth():
+            wait = engine.bandwidth_manager.acquire(
+                request.form.get('consumerId'),
+                int(request.form.get('bytes')))
+            return json.dumps({
+                "wait": wait
+            })
+
+        ## build set-max-bandwidth method
+        @flask_server.route('/set-max-bandwidth', methods=['POST'])
+        def set_max_bandwidth():
+            max_mb_per_second = request.args.get('maxMBPerSecond')
+            logger.info("Command Server: Received a set-max-bandwidth command"
+                        " (maxMBPerSecond=%s)" % max_mb_per_second)
+            try:
+                engine.max_bandwidth_mb_per_second = max_mb_per_second
+                return document_pretty_string({
+                    "ok": 1,
+                    "maxMBPerSecond": engine.max_bandwidth_mb_per_second
+                })
+            except Exception, e:
+                msg = ("Error while trying to set max bandwidth to '%s': %s" %
+                       (max_mb_per_second, e))
+                logger.error(msg)
+                logger.error(traceback.format_exc())
+                return document_pretty_string({
+                    "ok": 0,
+                    "error": msg
+                })
+
         ## build stop-command-server method
         @flask_server.route('/stop-command-server', methods=['GET'])
         def stop_command_server():
@@ -621,6 +621,26 @@ class TargetDeleteError(TargetError, RetriableError):
 class TargetFileNotFoundError(TargetError):
     pass
 
+###############################################################################
+class ChunkLockedError(TargetError, RetriableError):
+    """
+        Raised when a deduplicated chunk can not be referenced because it is
+        being deleted
+    """
+
+###############################################################################
+class ChunkIntegrityError(TargetError, RetriableError):
+    """
+        Raised when a downloaded deduplicated chunk does not match its hash
+    """
+
+###############################################################################
+class UploadStreamAbortedError(TargetError):
+    """
+        Raised when the producer of a streamed upload fails before the stream
+        is complete
+    """
+
 
 ###############################################################################
 class RetentionPolicyError(MBSError):
@@ -860,6 +880,13 @@ class RestoreError(MBSError):
                    "%s" % (return_code, last_log_line))
         super(RestoreError, self).__init__(msg=msg, details=details)
 
+###############################################################################
+class IncrementalChainError(MBSError):
+    """
+        Raised when a backup needed to restore an incremental backup is
+        missing or not restorable
+    """
+
 ###############################################################################
 class ExtractError(MBSError):
     """
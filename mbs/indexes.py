@@ -10,6 +10,17 @@ MBS_INDEXES = {
         {
             "index": [('planOccurrence', ASCENDING), ('plan._id', ASCENDING)]
         },
+        {
+            # one backup per plan occurrence so that scheduling is idempotent.
+            # Duplicate occurrences left by older double scheduling fail the
+            # build (logged) until they are removed
+            "index": [('plan._id', ASCENDING), ('planOccurrence', ASCENDING)],
+            "args": {
+                "name": "plan_occurrence_unique",
+                "unique": True,
+                "partialFilterExpression": {"planOccurrence": {"$type": "date"}}
+            }
+        },
         {
             "index": [('state', ASCENDING), ('engineGuid', ASCENDING), ('plan.nextOccurrence', ASCENDING)]
         },
@@ -44,6 +55,19 @@ MBS_INDEXES = {
                 ('state', ASCENDING),
                 ('cancelRequestedAt', ASCENDING)
             ]
+        },
+
+        {
+            "index": [('baseBackupId', ASCENDING), ('state', ASCENDING)]
+        },
+
+        # task claims
+        {
+            "index": [
+                ('state', ASCENDING),
+                ('engineGuid', ASCENDING),
+                ('priorityDate', ASCENDING)
+            ]
         }
     ],
 
@@ -56,6 +80,15 @@ MBS_INDEXES = {
     "restores": [
         {
             "index": [('state', ASCENDING), ('engineGuid', ASCENDING)]
+        },
+
+        # task claims
+        {
+            "index": [
+                ('state', ASCENDING),
+                ('engineGuid', ASCENDING),
+                ('priorityDate', ASCENDING)
+            ]
         }
     ],
 
@@ -8,8 +8,10 @@ import logging
 
 import threading
 
+from pymongo.errors import CollectionInvalid
 from collection import MBSObjectCollection, MBSTaskCollection
-from makerpy.maker import resolve_class, Maker
+from makerpy.maker import resolve_class
+from object_maker import ObjectMaker
 
 from type_bindings import TYPE_BINDINGS
 from indexes import MBS_INDEXES
@@ -38,6 +40,8 @@ DEFAULT_BACKUP_TEMP_DIR_ROOT = "~/backup_temp"
 DEFAULT_TEMPLATE_DIR_ROOT = \
     os.path.join(os.path.dirname(__file__), "notification", "templates")
 
+DEFAULT_TASK_EVENTS_SIZE_MB = 1024
+
 ###############################################################################
 # MBS
 ###############################################################################
@@ -53,7 +57,7 @@ class MBS(object):
         self._type_bindings = self._get_type_bindings()
 
         # make the maker
-        self._maker =  Maker(type_bindings=self._type_bindings)
+        self._maker = ObjectMaker(type_bindings=self._type_bindings)
 
         #  notifications
         self._notifications = None
@@ -64,6 +68,7 @@ class MBS(object):
         self._deleted_plan_collection = None
         self._audit_collection = None
         self._restore_collection = None
+        self._task_events_collection = None
 
         # load backup system/engines lazily
         self._backup_system = None
@@ -125,7 +130,13 @@ class MBS(object):
                                  (c_index, coll_name))
                     kwargs = c_index.get("args") or {}
                     kwargs["background"] = True
-                    coll.ensure_index(c_index["index"], **kwargs)
+                    try:
+                        coll.ensure_index(c_index["index"], **kwargs)
+                    except Exception, e:
+                        # e.g. existing duplicates fail unique indexes. Other
+                        # indexes are still ensured
+                        logger.error("Failed to ensure index %s on collection"
+                                     " '%s': %s" % (c_index, coll_name, e))
 
         threading.Thread(target=do_ensure_indexes).start()
 
@@ -164,7 +175,9 @@ class MBS(object):
         if not self._backup_collection:
             bc = MBSTaskCollection(self.database["backups"],
                                    clazz=Backup,
-                                   type_bindings=self._type_bindings)
+                                   type_bindings=self._type_bindings,
+                                   max_log_entries=self._get_config_value(
+                                       "maxTaskLogEntries"))
             self._backup_collection = bc
 
         return self._backup_collection
@@ -175,7 +188,9 @@ class MBS(object):
         if not self._restore_collection:
             rc = MBSTaskCollection(self.database["restores"],
                                    clazz=Restore,
-                                   type_bindings=self._type_bindings)
+                                   type_bindings=self._type_bindings,
+                                   max_log_entries=self._get_config_value(
+                                       "maxTaskLogEntries"))
             self._restore_collection = rc
 
         return self._restore_collection
@@ -222,6 +237,38 @@ class MBS(object):
 
         return self._audit_collection
 
+    ###########################################################################
+    @property
+    def chunk_reference_collection(self):
+        """
+            Reference counts of chunks stored by deduplicating targets
+        """
+        return self.database["chunk-references"]
+
+    ###########################################################################
+    @property
+    def task_events_collection(self):
+        """
+            Capped collection of task log entries archived out of task
+            documents (see maxTaskLogEntries)
+        """
+        if not self._task_events_collection:
+            db = self.database
+            if "task-events" not in db.collection_names():
+                size_mb = (self._get_config_value("taskEventsSizeMB") or
+                           DEFAULT_TASK_EVENTS_SIZE_MB)
+                try:
+                    db.create_collection("task-events", capped=True,
+                                         size=size_mb * 1024 * 1024)
+                except CollectionInvalid:
+                    # created by another process in the meantime
+                    pass
+            task_events = db["task-events"]
+            task_events.create_index([("taskId", 1), ("date", 1)])
+            self._task_events_collection = task_events
+
+        return self._task_events_collection
+
     ###########################################################################
     @property
     def engines(self):
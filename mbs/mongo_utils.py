@@ -3,11 +3,12 @@ __author__ = 'abdul'
 # Contains mongo db utility functions
 
 import time
+import Queue
 
 import pymongo
 import pymongo.errors
 from pymongo.mongo_client import MongoClient
-from threading import Thread
+from threading import Thread, Lock
 
 from mongo_uri_tools import parse_mongo_uri
 from bson.son import SON
@@ -36,6 +37,17 @@ CONN_TIMEOUT = 20
 # db socket timeout, 20 minutes
 SOCKET_TIMEOUT = 20 * 60
 
+# max concurrent dbstats/collstats commands run against a source
+DEFAULT_STATS_CONCURRENCY = 4
+
+# seconds a replica set topology (member isMaster results, rs status and
+# config) is reused by connectors of the same cluster uri
+TOPOLOGY_CACHE_TTL = 30
+
+# cluster uri => topology
+_topology_cache = {}
+_topology_cache_lock = Lock()
+
 ###############################################################################
 @robustify(max_attempts=3, retry_interval=3,
            do_on_exception=raise_if_not_retriable,
@@ -92,6 +104,7 @@ class MongoConnector(object):
         self._conn_timeout = conn_timeout or CONN_TIMEOUT
         self._connection_id = None
         self._display_name = display_name
+        self._stats_concurrency = DEFAULT_STATS_CONCURRENCY
 
     ###########################################################################
     @property
@@ -108,6 +121,19 @@ class MongoConnector(object):
     def display_name(self):
         return self._display_name
 
+    ###########################################################################
+    @property
+    def stats_concurrency(self):
+        """
+            Max concurrent dbstats/collstats commands of get_stats() and
+            get_collection_counts()
+        """
+        return self._stats_concurrency
+
+    @stats_concurrency.setter
+    def stats_concurrency(self, val):
+        self._stats_concurrency = val
+
     ###########################################################################
     @property
     def mongo_client(self):
@@ -293,6 +319,9 @@ class MongoConnector(object):
                do_on_exception=raise_if_not_retriable,
                do_on_failure=raise_exception)
     def _is_master_command(self):
+        probe = self._get_topology_probe()
+        if probe:
+            return probe["isMaster"]
         try:
             return (self.is_online() and
                     self.admin_db.command({"isMaster": 1}))
@@ -368,7 +397,8 @@ class MongoDatabase(MongoConnector):
         try:
 
             return {
-                self.database.name: _database_collection_counts(self.database)
+                self.database.name: _database_collection_counts(
+                    self.database, concurrency=self.stats_concurrency)
             }
 
         except Exception, e:
@@ -434,6 +464,8 @@ class MongoCluster(MongoConnector):
                                      conn_timeout=self.conn_timeout)
                 self._members.append(member)
 
+        self._apply_topology(self._get_topology())
+
         # find primary
         for member in self._members:
             if member.is_online() and member.is_primary():
@@ -444,6 +476,61 @@ class MongoCluster(MongoConnector):
 
         self._primary_member = primary_member
 
+    ###########################################################################
+    def _get_topology(self):
+        with _topology_cache_lock:
+            topology = _topology_cache.get(self.uri)
+        if topology and time.time() < topology["expiry"]:
+            return topology
+
+        topology = self._fetch_topology()
+        if topology:
+            with _topology_cache_lock:
+                _topology_cache[self.uri] = topology
+        return topology
+
+    ###########################################################################
+    def _fetch_topology(self):
+        """
+            Probes all members in parallel then reads the rs status and
+            config once from the primary. None if there is no primary
+        """
+        probes = parallel_map(_probe_member, self._members,
+                              concurrency=len(self._members))
+
+        primary_member = None
+        for member, probe in zip(self._members, probes):
+            if probe["isMaster"] and probe["isMaster"].get("ismaster"):
+                primary_member = member
+
+        if not primary_member:
+            return None
+
+        return {
+            "expiry": time.time() + TOPOLOGY_CACHE_TTL,
+            "members": dict((member.uri, probe)
+                            for member, probe in zip(self._members, probes)),
+            "rsStatus": primary_member.get_rs_status(),
+            "rsConf": primary_member.rs_conf
+        }
+
+    ###########################################################################
+    def _apply_topology(self, topology):
+        if not topology:
+            return
+        for member in self._members:
+            probe = topology["members"].get(member.uri)
+            if probe:
+                member.apply_topology(probe, topology["rsStatus"],
+                                      topology["rsConf"], topology["expiry"])
+
+    ###########################################################################
+    def invalidate_topology(self):
+        """
+            Makes the next connector of this cluster probe members again
+        """
+        invalidate_topology_cache(self.uri)
+
     ###########################################################################
     def get_mongolab_backup_node(self):
         logger.info("Attempting to determine mongolab backup node for %s" % self.connector_id)
@@ -499,6 +586,13 @@ class MongoServer(MongoConnector):
         self._lag_in_seconds = 0
         self._allow_local_connections = allow_local_connections
 
+        # state of the member in a cached cluster topology. Used instead of
+        # running isMaster until it expires
+        self._topology_probe = None
+        self._topology_expiry = None
+        self._topology_rs_conf = None
+        self._topology_member_rs_status = None
+
     ###########################################################################
     @property
     def connection_address(self):
@@ -523,6 +617,39 @@ class MongoServer(MongoConnector):
             self._mongo_client = mongo_connect(self.uri, **kwargs)
         return self._mongo_client
 
+    ###########################################################################
+    def apply_topology(self, probe, rs_status, rs_conf, expiry):
+        """
+            Uses the member state of a cluster topology until it expires. rs
+            status and config are the ones read from the primary
+        """
+        self._topology_probe = probe
+        self._topology_expiry = expiry
+        self._topology_rs_conf = rs_conf
+        self._topology_member_rs_status = None
+
+        me = probe["isMaster"] and probe["isMaster"].get("me")
+        if me and rs_status:
+            for member_status in rs_status.get("members", []):
+                if member_status.get("name") == me:
+                    self._topology_member_rs_status = member_status
+
+    ###########################################################################
+    def _is_topology_expired(self):
+        return not self._topology_expiry or time.time() >= self._topology_expiry
+
+    ###########################################################################
+    def _get_topology_probe(self):
+        if self._topology_probe and not self._is_topology_expired():
+            return self._topology_probe
+
+    ###########################################################################
+    def is_online(self):
+        probe = self._get_topology_probe()
+        if probe:
+            return probe["online"]
+        return MongoConnector.is_online(self)
+
     ###########################################################################
     @property
     def lag_in_seconds(self):
@@ -537,6 +664,17 @@ class MongoServer(MongoConnector):
     ###########################################################################
     @property
     def member_rs_status(self):
+        if (self._topology_member_rs_status and
+                not self._is_topology_expired()):
+            return self._topology_member_rs_status
+
+        return self._self_rs_status()
+
+    ###########################################################################
+    def _self_rs_status(self):
+        """
+            The status of this member as reported by itself
+        """
         if not self._member_rs_status and self.is_replica_member():
             self._member_rs_status = self._get_member_rs_status()
 
@@ -545,6 +683,9 @@ class MongoServer(MongoConnector):
     ###########################################################################
     @property
     def rs_conf(self):
+        if self._topology_rs_conf and not self._is_topology_expired():
+            return self._topology_rs_conf
+
         if not self.is_arbiter() and not self._rs_conf:
             self._rs_conf = self._get_rs_config()
 
@@ -585,11 +726,13 @@ class MongoServer(MongoConnector):
     ###########################################################################
     def is_too_stale(self):
         """
-            Returns true if the member is too stale
+            Returns true if the member is too stale. Only the member reports
+            its own RS102 errmsg so the topology status is not used
         """
-        return (self.member_rs_status and
-                "errmsg" in self.member_rs_status and
-                "RS102" in self.member_rs_status["errmsg"])
+        my_status = self._self_rs_status()
+        return (my_status and
+                "errmsg" in my_status and
+                "RS102" in my_status["errmsg"])
 
     ###########################################################################
     @robustify(max_attempts=3, retry_interval=3,
@@ -603,7 +746,8 @@ class MongoServer(MongoConnector):
             if only_for_db:
                 db_stats = _calculate_database_stats(client[only_for_db])
             else:
-                db_stats = _calculate_client_databases_stats(client)
+                db_stats = _calculate_client_databases_stats(
+                    client, concurrency=self.stats_concurrency)
 
 
             stats =  {
@@ -635,12 +779,14 @@ class MongoServer(MongoConnector):
         try:
             if only_for_db:
                 db = self.mongo_client[only_for_db]
-                db_col_count = _database_collection_counts(db)
+                db_col_count = _database_collection_counts(
+                    db, concurrency=self.stats_concurrency)
                 return {
                     db.name: db_col_count
                 }
             else:
-                return _client_collection_counts(self.mongo_client)
+                return _client_collection_counts(
+                    self.mongo_client, concurrency=self.stats_concurrency)
         except Exception, e:
             if is_connection_exception(e):
                 details = ("Error while trying to compute collection counts for server "
@@ -834,6 +980,31 @@ class MongoServer(MongoConnector):
     def is_config_server(self):
         return "configsvr" in self.get_cmd_line_opts()
 
+    ###########################################################################
+    def get_oplog_first_ts(self):
+        return self._get_oplog_edge_ts(1)
+
+    ###########################################################################
+    def get_oplog_last_ts(self):
+        return self._get_oplog_edge_ts(-1)
+
+    ###########################################################################
+    def _get_oplog_edge_ts(self, direction):
+        oplog = self.mongo_client.local["oplog.rs"]
+        entry = next(iter(oplog.find({}, {"ts": 1}).sort("$natural", direction).limit(1)), None)
+        return entry and entry["ts"]
+
+    ###########################################################################
+    def get_num_cores(self):
+        """
+            Returns the number of cores of the server host, None if unknown
+        """
+        try:
+            return self.admin_db.command({"hostInfo": 1})["system"]["numCores"]
+        except Exception, e:
+            logger.warning("Unable to determine number of cores for '%s': %s"
+                           % (self, e))
+
     ###########################################################################
     def whatsmyuri(self):
         return self.admin_db.command({"whatsmyuri": 1})
@@ -1135,10 +1306,11 @@ def _calculate_database_stats(db):
 @robustify(max_attempts=3, retry_interval=3,
            do_on_exception=raise_if_not_retriable,
            do_on_failure=raise_exception)
-def _calculate_client_databases_stats(mongo_client):
+def _calculate_client_databases_stats(mongo_client, concurrency=None):
     """
 
     :param mongo_client:
+    :param concurrency: max concurrent dbstats commands
     :return: dict with following structure
         { [sum of all database stats except for local],
           "databaseStats": {dbname : stats} , except local
@@ -1160,14 +1332,15 @@ def _calculate_client_databases_stats(mongo_client):
         "nsSizeMB": 0
     }
 
-    database_names = mongo_client.database_names()
+    database_names = [dbname for dbname in mongo_client.database_names()
+                      if not dbname.startswith("$")]
 
-    for dbname in database_names:
-        if dbname.startswith("$"):
-            continue
+    # each dbstats is retried on its own
+    databases_stats = parallel_map(
+        lambda dbname: _calculate_database_stats(mongo_client[dbname]),
+        database_names, concurrency=concurrency)
 
-        db = mongo_client[dbname]
-        db_stats = _calculate_database_stats(db)
+    for dbname, db_stats in zip(database_names, databases_stats):
         # capture local database stats
         if dbname == "local":
             local_db_stats = db_stats
@@ -1185,31 +1358,31 @@ def _calculate_client_databases_stats(mongo_client):
 @robustify(max_attempts=3, retry_interval=3,
            do_on_exception=raise_if_not_retriable,
            do_on_failure=raise_exception)
-def _database_collection_counts(db):
-    result = []
-    for cname in db.collection_names():
-        # skip system collections
-        if cname.startswith("system."):
-            continue
-
-        collstats = db.command("collstats", cname)
-        result.append({
-            "name": cname,
-            "count": collstats["count"]
-        })
+def _database_collection_counts(db, concurrency=None):
+    # skip system collections
+    collection_names = [cname for cname in db.collection_names()
+                        if not cname.startswith("system.")]
 
-    return result
+    counts = parallel_map(lambda cname: _collection_count(db, cname),
+                          collection_names, concurrency=concurrency)
 
+    return [{"name": cname, "count": count}
+            for cname, count in zip(collection_names, counts)]
 
+###############################################################################
+def _collection_count(db, cname):
+    # not retried on its own, callers retry the whole count
+    return db.command("collstats", cname)["count"]
 
 ###############################################################################
 @robustify(max_attempts=3, retry_interval=3,
            do_on_exception=raise_if_not_retriable,
            do_on_failure=raise_exception)
-def _client_collection_counts(mongo_client):
+def _client_collection_counts(mongo_client, concurrency=None):
     """
 
     :param mongo_client:
+    :param concurrency: max concurrent collstats commands
     :return: dict with all dbs collection counts
 
     """
@@ -1219,13 +1392,84 @@ def _client_collection_counts(mongo_client):
 
     database_names = mongo_client.database_names()
 
+    # collections of all databases share the pool so that databases with
+    # few collections do not leave it idle
+    db_collections = []
     for dbname in database_names:
         db = mongo_client[dbname]
-        db_collection_counts = _database_collection_counts(db)
-        collection_counts[dbname] = db_collection_counts
+        collection_counts[dbname] = []
+        db_collections.extend((db, cname) for cname in db.collection_names()
+                              if not cname.startswith("system."))
+
+    counts = parallel_map(lambda db_cname: _collection_count(*db_cname),
+                          db_collections, concurrency=concurrency)
+
+    for (db, cname), count in zip(db_collections, counts):
+        collection_counts[db.name].append({
+            "name": cname,
+            "count": count
+        })
 
     return collection_counts
 
+###############################################################################
+def _probe_member(member):
+    online = bool(member.is_online())
+    return {
+        "online": online,
+        "isMaster": online and member._is_master_command() or None
+    }
+
+###############################################################################
+def invalidate_topology_cache(uri=None):
+    """
+        Drops the cached topology of the cluster uri (all if not specified)
+    """
+    with _topology_cache_lock:
+        if uri:
+            _topology_cache.pop(uri, None)
+        else:
+            _topology_cache.clear()
+
+###############################################################################
+def parallel_map(func, items, concurrency=None):
+    """
+        Returns [func(item) for item in items] computed by at most
+        concurrency threads. Raises the first error once all threads stopped
+    """
+    items = list(items)
+    concurrency = max(1, concurrency or DEFAULT_STATS_CONCURRENCY)
+    if len(items) <= 1 or concurrency == 1:
+        return map(func, items)
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for item in enumerate(items):
+        queue.put(item)
+
+    def work():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception, e:
+                errors.append(e)
+
+    workers = [Thread(target=work) for i in range(min(concurrency, len(items)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
 
 ###############################################################################
 def build_mongo_connector(uri):
@@ -60,7 +60,11 @@ class BackupMonitor(ScheduleRunner):
 
         past_due_backup_infos = []
 
-        for backup in get_mbs().backup_collection.find_iter(q, no_cursor_timeout=True):
+        # only load what is_backup_past_due() needs. source is made only for
+        # past due backups
+        projection = ["state", "plan.schedule", "source", "logs"]
+        for backup in get_mbs().backup_collection.find_iter(q, projection=projection, lazy=True,
+                                                            no_cursor_timeout=True):
             if self.is_backup_past_due(backup):
                 past_due_backup_infos.append("%s (%s)" % (str(backup.id), backup.source.get_source_info()))
 
@@ -0,0 +1,128 @@
+__author__ = 'abdul'
+
+import datetime
+
+from threading import Lock
+
+from bson.objectid import ObjectId
+
+from makerpy.maker import Maker, resolve_class
+
+from base import MBSObject
+from utils import document_key_attribute_name
+
+###############################################################################
+# CONSTANTS
+###############################################################################
+# values that are set as is
+PLAIN_TYPES = (basestring, bool, int, long, float, type(None),
+               datetime.datetime, ObjectId)
+
+###############################################################################
+# ObjectMaker
+###############################################################################
+class ObjectMaker(Maker):
+    """
+        Maker that compiles, once per _type, the class and the property
+        setters of the documents it makes instead of resolving them for every
+        nested document. Only MBSObject types are compiled. Documents with
+        keys that are not backed by a property are made by Maker as before.
+        invalidate() must be called when type bindings or classes change
+    """
+    ###########################################################################
+    def __init__(self, type_bindings=None):
+        Maker.__init__(self, type_bindings=type_bindings)
+        self._type_bindings = type_bindings or {}
+        self._compiled_types = {}
+        self._lock = Lock()
+
+    ###########################################################################
+    def make(self, o):
+        if isinstance(o, dict) and "_type" in o:
+            compiled_type = self._get_compiled_type(o["_type"])
+            if compiled_type:
+                obj = compiled_type.make(o, self)
+                if obj is not None:
+                    return obj
+        elif isinstance(o, list):
+            return [self.make(v) for v in o]
+
+        return Maker.make(self, o)
+
+    ###########################################################################
+    def _get_compiled_type(self, type_name):
+        try:
+            return self._compiled_types[type_name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            compiled_type = self._compile_type(type_name)
+            self._compiled_types[type_name] = compiled_type
+            return compiled_type
+
+    ###########################################################################
+    def _compile_type(self, type_name):
+        try:
+            clazz = resolve_class(self._type_bindings.get(type_name,
+                                                          type_name))
+        except Exception:
+            # let Maker report it
+            return None
+
+        if isinstance(clazz, type) and issubclass(clazz, MBSObject):
+            return CompiledType(clazz)
+
+    ###########################################################################
+    def invalidate(self, type_name=None):
+        """
+            Drops the compiled type of type_name (all if not specified)
+        """
+        with self._lock:
+            if type_name:
+                self._compiled_types.pop(type_name, None)
+            else:
+                self._compiled_types = {}
+
+###############################################################################
+# CompiledType
+###############################################################################
+class CompiledType(object):
+    """
+        Class and document key => property setter of a _type
+    """
+    ###########################################################################
+    def __init__(self, clazz):
+        self.clazz = clazz
+        self._setters = {}
+
+    ###########################################################################
+    def get_setter(self, key):
+        try:
+            return self._setters[key]
+        except KeyError:
+            pass
+
+        attr = "id" if key == "_id" else document_key_attribute_name(key)
+        prop = getattr(self.clazz, attr, None)
+        setter = prop.fset if isinstance(prop, property) else None
+        self._setters[key] = setter
+        return setter
+
+    ###########################################################################
+    def make(self, doc, maker):
+        """
+            Returns None if doc has keys that are not compiled
+        """
+        obj = self.clazz()
+        for key, value in doc.iteritems():
+            if key == "_type":
+                continue
+            setter = self.get_setter(key)
+            if setter is None:
+                return None
+            if not isinstance(value, PLAIN_TYPES):
+                value = maker.make(value)
+            setter(obj, value)
+
+        return obj
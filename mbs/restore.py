@@ -17,6 +17,7 @@ class Restore(MBSTask):
 
         self._data_stats = {}
         self._valid = None
+        self._point_in_time = None
 
     ###########################################################################
     def execute(self):
@@ -86,6 +87,25 @@ class Restore(MBSTask):
     def valid(self, valid):
         self._valid = valid
 
+    ###########################################################################
+    @property
+    def point_in_time(self):
+        """
+            For restores of incremental backups, oplog entries after this
+            date are not replayed
+        """
+        return self._point_in_time
+
+    @point_in_time.setter
+    def point_in_time(self, val):
+        self._point_in_time = val
+
+    ###########################################################################
+    def export_property(self, prop):
+        if prop == "sourceBackup":
+            return DBRef("backups", self.source_backup.id)
+        return MBSTask.export_property(self, prop)
+
     ###########################################################################
     def to_document(self, display_only=False):
         doc = MBSTask.to_document(self, display_only=display_only)
@@ -98,4 +118,7 @@ class Restore(MBSTask):
             "valid": self.valid
         })
 
+        if self.point_in_time:
+            doc["pointInTime"] = self.point_in_time
+
         return doc
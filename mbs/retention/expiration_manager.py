@@ -1,8 +1,13 @@
 __author__ = 'abdul'
 
+import time
 import traceback
 import Queue
 
+from itertools import groupby
+
+from bson.son import SON
+
 from mbs import mbs_logging
 from mbs import persistence
 
@@ -40,6 +45,20 @@ DEFAULT_EXP_SCHEDULE = Schedule(frequency_in_seconds=(5 * 60 * 60))
 
 DEFAULT_EXP_CANCELED_DELAY = 5 * 60 * 60 * 24
 
+# plans are fetched and their expirations are written in batches of this size
+RETENTION_PLAN_BATCH_SIZE = 200
+
+# backup fields loaded to evaluate retention of recurring backups. Backups
+# passed to find_plan_expirable_backups() only have these unless
+# get_retention_backup_fields() is overridden
+RETENTION_BACKUP_FIELDS = ["state", "createdDate", "planOccurrence",
+                           "previousBackupId", "plan._id", "targetReference",
+                           "startDate", "endDate", "expiredDate", "dontExpire"]
+
+# plan not read by the caller of is_plan_backups_expirable()
+_NOT_FETCHED = object()
+
+
 class BackupExpirationManager(ScheduleRunner):
     """
         A Thread that periodically expire backups that are due for expiration
@@ -54,6 +73,7 @@ class BackupExpirationManager(ScheduleRunner):
             self, self._retention_request_queue)
 
         self._expire_canceled_delay_in_seconds = DEFAULT_EXP_CANCELED_DELAY
+        self._recurring_cycle_stats = None
 
     ###########################################################################
     def start(self):
@@ -89,6 +109,15 @@ class BackupExpirationManager(ScheduleRunner):
     def expire_canceled_delay_in_seconds(self, val):
         self._expire_canceled_delay_in_seconds = val
 
+    ###########################################################################
+    @property
+    def recurring_cycle_stats(self):
+        """
+            Duration, totals and backups examined per second of the last
+            recurring backups expiration cycle
+        """
+        return self._recurring_cycle_stats
+
     ###########################################################################
     def tick(self):
         try:
@@ -142,7 +171,9 @@ class BackupExpirationManager(ScheduleRunner):
     ###########################################################################
     def _expire_due_recurring_backups(self):
 
+        start = time.time()
         total_processed = 0
+        total_plans = 0
         total_expired = 0
         total_dont_expire = 0
 
@@ -154,55 +185,129 @@ class BackupExpirationManager(ScheduleRunner):
             "$exists": True
         }
 
-        s = [("plan._id", -1)]
+        pipeline = self._plan_backups_pipeline(q)
+        logger.info("BackupExpirationManager: Executing aggregation :\n%s" %
+                    document_pretty_string(pipeline))
 
-        logger.info("BackupExpirationManager: Executing query :\n%s" %
-                    document_pretty_string(q))
+        plan_backup_docs = get_mbs().backup_collection.collection.aggregate(
+            pipeline, allowDiskUse=True)
+        plan_groups = _group_plan_backups(plan_backup_docs)
 
-        backups_iter = get_mbs().backup_collection.find_iter(query=q, sort=s, no_cursor_timeout=True)
+        batch = []
+        for plan_group in plan_groups:
+            if self.stop_requested:
+                break
+            batch.append(plan_group)
+            if len(batch) == RETENTION_PLAN_BATCH_SIZE:
+                batch_expired, batch_dont_expire, batch_processed = \
+                    self._process_plan_batch(batch)
+                total_expired += batch_expired
+                total_dont_expire += batch_dont_expire
+                total_processed += batch_processed
+                total_plans += len(batch)
+                batch = []
+
+        if batch and not self.stop_requested:
+            batch_expired, batch_dont_expire, batch_processed = \
+                self._process_plan_batch(batch)
+            total_expired += batch_expired
+            total_dont_expire += batch_dont_expire
+            total_processed += batch_processed
+            total_plans += len(batch)
+
+        duration = time.time() - start
+        self._recurring_cycle_stats = {
+            "endDate": date_now(),
+            "durationInSeconds": round(duration, 2),
+            "totalPlans": total_plans,
+            "totalProcessed": total_processed,
+            "totalExpired": total_expired,
+            "totalDontExpire": total_dont_expire,
+            "backupsExaminedPerSecond": round(total_processed / max(duration, 0.001), 2)
+        }
 
-        current_backup = next(backups_iter, None)
+        logger.info("BackupExpirationManager: Finished processing Recurring "
+                    "Backups.\nTotal Expired=%s, Total Don't Expire=%s, "
+                    "Total Processed=%s, Total Plans=%s, Duration=%.1f s "
+                    "(%s backups/s)" %
+                    (total_expired, total_dont_expire, total_processed,
+                     total_plans, duration,
+                     self._recurring_cycle_stats["backupsExaminedPerSecond"]))
 
-        plan = current_backup.plan if current_backup else None
-        plan_backups = []
+    ###########################################################################
+    def _plan_backups_pipeline(self, q):
+        """
+            Sorts the backups matching q by plan, most recent first, with
+            only the retention backup fields. Backups are grouped by plan
+            while reading the results since a plan can have more backups than
+            fit in one (16MB) $group document
+        """
+        projection = dict((field, 1) for field in
+                          self.get_retention_backup_fields())
+        # types of the backup and its plan so that they are made as objects
+        projection["_type"] = 1
+        projection["plan._type"] = 1
+        return [
+            {"$match": q},
+            # grouping by plan relies on plan._id being the first sort key
+            {"$sort": SON([("plan._id", 1), ("planOccurrence", -1),
+                           ("createdDate", -1)])},
+            {"$project": projection}
+        ]
 
-        # process all plan backups
-        while current_backup and not self.stop_requested:
-            total_processed += 1
+    ###########################################################################
+    def _process_plan_batch(self, plan_groups):
+        """
+            Evaluates the retention of a batch of plans (fetched with one
+            query) and writes their expirations with one bulk write. Returns
+            total expired, total dont expire and total processed
+        """
+        bc = get_mbs().backup_collection
+        fields = self.get_retention_backup_fields()
+        plan_ids = [plan_group["_id"] for plan_group in plan_groups]
+        plans = dict((plan.id, plan) for plan in
+                     get_mbs().plan_collection.find({"_id": {"$in": plan_ids}}))
 
-            if current_backup.plan.id == plan.id:
-                plan_backups.append(current_backup)
+        total_expired = 0
+        total_dont_expire = 0
+        total_processed = 0
+        batch_dues = []
+        batch_dont_expire = []
+        for plan_group in plan_groups:
+            plan_backups = [bc.make_object(doc, projection=fields)
+                            for doc in plan_group["backups"]]
+            total_processed += len(plan_backups)
 
-            current_backup = next(backups_iter, None)
-            # process the current plan
-            if not current_backup or current_backup.plan.id != plan.id:
-                plan_total_expired, plan_total_dont_expire = \
-                    self._process_plan(plan, plan_backups)
-                total_expired += plan_total_expired
-                total_dont_expire = plan_total_dont_expire
+            latest_plan = plans.get(plan_group["_id"])
+            plan = latest_plan
+            if plan is None:
+                # removed plans are still reported as they were last backed up
+                plan = bc.find_one({"plan._id": plan_group["_id"]}, projection=["plan"]).plan
 
-                plan = current_backup.plan if current_backup else None
-                plan_backups = []
+            dues, dont_expire = self._evaluate_plan(plan, plan_backups, latest_plan=latest_plan)
+            batch_dues.extend(dues)
+            batch_dont_expire.extend(dont_expire)
 
-        logger.info("BackupExpirationManager: Finished processing Recurring "
-                    "Backups.\nTotal Expired=%s, Total Don't Expire=%s, "
-                    "Total Processed=%s" %
-                    (total_expired, total_dont_expire, total_processed))
+        total_dont_expire += self.mark_backups_never_expire(batch_dont_expire)
+        total_expired += self.expire_backups(batch_dues)
+
+        return total_expired, total_dont_expire, total_processed
 
     ###########################################################################
-    def _process_plan(self, plan, plan_backups):
-        total_dont_expire = 0
-        total_expired = 0
+    def _evaluate_plan(self, plan, plan_backups, latest_plan=_NOT_FETCHED):
+        """
+            Returns the plan backups to expire (validated) and to mark as
+            dontExpire. Errors are reported and nothing is done for the plan
+        """
         logger.info("==== Processing plan '%s' .... " % plan.id)
-        # Ensure we have the latest revision of the backup plan
-        plan = persistence.get_backup_plan(plan.id) or plan
         try:
             expirable_backups, non_expirable_backups = self.find_plan_expirable_backups(plan, plan_backups)
-            if non_expirable_backups:
-                self.mark_plan_backups_not_expirable(plan, non_expirable_backups)
-                total_dont_expire += len(non_expirable_backups)
+            dues = self.get_plan_backups_due_for_expiration(plan, expirable_backups,
+                                                            latest_plan=latest_plan) or []
+            for due_backup in dues:
+                self.validate_backup_to_expire(due_backup, plan=plan)
 
-            total_expired += self.expire_plan_dues(plan, expirable_backups)
+            return dues, non_expirable_backups
         except Exception, e:
             logger.exception("BackupExpirationManager Error while"
                              " processing plan '%s'" % plan.id)
@@ -211,6 +316,16 @@ class BackupExpirationManager(ScheduleRunner):
                        " plan '%s'\n\nStack Trace:\n%s" %
                        (plan.id, traceback.format_exc()))
             get_mbs().notifications.send_error_notification(subject, message)
+            return [], []
+
+    ###########################################################################
+    def _process_plan(self, plan, plan_backups):
+        # Ensure we have the latest revision of the backup plan
+        latest_plan = persistence.get_backup_plan(plan.id)
+        dues, dont_expire = self._evaluate_plan(latest_plan or plan, plan_backups,
+                                                latest_plan=latest_plan)
+        total_dont_expire = self.mark_backups_never_expire(dont_expire)
+        total_expired = self.expire_backups(dues)
 
         return total_expired, total_dont_expire
 
@@ -231,7 +346,8 @@ class BackupExpirationManager(ScheduleRunner):
 
         logger.info("BackupExpirationManager: Executing query :\n%s" %
                     document_pretty_string(q))
-        onetime_backups_iter = get_mbs().backup_collection.find_iter(query=q, no_cursor_timeout=True)
+        onetime_backups_iter = get_mbs().backup_collection.find_iter(query=q, lazy=True,
+                                                                     no_cursor_timeout=True)
 
         for onetime_backup in onetime_backups_iter:
             if self.stop_requested:
@@ -265,7 +381,8 @@ class BackupExpirationManager(ScheduleRunner):
 
         logger.info("BackupExpirationManager: Executing query :\n%s" %
                     document_pretty_string(q))
-        canceled_backups_iter = get_mbs().backup_collection.find_iter(query=q, no_cursor_timeout=True)
+        canceled_backups_iter = get_mbs().backup_collection.find_iter(query=q, lazy=True,
+                                                                     no_cursor_timeout=True)
 
         for backup in canceled_backups_iter:
             if self.stop_requested:
@@ -277,16 +394,23 @@ class BackupExpirationManager(ScheduleRunner):
                     " Backups")
 
     ###########################################################################
-    def get_plan_backups_due_for_expiration(self, plan, plan_backups):
+    def get_plan_backups_due_for_expiration(self, plan, plan_backups,
+                                            latest_plan=_NOT_FETCHED):
         rp = plan.retention_policy
-        if rp and self.is_plan_backups_expirable(plan):
+        if rp and self.is_plan_backups_expirable(plan, latest_plan=latest_plan):
             return rp.filter_backups_due_for_expiration(plan_backups)
 
     ###########################################################################
-    def is_plan_backups_expirable(self, plan):
+    def is_plan_backups_expirable(self, plan, latest_plan=_NOT_FETCHED):
+        """
+            latest_plan is the plan as read from the plan collection (None if
+            it was removed) when the caller already read it
+        """
         # We only allow expiring backups that has a whose plans still exist
         #  and has a retention policy
-        return persistence.get_backup_plan(plan.id) is not None
+        if latest_plan is _NOT_FETCHED:
+            latest_plan = persistence.get_backup_plan(plan.id)
+        return latest_plan is not None
 
     ###########################################################################
     def is_onetime_backup_due_for_expiration(self, backup):
@@ -298,15 +422,29 @@ class BackupExpirationManager(ScheduleRunner):
 
     ###########################################################################
     def find_plan_expirable_backups(self, plan, plan_backups):
+        """
+            Returns the expirable and never expirable backups of the plan.
+            Backups of the expiration cycle only have the fields of
+            get_retention_backup_fields()
+        """
         return plan_backups, []
 
+    ###########################################################################
+    def get_retention_backup_fields(self):
+        """
+            Backup fields loaded to evaluate the retention of recurring
+            backups. Overrides needing more fields extend these
+        """
+        return RETENTION_BACKUP_FIELDS
+
     ###########################################################################
     def expire_plan_dues(self, plan, plan_backups):
         dues = self.get_plan_backups_due_for_expiration(plan, plan_backups)
 
         if dues:
             for due_backup in dues:
-                self.expire_backup(due_backup)
+                self.validate_backup_to_expire(due_backup, plan=plan)
+            self.expire_backups(dues)
 
         return len(dues) if dues else 0
 
@@ -322,12 +460,7 @@ class BackupExpirationManager(ScheduleRunner):
     ###########################################################################
     def expire_backup(self, backup, force=False):
         # do some validation
-        if backup.state == State.SUCCEEDED and not backup.target_reference:
-            raise BackupExpirationError("Cannot expire backup '%s'. "
-                                        "Backup never uploaded" % backup.id)
-
-        if not(force or backup.state == State.CANCELED):
-            self.validate_backup_expiration(backup)
+        self.validate_backup_to_expire(backup, force=force)
 
         if not self.test_mode:
             try:
@@ -348,22 +481,62 @@ class BackupExpirationManager(ScheduleRunner):
             return
 
     ###########################################################################
-    def validate_backup_expiration(self, backup):
+    def expire_backups(self, backups):
+        """
+            Expires (already validated) backups with one bulk write. Returns
+            the number of backups expired
+        """
+        if not backups:
+            return 0
+
+        if self.test_mode:
+            logger.info("BackupExpirationManager: NOOP. Test mode enabled. "
+                        "Not expiring %s backups" % len(backups))
+            return len(backups)
+
+        logger.info("BackupExpirationManager: Expiring %s backups: %s" %
+                    (len(backups), [backup.id for backup in backups]))
+        expired_date = date_now()
+        for backup in backups:
+            backup.expired_date = expired_date
+
+        try:
+            persistence.update_backups(backups, properties="expiredDate",
+                                       event_name="EXPIRING",
+                                       message="Expiring")
+        except Exception, e:
+            logger.exception("Error while attempting to expire %s backups: "
+                             "%s" % (len(backups), e))
+            return 0
+
+        return len(backups)
+
+    ###########################################################################
+    def validate_backup_to_expire(self, backup, force=False, plan=None):
+        if backup.state == State.SUCCEEDED and not backup.target_reference:
+            raise BackupExpirationError("Cannot expire backup '%s'. "
+                                        "Backup never uploaded" % backup.id)
+
+        if not(force or backup.state == State.CANCELED):
+            self.validate_backup_expiration(backup, plan=plan)
+
+    ###########################################################################
+    def validate_backup_expiration(self, backup, plan=None):
         logger.info("Validating backup '%s' expiration. startDate='%s',"
                     " endDate='%s'" % (backup.id, backup.start_date,
                                        backup.end_date))
         # recurring backup validation
         if backup.plan:
-            self.validate_recurring_backup_expiration(backup)
+            self.validate_recurring_backup_expiration(backup, plan=plan)
         else:
             self.validate_onetime_backup_expiration(backup)
 
     ###########################################################################
-    def validate_recurring_backup_expiration(self, backup):
+    def validate_recurring_backup_expiration(self, backup, plan=None):
         logger.info("Validating if recurring backup '%s' should be "
                     "expired now" % backup.id)
         # Ensure we have the latest revision of the backup plan when possible
-        plan = persistence.get_backup_plan(backup.plan.id) or backup.plan
+        plan = plan or persistence.get_backup_plan(backup.plan.id) or backup.plan
 
         rp = plan.retention_policy
 
@@ -371,10 +544,9 @@ class BackupExpirationManager(ScheduleRunner):
             raise BackupExpirationError(
                 "Bad attempt to expire backup '%s'. "
                 "Backup plan does not have a retention policy" % backup.id)
-        occurrences_to_retain = \
-            rp.get_plan_occurrences_to_retain_as_of(plan, date_now())
 
-        if backup.plan_occurrence in occurrences_to_retain:
+        if rp.is_plan_occurrence_retained_as_of(plan, backup.plan_occurrence,
+                                                date_now()):
             raise BackupExpirationError(
                 "Bad attempt to expire backup '%s'. Backup must not be"
                 " expired now." % backup.id)
@@ -425,8 +597,25 @@ class BackupExpirationManager(ScheduleRunner):
         logger.info("Marking following backups for plan '%s' as dontExpire (total of %s)"
                     % (plan.id, len(backups)))
 
+        self.mark_backups_never_expire(backups)
+
+    ###############################################################################
+    def mark_backups_never_expire(self, backups):
+        """
+            Marks backups as dontExpire with one bulk write. Returns the number
+            of backups marked
+        """
+        if not backups:
+            return 0
+
+        logger.info("Mark backups %s as not expirable...." %
+                    [backup.id for backup in backups])
         for backup in backups:
-            self.mark_backup_never_expire(backup)
+            backup.dont_expire = True
+        persistence.update_backups(backups, properties=["dontExpire"],
+                                   event_name="MARK_UNEXPIRABLE",
+                                   message="Marking as dontExpire")
+        return len(backups)
 
     ###############################################################################
     def mark_backup_never_expire(self, backup):
@@ -438,6 +627,19 @@ class BackupExpirationManager(ScheduleRunner):
                                   message="Marking as dontExpire")
 
 
+###############################################################################
+def _group_plan_backups(plan_backup_docs):
+    """
+        Groups backup documents sorted by plan into
+        {"_id": <plan id>, "backups": [...]} groups
+    """
+    for plan_id, docs in groupby(plan_backup_docs,
+                                 key=lambda doc: doc["plan"]["_id"]):
+        yield {
+            "_id": plan_id,
+            "backups": list(docs)
+        }
+
 ###############################################################################
 RETENTION_WORKER_SCHEDULE = Schedule(frequency_in_seconds=30)
 
@@ -20,7 +20,16 @@ class RetentionPolicy(MBSObject):
     def filter_backups_due_for_expiration(self, backups):
         """
             Returns a list of backups that should expired and should be
-            removed. Should be overridden by sub classes
+            removed. Backups needed to restore retained incremental backups
+            are never returned
+        """
+        due_backups = self._filter_backups_due_for_expiration(backups)
+        return _exclude_incremental_dependencies(due_backups, backups)
+
+    ###########################################################################
+    def _filter_backups_due_for_expiration(self, backups):
+        """
+            Should be overridden by sub classes
         """
         return []
 
@@ -28,6 +37,18 @@ class RetentionPolicy(MBSObject):
     def get_plan_occurrences_to_retain_as_of(self, plan, dt):
         pass
 
+    ###########################################################################
+    def iter_plan_occurrences_to_retain_as_of(self, plan, dt):
+        """
+            Lazy get_plan_occurrences_to_retain_as_of()
+        """
+        return iter(self.get_plan_occurrences_to_retain_as_of(plan, dt))
+
+    ###########################################################################
+    def is_plan_occurrence_retained_as_of(self, plan, occurrence, dt):
+        return occurrence in self.get_plan_occurrences_to_retain_as_of(plan,
+                                                                        dt)
+
     ###########################################################################
     def get_occurrence_expected_expire_date(self, plan, occurrence):
         pass
@@ -54,7 +75,7 @@ class RetainLastNPolicy(RetentionPolicy):
         self._retain_count = retain_count
 
     ###########################################################################
-    def filter_backups_due_for_expiration(self, backups):
+    def _filter_backups_due_for_expiration(self, backups):
 
         backups.sort(key=operator.attrgetter('created_date'), reverse=True)
 
@@ -106,7 +127,7 @@ class RetainMaxTimePolicy(RetentionPolicy):
         self._max_time = max_time
 
     ###########################################################################
-    def filter_backups_due_for_expiration(self, backups):
+    def _filter_backups_due_for_expiration(self, backups):
 
         earliest_date_to_keep = date_minus_seconds(date_now(), self.max_time)
 
@@ -120,6 +141,19 @@ class RetainMaxTimePolicy(RetentionPolicy):
         start_date = date_minus_seconds(end_date, self.max_time)
         return plan.schedule.natural_occurrences_between(start_date, end_date)
 
+    ###########################################################################
+    def iter_plan_occurrences_to_retain_as_of(self, plan, dt):
+        start_date = date_minus_seconds(dt, self.max_time)
+        return plan.schedule.iter_natural_occurrences_between(start_date, dt)
+
+    ###########################################################################
+    def is_plan_occurrence_retained_as_of(self, plan, occurrence, dt):
+        if not occurrence:
+            return False
+        start_date = date_minus_seconds(dt, self.max_time)
+        return plan.schedule.is_natural_occurrence_between(occurrence,
+                                                           start_date, dt)
+
     ###########################################################################
     def get_occurrence_expected_expire_date(self, plan, occurrence):
         return date_plus_seconds(occurrence, self.max_time)
@@ -130,3 +164,26 @@ class RetainMaxTimePolicy(RetentionPolicy):
             "_type": "RetainMaxTimePolicy",
             "maxTime": self.max_time
         }
+
+###############################################################################
+# HELPERS
+###############################################################################
+def _exclude_incremental_dependencies(due_backups, backups):
+    """
+        Excludes backups that retained incremental backups are chained to
+        (their base backup and the incrementals before them)
+    """
+    due_ids = set(backup.id for backup in due_backups)
+    backups_by_id = dict((backup.id, backup) for backup in backups)
+
+    needed_ids = set()
+    for backup in backups:
+        if backup.id in due_ids:
+            continue
+        previous_id = backup.previous_backup_id
+        while previous_id and previous_id not in needed_ids:
+            needed_ids.add(previous_id)
+            previous_backup = backups_by_id.get(previous_id)
+            previous_id = previous_backup and previous_backup.previous_backup_id
+
+    return filter(lambda backup: backup.id not in needed_ids, due_backups)
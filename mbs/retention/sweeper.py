@@ -145,18 +145,20 @@ class BackupSweeper(multiprocessing.Process):
         logger.info("BackupSweeper: Executing query :\n%s" %
                     document_pretty_string(q))
 
-        backups_iter = get_mbs().backup_collection.find_iter(query=q, no_cursor_timeout=True)
+        # only ids are loaded here. Workers load (and make) the backups they
+        # process so that making backup objects is spread across processes
+        backups_iter = get_mbs().backup_collection.find_iter(query=q, projection=["_id"],
+                                                             no_cursor_timeout=True)
 
         backups_iterated = 0
         # process all plan backups
         for backup in backups_iter:
 
-            self._sweep_queue.put(backup)
+            self._sweep_queue.put(backup.id)
             backups_iterated += 1
             # PERFORMANCE OPTIMIZATION
             # process 10 * worker at max
-            # This is needed because making backup objects (from within the backups_iter) takes up a lot of CPU/Memory
-            # This is needed to give it a breath
+            # This is needed to give workers a breath
             if backups_iterated % (self._worker_count * 10) == 0:
                 self._wait_for_queue_to_be_empty()
 
@@ -397,23 +399,27 @@ class SweepWorker(multiprocessing.Process):
     def run(self):
         while True:
 
-            backup = self._sweep_queue.get()
-            if backup is None: # None in Queue means STOP!!!
+            backup_id = self._sweep_queue.get()
+            if backup_id is None: # None in Queue means STOP!!!
                 logger.info("%s Exiting..." % self.name)
                 self._sweep_queue.task_done()
                 # breaking
                 break
 
-            logger.info("%s Processing backup %s" % (self.name, backup.id))
+            logger.info("%s Processing backup %s" % (self.name, backup_id))
             self.total_processed += 1
             try:
+                backup = get_mbs().backup_collection.get_by_id(backup_id)
+                if not backup:
+                    logger.info("%s Backup %s no longer exists" % (self.name, backup_id))
+                    continue
                 deleted = self._backup_sweeper.delete_backup_targets(backup)
                 if deleted:
                     self.total_deleted += 1
             except Exception, ex:
                 self.total_errored += 1
                 msg = ("%s: Error while attempting to "
-                       "delete backup targets for backup '%s'" % (self.name, backup.id))
+                       "delete backup targets for backup '%s'" % (self.name, backup_id))
                 logger.exception(msg)
             finally:
                 self._sweep_queue.task_done()
@@ -1,6 +1,10 @@
 import abc
+import heapq
+import itertools
 
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from threading import Lock
 
 from croniter import croniter
 
@@ -9,6 +13,16 @@ from date_utils import (seconds_to_date, date_to_seconds, date_plus_seconds,
                         date_now, is_date_value, epoch_date,
                         timedelta_total_seconds)
 
+###############################################################################
+# CONSTANTS
+###############################################################################
+# max number of compiled cron expressions kept in memory
+COMPILED_CRON_CACHE_SIZE = 1024
+
+# enumerating cron occurrences gives up after this many days without one
+# (e.g. "0 0 29 2 *" can skip 8 years around non leap centuries)
+MAX_CRON_SEARCH_DAYS = 366 * 9
+
 
 ###############################################################################
 # AbstractSchedule
@@ -99,11 +113,67 @@ class AbstractSchedule(object):
         if end_dt <= start_dt:
             raise Exception('end_dt must be greater than start_dt')
 
+    ###########################################################################
+    @abc.abstractmethod
+    def iter_natural_occurrences(self, start_dt):
+        """ Yields the scheduled occurrences starting at start_dt (inclusive),
+        in order and without end.
+
+        """
+        pass
+
+    ###########################################################################
+    @abc.abstractmethod
+    def is_natural_occurrence(self, dt):
+        """ Returns True if dt is a scheduled occurrence.
+
+        """
+        pass
+
+    ###########################################################################
+    def iter_natural_occurrences_between(self, start_dt, end_dt=None):
+        """ Lazy natural_occurrences_between()
+
+        """
+        end_dt = date_now() if end_dt is None else end_dt
+        AbstractSchedule.natural_occurrences_between(self, start_dt, end_dt)
+        return itertools.takewhile(lambda occurrence: occurrence < end_dt,
+                                   self.iter_natural_occurrences(start_dt))
+
+    ###########################################################################
+    def count_natural_occurrences_between(self, start_dt, end_dt=None):
+        """ Number of natural_occurrences_between() without building them
+
+        """
+        return sum(1 for occurrence in
+                   self.iter_natural_occurrences_between(start_dt, end_dt))
+
+    ###########################################################################
+    def nth_natural_occurrence(self, n, start_dt):
+        """ The nth (0 based) occurrence starting at start_dt (inclusive)
+
+        """
+        return next(itertools.islice(self.iter_natural_occurrences(start_dt),
+                                     n, None))
+
+    ###########################################################################
+    def is_natural_occurrence_between(self, dt, start_dt, end_dt=None):
+        """ Returns True if dt is one of natural_occurrences_between()
+
+        """
+        end_dt = date_now() if end_dt is None else end_dt
+        return start_dt <= dt < end_dt and self.is_natural_occurrence(dt)
+
     ###########################################################################
     def natural_occurrences_as_of(self, date):
         next_date = date + timedelta(days=1)
         return self.natural_occurrences_between(date, next_date)
 
+    ###########################################################################
+    def iter_natural_occurrences_as_of(self, date):
+        next_date = date + timedelta(days=1)
+        return self.iter_natural_occurrences_between(date, next_date)
+
     ###########################################################################
     def last_n_occurrences(self, n, dt=None):
         end_date = dt or date_now()
@@ -197,21 +267,45 @@ class Schedule(AbstractSchedule, MBSObject):
 
     ###########################################################################
     def natural_occurrences_between(self, start_dt, end_dt=None):
-        super(Schedule, self).natural_occurrences_between(start_dt, end_dt)
+        return list(self.iter_natural_occurrences_between(start_dt, end_dt))
 
-        end_dt = date_now() if end_dt is None else end_dt
-        occurrences = []
-        last_occurrence = self.last_natural_occurrence(start_dt)
+    ###########################################################################
+    def _first_occurrence(self, start_dt):
+        """
+            First occurrence at or after start_dt
+        """
+        occurrence = self.last_natural_occurrence(start_dt)
+        if occurrence < start_dt:
+            occurrence += timedelta(seconds=self.frequency_in_seconds)
+        return occurrence
 
+    ###########################################################################
+    def iter_natural_occurrences(self, start_dt):
+        occurrence = self._first_occurrence(start_dt)
         delta = timedelta(seconds=self.frequency_in_seconds)
+        while True:
+            yield occurrence
+            occurrence += delta
 
-        while last_occurrence < end_dt:
-            if last_occurrence >= start_dt:
-                occurrences.append(last_occurrence)
+    ###########################################################################
+    def count_natural_occurrences_between(self, start_dt, end_dt=None):
+        end_dt = date_now() if end_dt is None else end_dt
+        AbstractSchedule.natural_occurrences_between(self, start_dt, end_dt)
+        first_occurrence = self._first_occurrence(start_dt)
+        if first_occurrence >= end_dt:
+            return 0
+        # occurrences in [first_occurrence, end_dt), rounded up
+        seconds = timedelta_total_seconds(end_dt - first_occurrence)
+        return int(-(-seconds // self.frequency_in_seconds))
 
-            last_occurrence = last_occurrence + delta
+    ###########################################################################
+    def nth_natural_occurrence(self, n, start_dt):
+        return (self._first_occurrence(start_dt) +
+                timedelta(seconds=n * self.frequency_in_seconds))
 
-        return occurrences
+    ###########################################################################
+    def is_natural_occurrence(self, dt):
+        return dt.microsecond == 0 and self.last_natural_occurrence(dt) == dt
 
     ###########################################################################
     def to_document(self, display_only=False):
@@ -228,6 +322,7 @@ class Schedule(AbstractSchedule, MBSObject):
 class CronSchedule(AbstractSchedule, MBSObject):
     def __init__(self):
         self._expression = None
+        self._compiled_cron = None
 
     ###########################################################################
     @property
@@ -237,9 +332,24 @@ class CronSchedule(AbstractSchedule, MBSObject):
     @expression.setter
     def expression(self, expression):
         self._expression = expression
+        self._compiled_cron = None
+
+    ###########################################################################
+    def _get_compiled_cron(self):
+        """
+            Returns the CompiledCron of the expression or None if it can't be
+            compiled, in which case occurrences are computed by croniter
+        """
+        if self._compiled_cron is None:
+            self._compiled_cron = compile_cron(self._expression) or False
+        return self._compiled_cron
 
     ###########################################################################
     def _is_occurrence(self, dt):
+        compiled_cron = self._get_compiled_cron()
+        if compiled_cron:
+            return compiled_cron.is_occurrence(dt)
+
         occurrence = croniter(self._expression, dt).get_prev(datetime)
         if dt == croniter(self._expression, occurrence).get_next(datetime):
             return True
@@ -275,6 +385,9 @@ class CronSchedule(AbstractSchedule, MBSObject):
     ###########################################################################
     def next_natural_occurrence(self, dt=None):
         dt = date_now() if dt is None else dt
+        compiled_cron = self._get_compiled_cron()
+        if compiled_cron:
+            return compiled_cron.next_occurrence(dt)
         return croniter(self._expression, dt).get_next(datetime)
 
     ###########################################################################
@@ -288,12 +401,38 @@ class CronSchedule(AbstractSchedule, MBSObject):
             dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
         if self._is_occurrence(dt):
             return dt
+        compiled_cron = self._get_compiled_cron()
+        if compiled_cron:
+            return compiled_cron.previous_occurrence(dt)
         return croniter(self._expression, dt).get_prev(datetime)
 
+    ###########################################################################
+    def iter_natural_occurrences(self, start_dt):
+        compiled_cron = self._get_compiled_cron()
+        if compiled_cron:
+            return compiled_cron.iter_occurrences(start_dt)
+        return self._iter_croniter_occurrences(start_dt)
+
+    ###########################################################################
+    def _iter_croniter_occurrences(self, start_dt):
+        if self._is_occurrence(start_dt):
+            yield start_dt
+        iter_ = croniter(self._expression, start_dt)
+        while True:
+            yield iter_.get_next(datetime)
+
+    ###########################################################################
+    def is_natural_occurrence(self, dt):
+        return self._is_occurrence(dt)
+
     ###########################################################################
     def natural_occurrences_between(self, start_dt, end_dt=None):
         super(CronSchedule, self).natural_occurrences_between(start_dt, end_dt)
         end_dt = date_now() if end_dt is None else end_dt
+        compiled_cron = self._get_compiled_cron()
+        if compiled_cron:
+            return compiled_cron.occurrences_between(start_dt, end_dt)
+
         occurrences = []
         if self._is_occurrence(start_dt):
             occurrences.append(start_dt)
@@ -315,6 +454,164 @@ class CronSchedule(AbstractSchedule, MBSObject):
         }
 
 
+###############################################################################
+# CompiledCron
+###############################################################################
+class CompiledCron(object):
+    """
+        A cron expression expanded once (by croniter) into the set of
+        minutes, hours, days, months and weekdays it matches. Checking an
+        occurrence is a few set lookups and occurrences are enumerated a day
+        at a time. Follows croniter semantics: when both day of month and
+        day of week are restricted a day matching either one is an occurrence
+    """
+    ###########################################################################
+    def __init__(self, expression):
+        cron = croniter(expression)
+        expanded = cron.expanded
+        if len(expanded) != 5 or getattr(cron, "nth_weekday_of_month", None):
+            raise ValueError("Unsupported cron expression '%s'" % expression)
+
+        self.expression = expression
+        self.minutes = _cron_field_values(expanded[0], 0, 59)
+        self.hours = _cron_field_values(expanded[1], 0, 23)
+        self.days = _cron_field_values(expanded[2], 1, 31)
+        self.months = _cron_field_values(expanded[3], 1, 12)
+        # cron weekdays start on sunday (0 or 7)
+        self.weekdays = set(d % 7 for d in _cron_field_values(expanded[4],
+                                                              0, 6))
+        self._any_day = expanded[2][0] == "*"
+        self._any_weekday = expanded[4][0] == "*"
+
+        # occurrence times of a matching day, in order
+        self._times = [(h, m) for h in sorted(self.hours)
+                       for m in sorted(self.minutes)]
+
+    ###########################################################################
+    def is_occurrence(self, dt):
+        return (dt.second == 0 and dt.microsecond == 0 and
+                dt.minute in self.minutes and dt.hour in self.hours and
+                self.is_occurrence_day(dt))
+
+    ###########################################################################
+    def is_occurrence_day(self, dt):
+        if dt.month not in self.months:
+            return False
+
+        if self._any_day and self._any_weekday:
+            return True
+
+        day_matches = dt.day in self.days
+        weekday_matches = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return weekday_matches
+        elif self._any_weekday:
+            return day_matches
+        else:
+            return day_matches or weekday_matches
+
+    ###########################################################################
+    def iter_occurrences(self, start_dt):
+        """
+            Yields occurrences starting at start_dt (inclusive), in order
+        """
+        day = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        for day in self._iter_occurrence_days(day, timedelta(days=1)):
+            for hour, minute in self._times:
+                occurrence = day.replace(hour=hour, minute=minute)
+                if occurrence >= start_dt:
+                    yield occurrence
+
+    ###########################################################################
+    def iter_occurrences_before(self, end_dt):
+        """
+            Yields occurrences before end_dt (exclusive), latest first
+        """
+        day = end_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        for day in self._iter_occurrence_days(day, timedelta(days=-1)):
+            for hour, minute in reversed(self._times):
+                occurrence = day.replace(hour=hour, minute=minute)
+                if occurrence < end_dt:
+                    yield occurrence
+
+    ###########################################################################
+    def _iter_occurrence_days(self, day, step):
+        days_without_occurrence = 0
+        while days_without_occurrence < MAX_CRON_SEARCH_DAYS:
+            if self.is_occurrence_day(day):
+                days_without_occurrence = 0
+                yield day
+            else:
+                days_without_occurrence += 1
+            day += step
+
+        raise ValueError("Cron expression '%s' has no occurrence within %s "
+                         "days" % (self.expression, MAX_CRON_SEARCH_DAYS))
+
+    ###########################################################################
+    def next_occurrence(self, dt):
+        """
+            First occurrence after dt
+        """
+        start_dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        return next(self.iter_occurrences(start_dt))
+
+    ###########################################################################
+    def previous_occurrence(self, dt):
+        """
+            Last occurrence before dt
+        """
+        return next(self.iter_occurrences_before(dt))
+
+    ###########################################################################
+    def occurrences_between(self, start_dt, end_dt):
+        """
+            Occurrences from start_dt (inclusive) to end_dt (exclusive)
+        """
+        occurrences = []
+        for occurrence in self.iter_occurrences(start_dt):
+            if occurrence >= end_dt:
+                break
+            occurrences.append(occurrence)
+        return occurrences
+
+###############################################################################
+def _cron_field_values(values, low, high):
+    if values[0] == "*":
+        return set(range(low, high + 1))
+    # raises for values that can't be expanded to a set (e.g. "L")
+    return set(int(v) for v in values)
+
+###############################################################################
+_compiled_crons = OrderedDict()
+_compiled_crons_lock = Lock()
+
+###############################################################################
+def compile_cron(expression):
+    """
+        Returns the CompiledCron of the expression (shared by all schedules
+        of the expression, least recently used ones are dropped) or None if
+        the expression can't be compiled
+    """
+    with _compiled_crons_lock:
+        if expression in _compiled_crons:
+            compiled_cron = _compiled_crons.pop(expression)
+            _compiled_crons[expression] = compiled_cron
+            return compiled_cron
+
+    try:
+        compiled_cron = CompiledCron(expression)
+    except Exception:
+        compiled_cron = None
+
+    with _compiled_crons_lock:
+        _compiled_crons[expression] = compiled_cron
+        while len(_compiled_crons) > COMPILED_CRON_CACHE_SIZE:
+            _compiled_crons.popitem(last=False)
+
+    return compiled_cron
+
+
 ########################################################################################################################
 # CompositeSchedule
 ########################################################################################################################
@@ -366,14 +663,23 @@ class CompositeSchedule(AbstractSchedule, MBSObject):
         """
             :returns all occurrences across all schedules
         """
-        all_ocs = []
-        for s in self.schedules:
-            all_ocs.extend(s.natural_occurrences_between(start_dt, end_dt=end_dt))
+        return list(self.iter_natural_occurrences_between(start_dt, end_dt=end_dt))
+
+    ###########################################################################
+    def iter_natural_occurrences(self, start_dt):
+        """
+            Merges the (ordered) occurrences of all schedules, without duplicates
+        """
+        last_occurrence = None
+        for occurrence in heapq.merge(*[s.iter_natural_occurrences(start_dt)
+                                        for s in self.schedules]):
+            if occurrence != last_occurrence:
+                last_occurrence = occurrence
+                yield occurrence
 
-        # eliminate duplicates
-        all_ocs = list(set(all_ocs))
-        all_ocs.sort()
-        return all_ocs
+    ###########################################################################
+    def is_natural_occurrence(self, dt):
+        return any(s.is_natural_occurrence(dt) for s in self.schedules)
 
     ###########################################################################
     def validate(self):
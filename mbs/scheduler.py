@@ -4,13 +4,18 @@ from schedule_runner import ScheduleRunner
 from schedule import Schedule
 from globals import State
 from mbs import get_mbs
-from date_utils import date_now, timedelta_total_seconds
+from date_utils import (date_now, timedelta_total_seconds, date_plus_seconds,
+                        date_minus_seconds)
+from mongo_utils import objectiditify
 from task import EVENT_STATE_CHANGE
 import traceback
 import logging
 from errors import InvalidPlanError
 
 import Queue
+import heapq
+
+from threading import Thread, Condition
 ########################################################################################################################
 # LOGGER
 ########################################################################################################################
@@ -18,10 +23,27 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 PLAN_WORKER_COUNT = 5
+
+# plans occurring within this many seconds are loaded into memory
+PLAN_LOOKAHEAD_SECONDS = 5 * 60
+
+# plans past due for this long that are not being processed are loaded again
+# (e.g. processing failed or the plan was changed outside the backup system)
+PLAN_RECOVERY_GRACE_SECONDS = 60
+PLAN_RECOVERY_MAX_COUNT = 1000
+
+# max seconds the dispatcher sleeps without checking for a stop request
+MAX_DISPATCH_WAIT = 1
+
+# max number of due plans a worker schedules with one bulk insert
+PLAN_BATCH_SIZE = 100
 ########################################################################################################################
 class BackupScheduler(ScheduleRunner):
     """
-        Backup monitoring thread
+        Fires plans at their next occurrence. Upcoming occurrences are loaded
+        into an in memory heap from the nextOccurrence index, PLAN_LOOKAHEAD_SECONDS
+        ahead on each tick. The backup system notifies the scheduler when it
+        creates, updates or removes plans
     """
     ####################################################################################################################
     def __init__(self, backup_system):
@@ -29,10 +51,21 @@ class BackupScheduler(ScheduleRunner):
         ScheduleRunner.__init__(self, schedule=Schedule(frequency_in_seconds=10))
         self._plans_queue = Queue.Queue()
         self._plan_workers = None
+        self._occurrences = PlanOccurrenceHeap()
+        self._occurrences_condition = Condition()
+        # occurrences up to this date are in the heap
+        self._loaded_until = None
+        # ids of plans dispatched and not processed yet
+        self._in_flight = set()
+        self._dispatcher = None
 
     ####################################################################################################################
     def run(self):
         self._init_workers()
+        self._load_upcoming_plans()
+        self._dispatcher = Thread(target=self._dispatch_due_plans)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
         super(BackupScheduler,self).run()
 
     ####################################################################################################################
@@ -47,7 +80,8 @@ class BackupScheduler(ScheduleRunner):
     def tick(self):
 
         try:
-            self._process_plans_considered_now(process_max_count=100)
+            self._load_upcoming_plans()
+            self._recover_past_due_plans()
         except Exception, e:
             logger.error("Caught an error: '%s'.\nStack Trace:\n%s" %
                          (e, traceback.format_exc()))
@@ -73,94 +107,206 @@ class BackupScheduler(ScheduleRunner):
             message = ("%s.\n\nStack Trace:\n%s" % (e, traceback.format_exc()))
             get_mbs().notifications.send_error_notification(subject, message)
 
+    ####################################################################################################################
+    def _load_upcoming_plans(self):
+        """
+        Adds plans occurring until now + PLAN_LOOKAHEAD_SECONDS to the heap.
+        Only occurrences after the previous load are read. Plans with no next
+        occurrence yet are due now
+        """
+        # moved forward before reading so that plan_updated() keeps plans it
+        # sees occurring before load_until instead of leaving them to a load
+        # that would skip them
+        with self._occurrences_condition:
+            loaded_until = self._loaded_until
+            load_until = date_plus_seconds(date_now(), PLAN_LOOKAHEAD_SECONDS)
+            self._loaded_until = load_until
+
+        occurrence_q = {"$lte": load_until}
+        if loaded_until:
+            occurrence_q["$gt"] = loaded_until
+
+        q = {"$or": [
+            {"nextOccurrence": None},
+            {"nextOccurrence": occurrence_q}
+        ]
+        }
+
+        try:
+            count = self._add_plan_occurrences(q)
+        except Exception:
+            with self._occurrences_condition:
+                if self._loaded_until == load_until:
+                    self._loaded_until = loaded_until
+            raise
+
+        if count:
+            logger.info("Loaded %s plan occurrences until '%s'" % (count, load_until))
 
     ####################################################################################################################
-    def _process_plans_considered_now(self, process_max_count=None):
-        count = 0
-        start_date = date_now()
-        for plan in self._get_plans_to_consider_now(limit=process_max_count):
-            self._plans_queue.put(plan)
-            if process_max_count:
-                count += 1
-                if count >= process_max_count:
-                    break
-        # wait for workers to finish
-        self._plans_queue.join()
+    def _recover_past_due_plans(self):
+        q = {"$or": [
+            {"nextOccurrence": None},
+            {"nextOccurrence": {"$lte": date_minus_seconds(date_now(), PLAN_RECOVERY_GRACE_SECONDS)}}
+        ]
+        }
 
+        count = self._add_plan_occurrences(q, limit=PLAN_RECOVERY_MAX_COUNT)
         if count:
-            time_elapsed = timedelta_total_seconds(date_now() - start_date)
-            logger.info("Finished processing %s plans in %s seconds" % ((count or "all"), time_elapsed))
+            logger.info("Recovered %s past due plans" % count)
 
     ####################################################################################################################
-    def _process_plan(self, plan):
-        """
-        Schedule the plan if the following conditions apply
-        """
-        logger.info("Processing plan '%s'" % plan.id)
-        # validate plan first
-        logger.debug("Validating plan '%s'" % plan.id)
+    def _add_plan_occurrences(self, q, limit=None):
+        # only read what the nextOccurrence index covers
+        projection = {"_id": 1, "nextOccurrence": 1, "priority": 1}
+        now = date_now()
+        count = 0
+        with self._occurrences_condition:
+            for plan_doc in get_mbs().plan_collection.collection.find(q, projection, limit=limit or 0):
+                plan_id = plan_doc["_id"]
+                if plan_id in self._in_flight or plan_id in self._occurrences:
+                    continue
+                self._occurrences.set(plan_id, plan_doc.get("nextOccurrence") or now,
+                                      priority=plan_doc.get("priority"))
+                count += 1
 
-        errors = plan.validate()
-        if errors:
-            err_msg = ("Plan '%s' is invalid. Deleting...."
-                       " errors.\n%s" % (plan.id, errors))
-            logger.error(err_msg)
-            self._backup_system.remove_plan(plan.id)
+            self._occurrences_condition.notify()
 
-            return
+        return count
 
+    ####################################################################################################################
+    def _dispatch_due_plans(self):
+        while not self.stop_requested:
+            try:
+                with self._occurrences_condition:
+                    due_plan_ids = self._occurrences.pop_due(date_now())
+                    if not due_plan_ids:
+                        self._occurrences_condition.wait(self._seconds_until_next_occurrence())
+                        continue
 
-        now = date_now()
-        next_natural_occurrence = plan.schedule.next_natural_occurrence()
+                    self._in_flight.update(due_plan_ids)
 
-        # CASE I: First time <==> No previous backups
-        # Only set the next occurrence here
-        if not plan.next_occurrence:
-            logger.info("Plan '%s' has no previous backup. Setting next occurrence to '%s'" %
-                        (plan.id, next_natural_occurrence))
+                for plan_id in due_plan_ids:
+                    self._plans_queue.put(plan_id)
+            except Exception, e:
+                logger.exception("Error while dispatching plans. Cause: %s" % e)
 
-            self._set_update_plan_next_occurrence(plan)
+    ####################################################################################################################
+    def _seconds_until_next_occurrence(self):
+        next_occurrence = self._occurrences.next_occurrence()
+        if next_occurrence is None:
+            return MAX_DISPATCH_WAIT
+        seconds = timedelta_total_seconds(next_occurrence - date_now())
+        return max(0, min(seconds, MAX_DISPATCH_WAIT))
 
-            # CASE II: If there is a backup running (IN PROGRESS)
-            # ===> no op
-            ### TODO XXX : we don't this case any more
+    ####################################################################################################################
+    def plan_updated(self, plan):
+        """
+        Called when a plan is created/updated or its next occurrence changes
+        """
+        plan_id = objectiditify(plan.id)
+        with self._occurrences_condition:
+            if plan_id in self._in_flight:
+                # the worker processing it refreshes it when done
+                return
+            if not plan.next_occurrence or (self._loaded_until and plan.next_occurrence <= self._loaded_until):
+                self._occurrences.set(plan_id, plan.next_occurrence or date_now(), priority=plan.priority)
+            else:
+                # loaded when it gets close
+                self._occurrences.remove(plan_id)
+            self._occurrences_condition.notify()
 
-            #elif self._plan_has_backup_in_progress(plan):
-            #self.info("Plan '%s' has a backup that is currently in"
-            #" progress. Nothing to do now." % plan._id)
-        # CASE III: if time now is past the next occurrence
-        elif plan.next_occurrence <= now:
-            logger.info("Plan '%s' next occurrence '%s' is greater than"
-                      " now. Scheduling a backup!!!" %
-                      (plan.id, plan.next_occurrence))
+    ####################################################################################################################
+    def plan_removed(self, plan_id):
+        with self._occurrences_condition:
+            self._occurrences.remove(objectiditify(plan_id))
 
-            self._backup_system.schedule_plan_backup(plan)
-        else:
-            logger.info("Wooow. How did you get here!!!! Plan '%s' does not to be scheduled yet. next natural "
-                        "occurrence %s " % (plan.id, next_natural_occurrence))
+    ####################################################################################################################
+    def _process_dispatched_plans(self, plan_ids):
+        plans = []
+        processed = False
+        q = {"_id": {"$in": plan_ids}}
+        try:
+            plans = get_mbs().plan_collection.find(q)
+            due_plans = []
+            now = date_now()
+            for plan in plans:
+                if plan.next_occurrence and plan.next_occurrence > now:
+                    # changed since it was loaded
+                    logger.info("Plan '%s' next occurrence moved to '%s'" % (plan.id, plan.next_occurrence))
+                else:
+                    due_plans.append(plan)
+
+            if len(plans) < len(plan_ids):
+                logger.info("%s dispatched plans no longer exist" % (len(plan_ids) - len(plans)))
+
+            self._process_plans(due_plans)
+            processed = True
+        finally:
+            with self._occurrences_condition:
+                self._in_flight.difference_update(plan_ids)
+            if not processed:
+                # next occurrences in memory might not be the written ones
+                plans = self._read_persisted_plans(q)
+            for plan in plans:
+                self.plan_updated(plan)
 
     ####################################################################################################################
-    def _get_plans_to_consider_now(self, limit=None):
+    def _read_persisted_plans(self, q):
         """
-        Returns list of plans that the scheduler should process at this time.
-        Those are:
-            1- Plans with no backups scheduled yet (next occurrence has not
-            been calculated yet)
+        Plans as written. Plans that can not be read are recovered later as past due
+        """
+        try:
+            return get_mbs().plan_collection.find(q)
+        except Exception:
+            logger.exception("Failed to read plans %s" % q)
+            return []
 
-            2- Plans whose next occurrence is now or in the past
+    ####################################################################################################################
+    def _process_plan(self, plan):
+        self._process_plans([plan])
 
+    ####################################################################################################################
+    def _process_plans(self, plans):
         """
+        Schedule the plans if the following conditions apply. Due plans are scheduled in bulk
+        """
+        due_plans = []
         now = date_now()
-        q = {"$or": [
-            {"nextOccurrence": None},
-            {"nextOccurrence": {"$lte": now}}
-        ]
-        }
-
-        # sort by priority
-        s = [("priority", 1)]
-
-        return get_mbs().plan_collection.find_iter(q, sort=s, limit=limit)
+        for plan in plans:
+            logger.info("Processing plan '%s'" % plan.id)
+            # validate plan first
+            logger.debug("Validating plan '%s'" % plan.id)
+
+            errors = plan.validate()
+            if errors:
+                err_msg = ("Plan '%s' is invalid. Deleting...."
+                           " errors.\n%s" % (plan.id, errors))
+                logger.error(err_msg)
+                self._backup_system.remove_plan(plan.id)
+
+                continue
+
+            # CASE I: First time <==> No previous backups
+            # Only set the next occurrence here
+            if not plan.next_occurrence:
+                logger.info("Plan '%s' has no previous backup. Setting next occurrence to '%s'" %
+                            (plan.id, plan.schedule.next_natural_occurrence()))
+
+                self._set_update_plan_next_occurrence(plan)
+
+            # CASE II: if time now is past the next occurrence
+            elif plan.next_occurrence <= now:
+                logger.info("Plan '%s' next occurrence '%s' is greater than"
+                            " now. Scheduling a backup!!!" %
+                            (plan.id, plan.next_occurrence))
+                due_plans.append(plan)
+            else:
+                logger.info("Wooow. How did you get here!!!! Plan '%s' does not to be scheduled yet. next natural "
+                            "occurrence %s " % (plan.id, plan.schedule.next_natural_occurrence()))
+
+        if due_plans:
+            self._backup_system.schedule_plan_backups(due_plans)
 
     ####################################################################################################################
     def _set_update_plan_next_occurrence(self, plan):
@@ -176,6 +322,7 @@ class BackupScheduler(ScheduleRunner):
             }
         }
         get_mbs().plan_collection.update(spec=q, document=u)
+        self.plan_updated(plan)
 
     ####################################################################################################################
     def _cancel_past_cycle_backups(self):
@@ -192,7 +339,7 @@ class BackupScheduler(ScheduleRunner):
         }
 
         bc = get_mbs().backup_collection
-        for backup in bc.find(q):
+        for backup in bc.find(q, projection=["state"]):
             logger.info("Cancelling backup %s" % backup.id)
             backup.state = State.CANCELED
             bc.update_task(backup, properties="state",
@@ -247,37 +394,109 @@ class BackupScheduler(ScheduleRunner):
 
 
 #########################################################################################################################
-
-PLAN_WORKER_SCHEDULE = Schedule(frequency_in_seconds=1)
-
-class PlanWorker(ScheduleRunner):
+class PlanWorker(Thread):
     """
-        A Thread that periodically expire backups that are due for expiration
+        A Thread that processes plans dispatched by the scheduler
     """
     ####################################################################################################################
     def __init__(self, scheduler, plan_queue):
-        ScheduleRunner.__init__(self, schedule=PLAN_WORKER_SCHEDULE)
+        Thread.__init__(self)
+        self.daemon = True
         self._scheduler = scheduler
         self._plan_queue = plan_queue
 
     ####################################################################################################################
-    def tick(self):
-        while True:
+    def run(self):
+        while not self._scheduler.stop_requested:
 
             try:
-                plan = self._plan_queue.get_nowait()
+                plan_ids = self._get_plan_batch()
             except Queue.Empty:
-                # breaking
-                break
+                continue
             try:
-                self._scheduler._process_plan(plan)
+                self._scheduler._process_dispatched_plans(plan_ids)
             except Exception, e:
-                logger.exception("Error while processing plan '%s'. "
-                                 "Cause: %s" % (plan.id, e))
+                logger.exception("Error while processing plans %s. "
+                                 "Cause: %s" % (plan_ids, e))
 
                 subject = "Plan Scheduler Error"
-                message = ("Error while processing plan '%s'. Cause: %s.\n\nStack Trace:\n%s" %
-                           (plan.id, e, traceback.format_exc()))
+                message = ("Error while processing plans %s. Cause: %s.\n\nStack Trace:\n%s" %
+                           (plan_ids, e, traceback.format_exc()))
                 get_mbs().notifications.send_error_notification(subject, message)
             finally:
-                self._plan_queue.task_done()
+                for plan_id in plan_ids:
+                    self._plan_queue.task_done()
+
+    ####################################################################################################################
+    def _get_plan_batch(self):
+        """
+            Waits for a dispatched plan then takes whatever else is queued, up to PLAN_BATCH_SIZE
+        """
+        plan_ids = [self._plan_queue.get(timeout=MAX_DISPATCH_WAIT)]
+        while len(plan_ids) < PLAN_BATCH_SIZE:
+            try:
+                plan_ids.append(self._plan_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        return plan_ids
+
+
+########################################################################################################################
+# PlanOccurrenceHeap
+########################################################################################################################
+class PlanOccurrenceHeap(object):
+    """
+        Plan ids ordered by next occurrence then priority. Replaced/removed
+        entries are dropped lazily when they reach the top
+    """
+    ####################################################################################################################
+    def __init__(self):
+        self._heap = []
+        # plan id => current entry
+        self._entries = {}
+
+    ####################################################################################################################
+    def __len__(self):
+        return len(self._entries)
+
+    ####################################################################################################################
+    def __contains__(self, plan_id):
+        return plan_id in self._entries
+
+    ####################################################################################################################
+    def set(self, plan_id, occurrence, priority=None):
+        entry = (occurrence, priority, plan_id)
+        if self._entries.get(plan_id) != entry:
+            self._entries[plan_id] = entry
+            heapq.heappush(self._heap, entry)
+
+    ####################################################################################################################
+    def remove(self, plan_id):
+        self._entries.pop(plan_id, None)
+
+    ####################################################################################################################
+    def next_occurrence(self):
+        self._drop_stale()
+        if self._heap:
+            return self._heap[0][0]
+
+    ####################################################################################################################
+    def pop_due(self, now):
+        """
+        Removes and returns ids of plans occurring at or before now
+        """
+        due = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            del self._entries[entry[2]]
+            due.append(entry[2])
+            self._drop_stale()
+
+        return due
+
+    ####################################################################################################################
+    def _drop_stale(self):
+        while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0]:
+            heapq.heappop(self._heap)
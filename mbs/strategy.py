@@ -11,12 +11,13 @@ import re
 from mbs import get_mbs
 
 
+import persistence
 from persistence import update_backup, update_restore
 from mongo_utils import (
     MongoCluster, MongoServer, ShardedClusterConnector,
     MongoNormalizedVersion, build_mongo_connector)
 
-from date_utils import timedelta_total_seconds, date_now, mid_date_between, date_plus_seconds
+from date_utils import timedelta_total_seconds, date_now, mid_date_between, date_plus_seconds, date_to_seconds
 
 from subprocess import CalledProcessError
 from errors import *
@@ -27,11 +28,13 @@ from source import CompositeBlockStorage, is_snapshot_volume_encrypted
 
 from target import (
     SnapshotStatus, multi_target_upload_file,
-    EbsSnapshotReference, CompositeBlockStorageSnapshotReference
+    EbsSnapshotReference, CompositeBlockStorageSnapshotReference,
+    MultipartUploadState
 )
+from compression import get_codec, strip_extension
 
 
-from globals import EventType
+from globals import EventType, State
 from robustify.robustify import robustify
 from naming_scheme import *
 from threading import Thread
@@ -57,15 +60,30 @@ EVENT_END_ARCHIVE = "END_ARCHIVE"
 EVENT_START_UPLOAD = "START_UPLOAD"
 EVENT_END_UPLOAD = "END_UPLOAD"
 
+EVENT_SELECT_FULL_DUMP = "SELECT_FULL_DUMP"
+EVENT_SELECT_INCREMENTAL = "SELECT_INCREMENTAL"
+EVENT_START_REPLAY_INCREMENTAL = "START_REPLAY_INCREMENTAL"
+EVENT_END_REPLAY_INCREMENTAL = "END_REPLAY_INCREMENTAL"
+
 # max time to wait for balancer to stop (10 minutes)
 MAX_BALANCER_STOP_WAIT = 30 * 60
 
 # default max lag
 DEFAULT_MAX_LAG = 5 * 60
 
+# collections dumped/restored in parallel when the number of cores of the
+# server is unknown (same as mongodump's default)
+DEFAULT_DUMP_CONCURRENCY = 4
+MAX_DEFAULT_DUMP_CONCURRENCY = 8
+
+# incremental backups chained to a full dump (i.e. a daily full dump for
+# hourly plans)
+DEFAULT_MAX_INCREMENTALS = 23
+
 ###############################################################################
 VERSION_2_6 = MongoNormalizedVersion("2.6.0")
 VERSION_3_0 = MongoNormalizedVersion("3.0.0")
+VERSION_3_2 = MongoNormalizedVersion("3.2.0")
 
 ###############################################################################
 # Member preference values
@@ -134,6 +152,7 @@ class BackupStrategy(MBSObject):
         self._no_index_restore = None
         self._no_users_restore = None
         self._no_roles_restore = None
+        self._stream_restore = None
 
     ###########################################################################
     def _init_strategy(self, backup):
@@ -289,6 +308,20 @@ class BackupStrategy(MBSObject):
     def no_roles_restore(self, val):
         self._no_roles_restore = val
 
+    ###########################################################################
+    @property
+    def stream_restore(self):
+        """
+            When set, restores download the backup file with concurrent range
+            requests straight into the extract command instead of writing the
+            file to disk first
+        """
+        return self._stream_restore
+
+    @stream_restore.setter
+    def stream_restore(self, val):
+        self._stream_restore = val
+
     ###########################################################################
     def is_use_suspend_io(self):
         return False
@@ -558,6 +591,9 @@ class BackupStrategy(MBSObject):
         rs_conf = None
         rs_status = None
         error_type = error_type or NoEligibleMembersFound
+        # members may have changed since the topology was cached
+        if isinstance(mongo_cluster, MongoCluster):
+            mongo_cluster.invalidate_topology()
         try:
             rs_status = mongo_cluster.primary_member.get_rs_status()
         finally:
@@ -734,10 +770,13 @@ class BackupStrategy(MBSObject):
         try:
             if (self.backup_mode == BackupMode.ONLINE and
                     mongo_connector.is_online()):
+                start = time.time()
                 backup.source_stats = mongo_connector.get_stats(
                     only_for_db=dbname)
+                backup.data_stats["sourceStatsDurationInSeconds"] = \
+                    round(time.time() - start, 2)
                 # save source stats
-                update_backup(backup, properties="sourceStats",
+                update_backup(backup, properties=["sourceStats", "dataStats"],
                               event_name="COMPUTED_SOURCE_STATS",
                               message="Computed source stats")
 
@@ -1138,6 +1177,9 @@ class BackupStrategy(MBSObject):
         if self.no_roles_restore is not None:
             doc["noRolesRestore"] = self.no_roles_restore
 
+        if self.stream_restore is not None:
+            doc["streamRestore"] = self.stream_restore
+
         return doc
 
 ###############################################################################
@@ -1152,6 +1194,9 @@ class DumpStrategy(BackupStrategy):
         self._dump_users = None
         self._dump_options_overrides = None
         self._restore_options_overrides = None
+        self._stream_to_target = None
+        self._compression = None
+        self._dump_concurrency = None
 
     ###########################################################################
     @property
@@ -1190,6 +1235,52 @@ class DumpStrategy(BackupStrategy):
     def restore_options_overrides(self, val):
         self._restore_options_overrides = val
 
+    ###########################################################################
+    @property
+    def stream_to_target(self):
+        """
+            When set, mongodump archive output is uploaded to the target while
+            the dump is running instead of being dumped, tarred and uploaded
+            from disk
+        """
+        return self._stream_to_target
+
+    @stream_to_target.setter
+    def stream_to_target(self, val):
+        self._stream_to_target = val
+
+    ###########################################################################
+    @property
+    def compression(self):
+        """
+            Compression codec of backup archives (see mbs.compression).
+            Defaults to gzip
+        """
+        return self._compression
+
+    @compression.setter
+    def compression(self, val):
+        self._compression = val
+
+    ###########################################################################
+    @property
+    def compression_codec(self):
+        return get_codec(self.compression)
+
+    ###########################################################################
+    @property
+    def dump_concurrency(self):
+        """
+            Number of collections dumped/restored in parallel
+            (--numParallelCollections). Defaults to half the cores of the
+            server being dumped/restored to
+        """
+        return self._dump_concurrency
+
+    @dump_concurrency.setter
+    def dump_concurrency(self, val):
+        self._dump_concurrency = val
+
     ###########################################################################
     def to_document(self, display_only=False):
         doc = BackupStrategy.to_document(self, display_only=display_only)
@@ -1203,6 +1294,15 @@ class DumpStrategy(BackupStrategy):
         if self.dump_users is not None:
             doc["dumpUsers"] = self.dump_users
 
+        if self.stream_to_target is not None:
+            doc["streamToTarget"] = self.stream_to_target
+
+        if self.compression is not None:
+            doc["compression"] = self.compression
+
+        if self.dump_concurrency is not None:
+            doc["dumpConcurrency"] = self.dump_concurrency
+
         return doc
 
     ###########################################################################
@@ -1215,6 +1315,10 @@ class DumpStrategy(BackupStrategy):
         # create backup workspace
         self._create_backup_workspace(backup)
 
+        if self._is_stream_dump(backup, mongo_connector):
+            self._do_stream_dump(backup, mongo_connector)
+            return
+
         # run mongoctl dump
         if not backup.is_event_logged(EVENT_END_EXTRACT):
             try:
@@ -1242,30 +1346,98 @@ class DumpStrategy(BackupStrategy):
         if not backup.is_event_logged(EVENT_END_UPLOAD):
             self._upload_dump(backup)
 
+    ###########################################################################
+    def _is_stream_dump(self, backup, mongo_connector):
+        """
+            Returns true if the backup should be (or has been) dumped by
+            streaming to the target
+        """
+        # once dumped, stick to the mode that was used
+        if backup.is_event_logged(EVENT_END_EXTRACT):
+            return "streamedBytes" in backup.data_stats
+
+        if not self.stream_to_target:
+            return False
+
+        if backup.secondary_targets:
+            logger.info("Backup '%s' has secondary targets. Streaming dumps"
+                        " only support a single target. Falling back to"
+                        " regular dump" % backup.id)
+            return False
+
+        if not backup.target.supports_stream_upload():
+            logger.info("Target '%s' of backup '%s' does not support stream "
+                        "uploads. Falling back to regular dump" %
+                        (backup.target.target_type, backup.id))
+            return False
+
+        if (isinstance(mongo_connector, MongoServer) and
+                mongo_connector.get_mongo_version() < VERSION_3_2):
+            logger.info("mongodump --archive requires mongo 3.2 or later."
+                        " Falling back to regular dump for backup '%s'" %
+                        backup.id)
+            return False
+
+        return True
+
+    ###########################################################################
+    def _do_stream_dump(self, backup, mongo_connector):
+        source = backup.source
+
+        if not backup.is_event_logged(EVENT_END_EXTRACT):
+            try:
+                self.stream_dump_backup(backup, mongo_connector,
+                                        database_name=source.database_name)
+                self._upload_dump_log_file(backup)
+            except DumpError, e:
+                # nothing to tar for streamed dumps, just keep the dump logs
+                logger.error("Stream dumping backup '%s' failed. Will still"
+                             " upload dump logs" % backup.id)
+                msg = "Dump failed. Will upload the dump log"
+                update_backup(backup, event_type=EventType.ERROR, message=msg,
+                              error_code=to_mbs_error_code(e))
+                self._upload_dump_log_file(backup)
+                raise
+
+        if not backup.is_event_logged(EVENT_END_UPLOAD):
+            update_backup(backup, event_name=EVENT_END_UPLOAD,
+                          message="Upload completed!")
+
     ###########################################################################
     def _archive_dump(self, backup):
         dump_dir = _backup_dump_dir_name(backup)
-        tar_filename = _tar_file_name(backup)
-        logger.info("Taring dump %s to %s" % (dump_dir, tar_filename))
-        update_backup(backup,
+        codec = self.compression_codec
+        tar_filename = _tar_file_name(backup, codec)
+        logger.info("Taring dump %s to %s (%s compression)" %
+                    (dump_dir, tar_filename, codec.name))
+        # a new tar file can not resume uploads of a previous one
+        backup.multipart_uploads = None
+        update_backup(backup, properties="multipartUploads",
                       event_name=EVENT_START_ARCHIVE,
                       message="Taring dump")
 
-        self.backup_assistant.tar_backup(backup, dump_dir, tar_filename)
+        tar_info = self.backup_assistant.tar_backup(backup, dump_dir,
+                                                    tar_filename,
+                                                    compression=codec.name)
 
-        update_backup(backup,
+        backup.data_stats["compression"] = codec.name
+        if tar_info:
+            backup.data_stats.update(_compression_stats(tar_info))
+
+        update_backup(backup, properties="dataStats",
                       event_name=EVENT_END_ARCHIVE,
                       message="Taring completed")
 
     ###########################################################################
     def _upload_dump(self, backup):
-        tar_file_name = _tar_file_name(backup)
+        codec = self.compression_codec
+        tar_file_name = _tar_file_name(backup, codec)
         logger.info("Uploading %s to target" % tar_file_name)
 
         update_backup(backup,
                       event_name=EVENT_START_UPLOAD,
                       message="Upload tar to target")
-        upload_dest_path = _upload_file_dest(backup)
+        upload_dest_path = _upload_file_dest(backup, codec)
 
         all_targets = [backup.target]
 
@@ -1274,13 +1446,19 @@ class DumpStrategy(BackupStrategy):
 
         # Upload to all targets simultaneously
 
+        upload_states = self._get_multipart_upload_states(backup, all_targets, upload_dest_path)
         target_references = self.backup_assistant.upload_backup(backup, tar_file_name, all_targets,
-                                                                destination_path=upload_dest_path)
+                                                                destination_path=upload_dest_path,
+                                                                upload_states=upload_states)
 
         if len(target_references) != len(all_targets):
             raise TargetUploadError("Upload target mismatch! requested to upload to %s targets and got %s target"
                                     " references back" % (len(all_targets), len(target_references)))
 
+        # record the codec so that restores pick the matching decompressor
+        for reference in target_references:
+            reference.compression = codec.name
+
         # set the target reference
         target_reference = target_references[0]
 
@@ -1293,8 +1471,12 @@ class DumpStrategy(BackupStrategy):
         if backup.secondary_targets:
             backup.secondary_target_references = target_references[1:]
 
+        # uploads are complete, nothing to resume anymore
+        backup.multipart_uploads = None
+
         update_backup(backup, properties=["targetReference",
-                                          "secondaryTargetReferences"],
+                                          "secondaryTargetReferences",
+                                          "multipartUploads"],
                       event_name=EVENT_END_UPLOAD,
                       message="Upload completed!")
 
@@ -1306,6 +1488,34 @@ class DumpStrategy(BackupStrategy):
                 logger.error("Exception while deleting failed backup file: %s"
                              % ex)
 
+    ###########################################################################
+    def _get_multipart_upload_states(self, backup, targets, destination_path):
+        """
+            Returns the multipart upload state of each target, creating
+            missing ones. States are saved to the backup as parts get uploaded
+            so that a retried/recovered backup resumes the uploads
+        """
+        def save_upload_states(upload_state):
+            # coalesced since a part or two more to upload on resume is ok.
+            # states are exported when written so the latest one wins
+            update_backup(backup, properties="multipartUploads",
+                          coalesce=True)
+
+        upload_states = []
+        for target in targets:
+            upload_state = backup.get_multipart_upload(target.container_name,
+                                                       destination_path)
+            if not upload_state:
+                upload_state = MultipartUploadState()
+                upload_state.container_name = target.container_name
+                upload_state.destination_path = destination_path
+                backup.multipart_uploads = (backup.multipart_uploads or []) + [upload_state]
+
+            upload_state.progress_listener = save_upload_states
+            upload_states.append(upload_state)
+
+        return upload_states
+
     ###########################################################################
     def _upload_dump_log_file(self, backup):
         log_file_name = _log_file_name(backup)
@@ -1336,11 +1546,13 @@ class DumpStrategy(BackupStrategy):
                       message="Taring failed dump")
 
         dump_dir = _backup_dump_dir_name(backup)
-        failed_tar_filename = _failed_tar_file_name(backup)
+        codec = self.compression_codec
+        failed_tar_filename = _failed_tar_file_name(backup, codec)
 
-        failed_dest = _failed_upload_file_dest(backup)
+        failed_dest = _failed_upload_file_dest(backup, codec)
         # tar up
-        self.backup_assistant.tar_backup(backup, dump_dir, failed_tar_filename)
+        self.backup_assistant.tar_backup(backup, dump_dir, failed_tar_filename,
+                                         compression=codec.name)
         update_backup(backup,
                       event_name="ERROR_HANDLING_END_TAR",
                       message="Finished taring failed dump")
@@ -1354,6 +1566,7 @@ class DumpStrategy(BackupStrategy):
         # upload failed tar file and allow overwriting existing
         target_reference = self.backup_assistant.upload_backup(backup, failed_tar_filename, backup.target,
                                                                destination_path=failed_dest)
+        target_reference.compression = codec.name
         backup.target_reference = target_reference
 
         update_backup(backup, properties="targetReference",
@@ -1366,6 +1579,76 @@ class DumpStrategy(BackupStrategy):
         update_backup(backup, event_name=EVENT_START_EXTRACT,
                       message="Dumping backup")
 
+        uri, dump_options = self._get_dump_uri_and_options(
+            mongo_connector, database_name=database_name)
+
+        # DUMP command
+        destination = _backup_dump_dir_name(backup)
+
+        log_file_name = _log_file_name(backup)
+        # execute dump command
+        dump_info = self.backup_assistant.dump_backup(backup, uri, destination, log_file_name, options=dump_options)
+        if dump_info and "dumpCollectionCounts" in dump_info:
+            backup.data_stats["dumpCollectionCounts"] = dump_info["dumpCollectionCounts"]
+
+        if dump_info and "dumpCollectionDurations" in dump_info:
+            backup.data_stats["dumpCollectionDurations"] = dump_info["dumpCollectionDurations"]
+
+        update_backup(backup, properties="dataStats",
+                      event_name=EVENT_END_EXTRACT,
+                      message="Dump completed")
+
+    ###########################################################################
+    def stream_dump_backup(self, backup, mongo_connector, database_name=None):
+
+        update_backup(backup, event_name=EVENT_START_EXTRACT,
+                      message="Dumping backup (streaming to target)")
+
+        uri, dump_options = self._get_dump_uri_and_options(
+            mongo_connector, database_name=database_name)
+        dump_options.append("--gzip")
+
+        update_backup(backup, event_name=EVENT_START_UPLOAD,
+                      message="Streaming dump to target")
+
+        failed_reference = backup.target_reference
+
+        stream_info = self.backup_assistant.stream_dump_backup(
+            backup, uri, _backup_dump_dir_name(backup), _log_file_name(backup),
+            backup.target, _upload_archive_file_dest(backup),
+            options=dump_options)
+
+        backup.target_reference = stream_info["targetReference"]
+
+        streamed_bytes = stream_info["streamedBytes"]
+        duration = stream_info["streamDurationInSeconds"] or 0
+        backup.data_stats["streamedBytes"] = streamed_bytes
+        backup.data_stats["streamDurationInSeconds"] = duration
+        if "dumpCollectionDurations" in stream_info:
+            backup.data_stats["dumpCollectionDurations"] = stream_info["dumpCollectionDurations"]
+        if duration:
+            backup.data_stats["streamThroughputInMBPerSecond"] = \
+                round(float(streamed_bytes) / (1024 * 1024) / duration, 2)
+
+        update_backup(backup, properties=["targetReference", "dataStats"],
+                      event_name=EVENT_END_EXTRACT,
+                      message="Dump completed (%s bytes streamed in %.1f"
+                              " seconds)" % (streamed_bytes, duration))
+
+        # remove failed reference if exists
+        if failed_reference:
+            try:
+                backup.target.delete_file(failed_reference)
+            except Exception, ex:
+                logger.error("Exception while deleting failed backup file: %s"
+                             % ex)
+
+    ###########################################################################
+    def _get_dump_uri_and_options(self, mongo_connector, database_name=None):
+        """
+            Returns the dump uri and the mongoctl dump options for the
+            specified connector
+        """
         # only mongo servers
 
         if not isinstance(mongo_connector, MongoServer):
@@ -1378,9 +1661,6 @@ class DumpStrategy(BackupStrategy):
                 uri += "/"
             uri += database_name
 
-        # DUMP command
-        destination = _backup_dump_dir_name(backup)
-
         dump_options = []
         # Add --journal for config server backup
         if mongo_connector.is_config_server():
@@ -1411,18 +1691,28 @@ class DumpStrategy(BackupStrategy):
                     self.dump_users is not False):
             dump_options.append("--dumpDbUsersAndRoles")
 
+        # dump collections in parallel for 3.0 dumps
+        if mongo_version >= VERSION_3_0:
+            dump_options.extend([
+                "--numParallelCollections",
+                str(self._get_dump_concurrency(mongo_connector))
+            ])
+
         # apply overrides
         self._apply_dump_options_overrides(dump_options)
 
-        log_file_name = _log_file_name(backup)
-        # execute dump command
-        dump_info = self.backup_assistant.dump_backup(backup, uri, destination, log_file_name, options=dump_options)
-        if dump_info and "dumpCollectionCounts" in dump_info:
-            backup.data_stats["dumpCollectionCounts"] = dump_info["dumpCollectionCounts"]
+        return uri, dump_options
 
-        update_backup(backup, properties="dataStats",
-                      event_name=EVENT_END_EXTRACT,
-                      message="Dump completed")
+    ###########################################################################
+    def _get_dump_concurrency(self, mongo_connector):
+        if self.dump_concurrency:
+            return self.dump_concurrency
+
+        num_cores = mongo_connector.get_num_cores()
+        if not num_cores:
+            return DEFAULT_DUMP_CONCURRENCY
+
+        return max(1, min(num_cores / 2, MAX_DEFAULT_DUMP_CONCURRENCY))
 
     ###########################################################################
     def _needs_new_member_selection(self, backup):
@@ -1449,11 +1739,24 @@ class DumpStrategy(BackupStrategy):
 
         logger.info("Running dump restore '%s'" % restore.id)
         self.backup_assistant.create_task_workspace(restore)
-        # download source backup tar
-        if not restore.is_event_logged("END_DOWNLOAD_BACKUP"):
+
+        file_reference = restore.source_backup.target_reference
+        is_archive = _is_archive_file_reference(file_reference)
+        is_stream_restore = self._is_stream_restore(restore)
+
+        if (is_stream_restore and not is_archive and
+                not restore.is_event_logged("END_EXTRACT_BACKUP")):
+            self._stream_download_and_extract_source_backup(restore)
+
+        # download source backup tar. streamed archives are downloaded
+        # straight into mongorestore
+        if (not restore.is_event_logged("END_DOWNLOAD_BACKUP") and
+                not (is_stream_restore and is_archive)):
             self._download_source_backup(restore)
 
-        if not restore.is_event_logged("END_EXTRACT_BACKUP"):
+        # archives are restored as is
+        if (not restore.is_event_logged("END_EXTRACT_BACKUP") and
+                not is_archive):
             # extract tar
             self._extract_source_backup(restore)
 
@@ -1469,15 +1772,23 @@ class DumpStrategy(BackupStrategy):
             raise
 
 
+    ###########################################################################
+    def _is_stream_restore(self, restore):
+        return (self.stream_restore and
+                restore.source_backup.target.supports_stream_download())
+
     ###########################################################################
     def _download_source_backup(self, restore):
         update_restore(restore, event_name="START_DOWNLOAD_BACKUP",
                        message="Download source backup file...")
 
+        start = time.time()
         self.backup_assistant.download_restore_source_backup(restore)
+        file_size = restore.source_backup.target_reference.file_size
 
         update_restore(restore, event_name="END_DOWNLOAD_BACKUP",
-                       message="Source backup file download complete!")
+                       message="Source backup file download complete!",
+                       details=_throughput_details(file_size, time.time() - start))
 
 
     ###########################################################################
@@ -1485,10 +1796,36 @@ class DumpStrategy(BackupStrategy):
         update_restore(restore, event_name="START_EXTRACT_BACKUP",
                        message="Extract backup file...")
 
+        start = time.time()
         self.backup_assistant.extract_restore_source_backup(restore)
+        file_size = restore.source_backup.target_reference.file_size
+
+        update_restore(restore, event_name="END_EXTRACT_BACKUP",
+                       message="Extract backup file completed!",
+                       details=_throughput_details(file_size, time.time() - start))
 
+    ###########################################################################
+    def _stream_download_and_extract_source_backup(self, restore):
+        """
+            Downloads and extracts in one pass. The backup file never lands
+            on disk
+        """
+        update_restore(restore, event_name="START_DOWNLOAD_BACKUP",
+                       message="Streaming source backup file download into "
+                               "extract...")
+        update_restore(restore, event_name="START_EXTRACT_BACKUP",
+                       message="Extract backup file stream...")
+
+        stream_info = self.backup_assistant.stream_extract_restore_source_backup(restore)
+
+        details = _throughput_details(stream_info["downloadedBytes"],
+                                      stream_info["durationInSeconds"])
+        update_restore(restore, event_name="END_DOWNLOAD_BACKUP",
+                       message="Source backup file download complete!",
+                       details=details)
         update_restore(restore, event_name="END_EXTRACT_BACKUP",
-                       message="Extract backup file completed!")
+                       message="Extract backup file stream completed!",
+                       details=details)
 
     ###########################################################################
     def _restore_dump(self, restore):
@@ -1500,7 +1837,8 @@ class DumpStrategy(BackupStrategy):
 
         # run mongoctl restore
         logger.info("Restoring using mongoctl restore")
-        dump_dir = file_reference.file_name[: -4]
+        dump_dir = strip_extension(file_reference.file_name,
+                                   get_codec(file_reference.compression))
 
 
 
@@ -1577,7 +1915,10 @@ class DumpStrategy(BackupStrategy):
         # stop on errors for 3.0 restores
         if dest_mongo_version >= VERSION_3_0:
             restore_options.append("--stopOnError")
-            restore_options.extend(["--numParallelCollections", "1"])
+            restore_options.extend([
+                "--numParallelCollections",
+                str(self._get_dump_concurrency(mongo_connector))
+            ])
 
         # additional restore options
         if self.no_index_restore:
@@ -1585,6 +1926,13 @@ class DumpStrategy(BackupStrategy):
 
         restore_options = self._apply_restore_options_overrides(restore_options)
 
+        if _is_archive_file_reference(file_reference):
+            self._restore_archive(restore, dest_uri, file_reference,
+                                  source_database_name, restore_options,
+                                  exclude_admin_system_users=exclude_admin_system_users,
+                                  exclude_system_roles=exclude_system_roles)
+            return
+
         # execute dump command
         restore_info = self.backup_assistant.run_mongo_restore(
             restore, dest_uri, dump_dir, source_database_name,
@@ -1602,6 +1950,64 @@ class DumpStrategy(BackupStrategy):
                        message="Restoring dump completed!")
 
 
+    ###########################################################################
+    def _restore_archive(self, restore, dest_uri, file_reference,
+                         source_database_name, restore_options,
+                         exclude_admin_system_users=False,
+                         exclude_system_roles=False):
+        """
+            Restores a streamed (mongodump --archive) backup. Excluded
+            collections are skipped through --nsExclude. Per database
+            system.users are not excluded since archives are only produced
+            from >= 3.2 sources. Archives keep their source namespaces so
+            restoring into another database renames them with --nsFrom/--nsTo
+        """
+        restore_options = list(restore_options)
+        if source_database_name:
+            restore_options.extend(["--nsInclude", "%s.*" % source_database_name])
+            dest_database_name = mongo_uri_tools.parse_mongo_uri(dest_uri).database
+            if dest_database_name and dest_database_name != source_database_name:
+                restore_options.extend([
+                    "--nsFrom", "%s.*" % source_database_name,
+                    "--nsTo", "%s.*" % dest_database_name
+                ])
+
+        if exclude_admin_system_users:
+            restore_options.extend(["--nsExclude", "admin.system.users"])
+
+        if exclude_system_roles:
+            restore_options.extend(["--nsExclude", "admin.system.roles"])
+
+        if self._is_stream_restore(restore):
+            self._stream_restore_archive(restore, dest_uri, restore_options)
+        else:
+            self.backup_assistant.run_mongo_archive_restore(
+                restore, dest_uri, file_reference.file_name,
+                _restore_log_file_name(restore), options=restore_options)
+
+        update_restore(restore, event_name="END_RESTORE_DUMP",
+                       message="Restoring archive completed!")
+
+    ###########################################################################
+    def _stream_restore_archive(self, restore, dest_uri, restore_options):
+        """
+            Feeds mongorestore from the download stream. Nothing is written
+            to the workspace except the restore log
+        """
+        update_restore(restore, event_name="START_DOWNLOAD_BACKUP",
+                       message="Streaming source backup archive download "
+                               "into mongorestore...")
+
+        stream_info = self.backup_assistant.stream_mongo_archive_restore(
+            restore, dest_uri, _restore_log_file_name(restore),
+            options=restore_options)
+
+        update_restore(restore, event_name="END_DOWNLOAD_BACKUP",
+                       message="Source backup archive download complete!",
+                       details=_throughput_details(
+                           stream_info["downloadedBytes"],
+                           stream_info["durationInSeconds"]))
+
     ###########################################################################
     def get_restore_mongo_connector(self, restore):
         logger.info("Selecting connector to run restore '%s'" % restore.id)
@@ -1628,7 +2034,9 @@ class DumpStrategy(BackupStrategy):
                            event_name="READ_DUMP_COLLECTION_COUNTS",
                            message="Reading mongodump collection counts for validation")
 
+            start = time.time()
             restore.data_stats["destinationCollectionCounts"] = self.get_destination_collection_counts(restore)
+            restore.data_stats["destinationCollectionCountsDurationInSeconds"] = round(time.time() - start, 2)
             update_restore(restore, properties="dataStats",
                            event_name="GET_DEST_COLLECTION_COUNTS",
                            message="Reading destination collection counts for validation")
@@ -1783,12 +2191,12 @@ def _log_file_name(backup):
     return "%s.log" % _backup_dump_dir_name(backup)
 
 ###############################################################################
-def _tar_file_name(backup):
-    return "%s.tgz" % _backup_dump_dir_name(backup)
+def _tar_file_name(backup, codec):
+    return "%s.%s" % (_backup_dump_dir_name(backup), codec.extension)
 
 ###############################################################################
-def _failed_tar_file_name(backup):
-    return "FAILED_%s.tgz" % _backup_dump_dir_name(backup)
+def _failed_tar_file_name(backup, codec):
+    return "FAILED_%s.%s" % (_backup_dump_dir_name(backup), codec.extension)
 
 ###############################################################################
 def _backup_dump_dir_name(backup):
@@ -1798,8 +2206,16 @@ def _backup_dump_dir_name(backup):
     return os.path.basename(backup.name)
 
 ###############################################################################
-def _upload_file_dest(backup):
-    return "%s.tgz" % backup.name
+def _upload_file_dest(backup, codec):
+    return "%s.%s" % (backup.name, codec.extension)
+
+###############################################################################
+def _upload_archive_file_dest(backup):
+    return "%s.archive.gz" % backup.name
+
+###############################################################################
+def _is_archive_file_reference(file_reference):
+    return file_reference.file_path.endswith(".archive.gz")
 
 ###############################################################################
 def _upload_log_file_dest(backup):
@@ -1814,17 +2230,321 @@ def _upload_restore_log_file_dest(restore):
     return "%s%sRESTORE_%s" % (parts[0], parts[1], parts[2])
 
 ###############################################################################
-def _failed_upload_file_dest(backup):
-    dest =  "%s.tgz" % backup.name
+def _failed_upload_file_dest(backup, codec):
+    dest =  "%s.%s" % (backup.name, codec.extension)
     # append FAILED as a prefix for the file name  + handle the case where
     # backup name is a path (as appose to just a file name)
     parts = dest.rpartition("/")
     return "%s%sFAILED_%s" % (parts[0], parts[1], parts[2])
 
+###############################################################################
+def _compression_stats(tar_info):
+    dump_size = tar_info["dumpSize"]
+    archive_size = tar_info["archiveSize"]
+    duration = tar_info["durationInSeconds"]
+    stats = {}
+    if archive_size:
+        stats["compressionRatio"] = round(float(dump_size) / archive_size, 2)
+    if duration:
+        stats["compressionThroughputInMBPerSecond"] = \
+            round(float(dump_size) / (1024 * 1024) / duration, 2)
+
+    return stats
+
+###############################################################################
+def _throughput_details(size_in_bytes, duration_in_seconds):
+    details = {
+        "bytes": size_in_bytes,
+        "durationInSeconds": round(duration_in_seconds, 2)
+    }
+    if size_in_bytes and duration_in_seconds:
+        details["throughputInMBPerSecond"] = \
+            round(float(size_in_bytes) / (1024 * 1024) / duration_in_seconds, 2)
+
+    return details
+
 ###############################################################################
 def _restore_log_file_name(restore):
     return "RESTORE_%s.log" % _backup_dump_dir_name(restore.source_backup)
 
+###############################################################################
+# IncrementalOplogStrategy
+###############################################################################
+class IncrementalOplogStrategy(DumpStrategy):
+    """
+        Backups between full dumps only capture the oplog since the previous
+        backup of the plan. Each incremental is chained to the previous backup
+        and to the full dump (base backup) the chain starts with.
+        Restoring an incremental restores the base then replays the oplog of
+        every incremental up to it
+    """
+    ###########################################################################
+    def __init__(self):
+        DumpStrategy.__init__(self)
+        self._max_incrementals = None
+
+    ###########################################################################
+    @property
+    def max_incrementals(self):
+        """
+            Max number of incremental backups chained to a full dump before
+            taking a new full dump
+        """
+        return self._max_incrementals
+
+    @max_incrementals.setter
+    def max_incrementals(self, val):
+        self._max_incrementals = val
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = DumpStrategy.to_document(self, display_only=display_only)
+        doc.update({
+            "_type": "IncrementalOplogStrategy"
+        })
+
+        if self.max_incrementals is not None:
+            doc["maxIncrementals"] = self.max_incrementals
+
+        return doc
+
+    ###########################################################################
+    def do_backup_mongo_connector(self, backup, mongo_connector):
+        """
+            Override
+        """
+        if not (backup.is_event_logged(EVENT_SELECT_FULL_DUMP) or
+                backup.is_event_logged(EVENT_SELECT_INCREMENTAL)):
+            self._select_backup_type(backup, mongo_connector)
+
+        if not backup.is_incremental():
+            DumpStrategy.do_backup_mongo_connector(self, backup, mongo_connector)
+            return
+
+        self._create_backup_workspace(backup)
+
+        if not backup.is_event_logged(EVENT_END_EXTRACT):
+            self._dump_oplog(backup, mongo_connector)
+
+        if not backup.is_event_logged(EVENT_END_ARCHIVE):
+            self._archive_dump(backup)
+
+        if not backup.is_event_logged(EVENT_END_UPLOAD):
+            self._upload_dump(backup)
+
+    ###########################################################################
+    def _select_backup_type(self, backup, mongo_connector):
+        """
+            Chains the backup to the previous backup of the plan if possible.
+            Otherwise, a full dump is taken
+        """
+        if not self._is_incremental_capable(backup, mongo_connector):
+            update_backup(backup, event_name=EVENT_SELECT_FULL_DUMP,
+                          message="Full dump (incremental backups are only "
+                                  "supported for replica set server backups)")
+            return
+
+        # oplog entries after this point are not in the dump for sure
+        backup.oplog_end_ts = mongo_connector.get_oplog_last_ts()
+
+        previous_backup = self._get_previous_backup(backup)
+        if previous_backup:
+            base_backup_id = previous_backup.base_backup_id or previous_backup.id
+            if self._get_chain_length(base_backup_id) >= self._get_max_incrementals():
+                logger.info("Max incrementals reached for base backup '%s'" %
+                            base_backup_id)
+                previous_backup = None
+            elif mongo_connector.get_oplog_first_ts() > previous_backup.oplog_end_ts:
+                msg = ("Oplog does not go back to previous backup '%s'. Taking"
+                       " a full dump instead" % previous_backup.id)
+                logger.warning(msg)
+                update_backup(backup, event_type=EventType.WARNING,
+                              event_name="OPLOG_GAP_WARNING", message=msg)
+                previous_backup = None
+
+        if not previous_backup:
+            update_backup(backup, properties="oplogEndTs",
+                          event_name=EVENT_SELECT_FULL_DUMP,
+                          message="Full dump")
+            return
+
+        backup.base_backup_id = previous_backup.base_backup_id or previous_backup.id
+        backup.previous_backup_id = previous_backup.id
+        backup.oplog_start_ts = previous_backup.oplog_end_ts
+
+        update_backup(backup, properties=["baseBackupId", "previousBackupId",
+                                          "oplogStartTs", "oplogEndTs"],
+                      event_name=EVENT_SELECT_INCREMENTAL,
+                      message="Incremental backup of the oplog since backup "
+                              "'%s'" % previous_backup.id)
+
+    ###########################################################################
+    def _is_incremental_capable(self, backup, mongo_connector):
+        return (backup.plan is not None and
+                not backup.source.database_name and
+                isinstance(mongo_connector, MongoServer) and
+                mongo_connector.is_replica_member())
+
+    ###########################################################################
+    def _get_previous_backup(self, backup):
+        q = {
+            "plan._id": backup.plan.id,
+            "state": State.SUCCEEDED,
+            "expiredDate": None,
+            "oplogEndTs": {"$exists": True}
+        }
+
+        return get_mbs().backup_collection.find_one(q, sort=[("createdDate", -1)])
+
+    ###########################################################################
+    def _get_chain_length(self, base_backup_id):
+        q = {
+            "baseBackupId": base_backup_id,
+            "state": State.SUCCEEDED
+        }
+        return get_mbs().backup_collection.collection.find(q).count()
+
+    ###########################################################################
+    def _get_max_incrementals(self):
+        if self.max_incrementals is None:
+            return DEFAULT_MAX_INCREMENTALS
+        return self.max_incrementals
+
+    ###########################################################################
+    def _dump_oplog(self, backup, mongo_connector):
+        update_backup(backup, event_name=EVENT_START_EXTRACT,
+                      message="Dumping oplog")
+
+        options = []
+        if mongo_connector.get_mongo_version() >= MongoNormalizedVersion("2.4.0"):
+            options.extend(["--authenticationDatabase", "admin"])
+
+        try:
+            dump_info = self.backup_assistant.dump_oplog(
+                backup, mongo_connector.dump_uri(),
+                _backup_dump_dir_name(backup), _log_file_name(backup),
+                backup.oplog_start_ts, backup.oplog_end_ts, options=options)
+        except DumpError, e:
+            logger.error("Dumping oplog for backup '%s' failed. Will still "
+                         "upload dump logs" % backup.id)
+            update_backup(backup, event_type=EventType.ERROR,
+                          message="Oplog dump failed. Will upload the dump log",
+                          error_code=to_mbs_error_code(e))
+            self._upload_dump_log_file(backup)
+            raise
+
+        if dump_info and "dumpCollectionDurations" in dump_info:
+            backup.data_stats["dumpCollectionDurations"] = dump_info["dumpCollectionDurations"]
+
+        self._upload_dump_log_file(backup)
+
+        update_backup(backup, properties="dataStats",
+                      event_name=EVENT_END_EXTRACT,
+                      message="Oplog dump completed")
+
+    ###########################################################################
+    # Restore implementation
+    ###########################################################################
+    def _do_run_restore(self, restore):
+        source_backup = restore.source_backup
+        if not source_backup.is_incremental():
+            DumpStrategy._do_run_restore(self, restore)
+            return
+
+        chain = self._get_restore_chain(restore)
+        logger.info("Restoring incremental backup '%s' from chain %s" %
+                    (source_backup.id, [b.id for b in chain]))
+
+        # restore the base using the regular dump restore
+        try:
+            restore.source_backup = chain[0]
+            DumpStrategy._do_run_restore(self, restore)
+        finally:
+            restore.source_backup = source_backup
+
+        incrementals = chain[1:]
+        replayed_count = restore.event_logged_count(EVENT_END_REPLAY_INCREMENTAL)
+        for i, incremental in enumerate(incrementals):
+            if i < replayed_count:
+                continue
+
+            oplog_limit = None
+            if restore.point_in_time and i == len(incrementals) - 1:
+                oplog_limit = date_to_seconds(restore.point_in_time)
+
+            self._replay_incremental(restore, incremental,
+                                     oplog_limit=oplog_limit)
+
+    ###########################################################################
+    def _get_restore_chain(self, restore):
+        """
+            Returns [base, incremental1, ..., incrementalN] where incrementalN
+            is the restore's source backup or the first incremental that
+            covers the restore's point in time
+        """
+        chain = []
+        backup = restore.source_backup
+        while backup.is_incremental():
+            chain.insert(0, backup)
+            previous_backup = persistence.get_backup(backup.previous_backup_id)
+            if (not previous_backup or previous_backup.expired_date or
+                    previous_backup.state != State.SUCCEEDED):
+                raise IncrementalChainError(
+                    "Backup '%s' of incremental chain of '%s' is not "
+                    "restorable" % (backup.previous_backup_id,
+                                    restore.source_backup.id))
+            backup = previous_backup
+
+        chain.insert(0, backup)
+
+        if restore.point_in_time:
+            pit_seconds = date_to_seconds(restore.point_in_time)
+            for i, incremental in enumerate(chain[1:], start=1):
+                if incremental.oplog_end_ts.time >= pit_seconds:
+                    return chain[:i + 1]
+
+        return chain
+
+    ###########################################################################
+    def _replay_incremental(self, restore, backup, oplog_limit=None):
+        update_restore(restore, event_name=EVENT_START_REPLAY_INCREMENTAL,
+                       message="Replaying oplog of incremental backup '%s'" %
+                               backup.id,
+                       details={"backupId": backup.id})
+
+        source_backup = restore.source_backup
+        try:
+            restore.source_backup = backup
+            self.backup_assistant.download_restore_source_backup(restore)
+            self.backup_assistant.extract_restore_source_backup(restore)
+
+            mongo_connector = self.get_restore_mongo_connector(restore)
+            dest_uri = mongo_connector.restore_uri()
+
+            restore_options = ["--oplogReplay"]
+            if oplog_limit:
+                restore_options.extend(["--oplogLimit", "%s:0" % oplog_limit])
+
+            if (mongo_connector.get_mongo_version() >= MongoNormalizedVersion("2.4.0") and
+                    isinstance(mongo_connector, (MongoServer, MongoCluster))):
+                restore_options.extend(["--authenticationDatabase", "admin"])
+
+            file_reference = backup.target_reference
+            dump_dir = strip_extension(file_reference.file_name,
+                                       get_codec(file_reference.compression))
+
+            self.backup_assistant.run_mongo_restore(
+                restore, dest_uri, dump_dir, None,
+                _restore_log_file_name(restore), _log_file_name(backup),
+                options=restore_options)
+        finally:
+            restore.source_backup = source_backup
+
+        update_restore(restore, event_name=EVENT_END_REPLAY_INCREMENTAL,
+                       message="Replayed oplog of incremental backup '%s'" %
+                               backup.id,
+                       details={"backupId": backup.id})
+
 ###############################################################################
 # CloudBlockStorageStrategy
 ###############################################################################
@@ -2166,7 +2886,8 @@ class CloudBlockStorageStrategy(BackupStrategy):
                 logger.info("Diff: \n%s" % document_pretty_string(diff))
                 snapshot_ref = new_snapshot_ref
                 backup.target_reference = snapshot_ref
-                update_backup(backup, properties="targetReference")
+                update_backup(backup, properties="targetReference",
+                              coalesce=True)
 
             time.sleep(sleep_time)
 
@@ -2345,6 +3066,7 @@ class HybridStrategy(BackupStrategy):
         strategy.no_index_restore = self.no_index_restore
         strategy.no_users_restore = self.no_users_restore
         strategy.no_roles_restore = self.no_roles_restore
+        strategy.stream_restore = self.stream_restore
 
     ###########################################################################
     def _do_run_restore(self, restore):
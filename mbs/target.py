@@ -6,25 +6,38 @@ import sys
 import logging
 import uuid
 import re
+import time
+import base64
+import errno
+import json
+import shutil
+import hashlib
+import tempfile
+import Queue
+
+from cStringIO import StringIO
 
 import cloudfiles
 import cloudfiles.errors
 
+import bandwidth
 import cloudfiles_utils
+import dedup
 import mbs
 import s3_utils
 
 from base import MBSObject
-from utils import which, execute_command, export_mbs_object_list, safe_stringify
+from utils import export_mbs_object_list, safe_stringify
 from azure.storage.blob.baseblobservice import BaseBlobService
+from azure.storage.blob.blockblobservice import BlockBlobService
+from azure.storage.blob.models import BlobBlock
 from boto.s3.key import Key
 from boto.exception import S3ResponseError
 from cloudfiles.errors import NoSuchContainer, AuthenticationFailed
 
 import errors
 from robustify.robustify import robustify
-from splitfile import SplitFile
-from threading import Thread
+from threading import Thread, Event, Lock, RLock, Semaphore, Condition
 import requests
 
 ###############################################################################
@@ -39,6 +52,29 @@ logger.addHandler(logging.NullHandler())
 MULTIPART_MIN_SIZE = 100 * 1024 * 1024
 CF_MULTIPART_MIN_SIZE = 5 * 1024 * 1024 * 1024
 MAX_SPLIT_SIZE = 1024 * 1024 * 1024
+AZURE_MAX_BLOCK_SIZE = 100 * 1024 * 1024
+
+# max number of parts allowed in a multipart upload (S3 limit)
+MAX_MULTIPART_PARTS = 10000
+
+# default number of parts uploaded concurrently
+DEFAULT_MULTIPART_CONCURRENCY = 4
+
+# single part transfers draw from the engine bandwidth in steps of this size
+# as they go
+BANDWIDTH_METER_SIZE = 4 * 1024 * 1024
+
+# default size of ranges fetched concurrently by ranged downloads
+DEFAULT_DOWNLOAD_PART_SIZE = 64 * 1024 * 1024
+
+# part size used for streamed uploads. Since the total size of a stream is
+# not known up front, the part size is doubled every
+# STREAM_PART_SIZE_GROWTH_INTERVAL parts to stay within the 10000 parts limit
+STREAM_PART_SIZE = 64 * 1024 * 1024
+STREAM_PART_SIZE_GROWTH_INTERVAL = 2000
+
+# where DedupTarget stores chunks within the underlying target
+DEFAULT_CHUNKS_PREFIX = "chunks/"
 
 
 # Cloud block storage statuses
@@ -58,6 +94,8 @@ class BackupTarget(MBSObject):
         self._credentials = None
         self._cloud_storage_encryption_enabled = False
         self._region = None
+        self._multipart_concurrency = None
+        self._multipart_part_size = None
 
     ###########################################################################
     @property
@@ -108,14 +146,57 @@ class BackupTarget(MBSObject):
         """
         self._cloud_storage_encryption_enabled = bool(val)
 
+    ###########################################################################
+    @property
+    def multipart_concurrency(self):
+        """
+            Number of parts uploaded concurrently for multipart uploads
+        """
+        return self._multipart_concurrency
+
+    @multipart_concurrency.setter
+    def multipart_concurrency(self, val):
+        self._multipart_concurrency = val
+
+    ###########################################################################
+    @property
+    def multipart_part_size(self):
+        """
+            Part size (in bytes) for multipart uploads. Defaults to a tenth of
+            the file size
+        """
+        return self._multipart_part_size
+
+    @multipart_part_size.setter
+    def multipart_part_size(self, val):
+        self._multipart_part_size = val
+
+    ###########################################################################
+    def _get_multipart_part_size(self, file_size, max_part_size=None):
+        # split into 10 chunks if no part size is configured
+        part_size = self.multipart_part_size or int(file_size / 10)
+        part_size = min(part_size, max_part_size or MAX_SPLIT_SIZE)
+        # do not exceed the max number of parts
+        min_part_size = int(file_size / MAX_MULTIPART_PARTS) + 1
+        return max(part_size, min_part_size)
+
+    ###########################################################################
+    def _new_multipart_upload_pool(self, upload_part, throttle=True):
+        return MultipartUploadPool(
+            upload_part,
+            concurrency=self.multipart_concurrency or DEFAULT_MULTIPART_CONCURRENCY,
+            throttle=throttle)
+
     ###########################################################################
     def put_file(self, file_path, destination_path=None,
-                 overwrite_existing=True, metadata=None):
+                 overwrite_existing=True, metadata=None, upload_state=None):
         """
             Uploads the specified file path under destination_path.
              destination_path defaults to base name (file name) of file_path
              This is the generic implementation that includes upload
-             verification and returning proper errors
+             verification and returning proper errors.
+             upload_state is an optional MultipartUploadState used by targets
+             that support resuming multipart uploads
         """
         try:
 
@@ -141,7 +222,8 @@ class BackupTarget(MBSObject):
             target_ref = self._robustifiled_put_file(
                 file_path,
                 destination_path=destination_path,
-                metadata=metadata)
+                metadata=metadata,
+                upload_state=upload_state)
             # set the preserve field
             target_ref.preserve = self.preserve
 
@@ -166,14 +248,15 @@ class BackupTarget(MBSObject):
 
     ###########################################################################
     def _robustifiled_put_file(self, file_path, destination_path,
-                               metadata=None):
+                               metadata=None, upload_state=None):
         attempt_counter = {
             "count": 0
         }
         return self._do_robustifiled_put_file(
             attempt_counter, file_path,
             destination_path,
-            metadata=metadata)
+            metadata=metadata,
+            upload_state=upload_state)
 
     ###########################################################################
     @robustify(max_attempts=10, retry_interval=5,
@@ -182,7 +265,7 @@ class BackupTarget(MBSObject):
                do_on_failure=errors.raise_exception,)
     def _do_robustifiled_put_file(self, attempt_counter,
                                   file_path, destination_path,
-                                  metadata=None):
+                                  metadata=None, upload_state=None):
         """
            a robustified put file
         """
@@ -204,21 +287,109 @@ class BackupTarget(MBSObject):
                                      file_size=file_size)
 
         return self.do_put_file(file_path, destination_path,
-                                metadata=metadata)
+                                metadata=metadata, upload_state=upload_state)
 
     ###########################################################################
-    def do_put_file(self, file_path, destination_path, metadata=None):
+    def do_put_file(self, file_path, destination_path, metadata=None,
+                    upload_state=None):
         """
            does the actual work. should be implemented by subclasses
         """
         pass
 
+    ###########################################################################
+    def put_data(self, data, destination_path, metadata=None):
+        """
+            Uploads data (a string) under destination_path from memory. No
+            retries nor upload verification, callers do that as needed.
+            Targets that can not upload from memory go through a temp file
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix=".data")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            self.do_put_file(tmp_path, destination_path, metadata=metadata)
+        finally:
+            os.remove(tmp_path)
+
+    ###########################################################################
+    def supports_stream_upload(self):
+        """
+            Returns true if the target can upload a stream of unknown size.
+            Should be overridden by subclasses that implement do_put_stream
+        """
+        return False
+
+    ###########################################################################
+    def put_stream(self, stream, destination_path, metadata=None):
+        """
+            Uploads the contents of the specified stream (any object with a
+            read(size) method) under destination_path. The stream is read
+            until exhausted. Includes upload verification and returning
+            proper errors like put_file
+        """
+        try:
+            logger.info("%s: Uploading stream to '%s' in container %s" %
+                        (self.target_type, destination_path,
+                         self.container_name))
+
+            target_ref = self.do_put_stream(stream, destination_path,
+                                            metadata=metadata)
+            # set the preserve field
+            target_ref.preserve = self.preserve
+
+            # validate that the file has been uploaded successfully
+            self._verify_file_uploaded(destination_path, target_ref.file_size)
+
+            logger.info("%s: Uploading stream to '%s' (%s bytes) in container"
+                        " %s completed successfully!!" %
+                        (self.target_type, destination_path,
+                         target_ref.file_size, self.container_name))
+
+            return target_ref
+        except Exception, e:
+            logger.exception("BackupTarget.put_stream(): Exception caught ")
+            if isinstance(e, errors.TargetError):
+                raise
+            elif errors.is_connection_exception(e):
+                raise errors.TargetConnectionError(self.container_name, cause=e)
+            else:
+                raise errors.TargetUploadError(destination_path, self.container_name,
+                                               cause=e)
+
+    ###########################################################################
+    def do_put_stream(self, stream, destination_path, metadata=None):
+        """
+           does the actual work. should be implemented by subclasses that
+           support stream uploads
+        """
+        raise errors.TargetError("%s does not support stream uploads" %
+                                 self.target_type)
+
     ###########################################################################
     def get_file(self, file_reference, destination):
         """
             Gets the file references and writes it to the specified destination
         """
 
+    ###########################################################################
+    def supports_stream_download(self):
+        """
+            Returns true if the target implements download_to_stream
+        """
+        return False
+
+    ###########################################################################
+    def download_to_stream(self, file_reference, out):
+        """
+            Downloads the file reference and writes its content, in order, to
+            the specified file-like object (e.g. a pipe).
+            Returns the number of bytes written.
+            Should be implemented by subclasses that support stream downloads
+        """
+        raise errors.TargetError("%s does not support stream downloads" %
+                                 self.target_type)
+
     ###########################################################################
     def get_temp_download_url(self, file_reference):
         """
@@ -362,6 +533,12 @@ class BackupTarget(MBSObject):
         if self.region is not None:
             doc["region"] = self.region
 
+        if self.multipart_concurrency is not None:
+            doc["multipartConcurrency"] = self.multipart_concurrency
+
+        if self.multipart_part_size is not None:
+            doc["multipartPartSize"] = self.multipart_part_size
+
         return doc
 
 ###############################################################################
@@ -381,7 +558,8 @@ class S3BucketTarget(BackupTarget):
         self._bucket = None
 
     ###########################################################################
-    def do_put_file(self, file_path, destination_path, metadata=None):
+    def do_put_file(self, file_path, destination_path, metadata=None,
+                    upload_state=None):
         # determine single/multi part upload
 
         try:
@@ -389,7 +567,8 @@ class S3BucketTarget(BackupTarget):
 
             if file_size >= MULTIPART_MIN_SIZE:
                 self._multi_part_put(file_path, destination_path, file_size,
-                                     metadata=metadata)
+                                     metadata=metadata,
+                                     upload_state=upload_state)
             else:
                 self._single_part_put(file_path, destination_path,
                                       metadata=metadata)
@@ -453,34 +632,181 @@ class S3BucketTarget(BackupTarget):
             for name, value in metadata.items():
                 k.set_metadata(name, value)
 
-        k.set_contents_from_file(file_obj, encrypt_key=self.cloud_storage_encryption_enabled)
+        file_size = os.path.getsize(file_path)
+        k.set_contents_from_file(file_obj, encrypt_key=self.cloud_storage_encryption_enabled,
+                                 cb=BandwidthMeter(),
+                                 num_cb=_num_meter_callbacks(file_size))
+
+    ###########################################################################
+    def put_data(self, data, destination_path, metadata=None):
+        k = Key(self._get_bucket())
+        k.key = destination_path
+        if metadata:
+            for name, value in metadata.items():
+                k.set_metadata(name, value)
 
+        bandwidth.consume(len(data))
+        k.set_contents_from_string(data, encrypt_key=self.cloud_storage_encryption_enabled)
 
     ###########################################################################
     def _multi_part_put(self, file_path, destination_path, file_size,
-                        metadata=None):
+                        metadata=None, upload_state=None):
 
         logger.info("S3BucketTarget: Starting multi-part put for %s " %
                     file_path)
-        chunk_size = int(file_size / 10)
-        if chunk_size > MAX_SPLIT_SIZE:
-            chunk_size = MAX_SPLIT_SIZE
 
-        bucket = self._get_bucket()
-        mp = bucket.initiate_multipart_upload(destination_path, metadata=metadata,
-                                              encrypt_key=self.cloud_storage_encryption_enabled)
+        mp = None
+        completed_parts = {}
+        if upload_state:
+            mp = self._find_resumable_multipart_upload(upload_state,
+                                                       destination_path,
+                                                       file_size)
+        if mp:
+            chunk_size = upload_state.part_size
+            completed_parts = self._get_multipart_upload_completed_parts(
+                mp, upload_state)
+            logger.info("S3BucketTarget: Resuming multi-part upload '%s' for"
+                        " %s. %s parts already uploaded" %
+                        (mp.id, file_path, len(completed_parts)))
+        else:
+            chunk_size = self._get_multipart_part_size(file_size)
+            bucket = self._get_bucket()
+            mp = bucket.initiate_multipart_upload(destination_path, metadata=metadata,
+                                                  encrypt_key=self.cloud_storage_encryption_enabled)
+            if upload_state:
+                upload_state.start(mp.id, self.container_name,
+                                   destination_path, file_size, chunk_size)
 
-        upload = SplitFile(file_path, chunk_size)
+        def upload_part(part_number, chunk):
+            key = mp.upload_part_from_file(chunk, part_number)
+            if upload_state:
+                upload_state.mark_part_completed(part_number, key.etag)
 
-        for i, chunk in enumerate(upload, 1):
-            logger.info("Uploading file part %d (%s bytes)" %
-                         (i, chunk.size))
-            mp.upload_part_from_file(chunk, i)
+        pool = self._new_multipart_upload_pool(upload_part)
+
+        try:
+            pool.upload(_file_parts(file_path, chunk_size,
+                                    skip_parts=completed_parts))
+            mp.complete_upload()
+        except Exception, e:
+            # keep the upload around so that a retry can resume it
+            if upload_state and errors.is_exception_retriable(e):
+                logger.error("S3BucketTarget: Multi-part put for %s failed. "
+                             "Keeping upload '%s' to be resumed" %
+                             (file_path, mp.id))
+                raise
+
+            logger.error("S3BucketTarget: Multi-part put for %s failed. "
+                         "Canceling upload" % file_path)
+            self._cancel_multipart_upload(mp)
+            if upload_state:
+                upload_state.reset()
+            raise
 
-        mp.complete_upload()
         logger.info("S3BucketTarget: Multi-part put for %s completed"
                     " successfully!" % file_path)
 
+    ###########################################################################
+    def _find_resumable_multipart_upload(self, upload_state, destination_path,
+                                         file_size):
+        """
+            Returns the in progress multipart upload referenced by
+            upload_state if it can be resumed for the specified file
+        """
+        if not upload_state.upload_id:
+            return None
+
+        bucket = self._get_bucket()
+        mp = None
+        for upload in bucket.get_all_multipart_uploads(prefix=destination_path):
+            if upload.id == upload_state.upload_id:
+                mp = upload
+                break
+
+        if not mp:
+            logger.info("S3BucketTarget: Multi-part upload '%s' no longer "
+                        "exists. Starting a new upload" %
+                        upload_state.upload_id)
+        elif not upload_state.matches(self.container_name, destination_path,
+                                      file_size):
+            logger.info("S3BucketTarget: Multi-part upload '%s' was for a "
+                        "different file. Canceling it and starting a new "
+                        "upload" % upload_state.upload_id)
+            self._cancel_multipart_upload(mp)
+            mp = None
+
+        if not mp:
+            upload_state.reset()
+
+        return mp
+
+    ###########################################################################
+    def _get_multipart_upload_completed_parts(self, mp, upload_state):
+        """
+            Returns parts recorded in upload_state that S3 also has with the
+            same etag
+        """
+        uploaded_etags = dict((part.part_number, part.etag) for part in mp)
+        completed_parts = {}
+        for part_number, etag in upload_state.completed_parts.items():
+            if uploaded_etags.get(part_number) == etag:
+                completed_parts[part_number] = etag
+
+        return completed_parts
+
+    ###########################################################################
+    def _cancel_multipart_upload(self, mp):
+        try:
+            mp.cancel_upload()
+        except Exception, ex:
+            logger.error("S3BucketTarget: Error while canceling multi-part"
+                         " upload '%s': %s" % (mp.id, ex))
+
+    ###########################################################################
+    def supports_stream_upload(self):
+        return True
+
+    ###########################################################################
+    def do_put_stream(self, stream, destination_path, metadata=None):
+        logger.info("S3BucketTarget: Starting multi-part stream put to %s " %
+                    destination_path)
+        try:
+            bucket = self._get_bucket()
+            mp = bucket.initiate_multipart_upload(destination_path, metadata=metadata,
+                                                  encrypt_key=self.cloud_storage_encryption_enabled)
+        except S3ResponseError, sre:
+            if 403 == sre.status:
+                raise errors.TargetInaccessibleError(self.bucket_name, cause=sre)
+            else:
+                raise
+
+        pool = self._new_multipart_upload_pool(
+            lambda part_number, part: mp.upload_part_from_file(part, part_number))
+
+        try:
+            part_count = len(pool.upload(_stream_parts(stream, self.multipart_part_size)))
+            mp.complete_upload()
+        except Exception:
+            logger.error("S3BucketTarget: Multi-part stream put to %s failed."
+                         " Canceling upload" % destination_path)
+            try:
+                mp.cancel_upload()
+            except Exception, ex:
+                logger.error("S3BucketTarget: Error while canceling multi-part"
+                             " upload for %s: %s" % (destination_path, ex))
+            raise
+
+        file_size = stream.bytes_read
+        logger.info("S3BucketTarget: Multi-part stream put to %s completed"
+                    " successfully! (%s parts, %s bytes)" %
+                    (destination_path, part_count, file_size))
+
+        cloud_storage_encryption = self._fetch_file_info(destination_path)['cloud_storage_encryption']
+
+        return FileReference(file_path=destination_path,
+                             file_size=file_size,
+                             cloud_storage_encryption=cloud_storage_encryption)
+
     ###########################################################################
     def get_file(self, file_reference, destination):
 
@@ -503,7 +829,8 @@ class S3BucketTarget(BackupTarget):
             file_obj = open(os.path.join(destination, file_name), mode="w")
 
             num_call_backs = key.size / 1000
-            key.get_contents_to_file(file_obj, cb=_download_progress,
+            key.get_contents_to_file(file_obj,
+                                     cb=BandwidthMeter(_download_progress),
                                      num_cb=num_call_backs)
 
             print("Download completed successfully!!")
@@ -515,6 +842,52 @@ class S3BucketTarget(BackupTarget):
             logger.exception(msg)
             raise errors.TargetError(msg, cause=e)
 
+    ###########################################################################
+    def supports_stream_download(self):
+        return True
+
+    ###########################################################################
+    def download_to_stream(self, file_reference, out):
+        """
+            Fetches the file with concurrent HTTP range requests
+        """
+        file_path = file_reference.file_path
+        try:
+            bucket = self._get_bucket()
+            key = bucket.get_key(file_path)
+
+            if not key:
+                raise errors.TargetFileNotFoundError("No such file '%s' in bucket "
+                                                     "'%s'" % (file_path,
+                                                               self.bucket_name))
+
+            def fetch_range(start, end):
+                # key objects hold response state so each range gets its own
+                range_key = bucket.new_key(file_path)
+                headers = {
+                    "Range": "bytes=%s-%s" % (start, end)
+                }
+                return range_key.get_contents_as_string(headers=headers)
+
+            part_size = self.multipart_part_size or DEFAULT_DOWNLOAD_PART_SIZE
+            concurrency = self.multipart_concurrency or DEFAULT_MULTIPART_CONCURRENCY
+            logger.info("S3BucketTarget: Downloading '%s' (%s bytes) from "
+                        "bucket '%s' using %s concurrent ranges of %s bytes" %
+                        (file_path, key.size, self.bucket_name, concurrency,
+                         part_size))
+
+            pool = RangedDownloadPool(fetch_range, concurrency=concurrency)
+            return pool.download(key.size, part_size, out)
+
+        except Exception, e:
+            if isinstance(e, errors.TargetError):
+                raise
+            msg = ("S3BucketTarget: Error while trying to download '%s'"
+                   " from s3 bucket %s. Cause: %s" %
+                   (file_path, self.bucket_name, e))
+            logger.exception(msg)
+            raise errors.TargetError(msg, cause=e)
+
     ###########################################################################
     def do_delete_file(self, file_reference):
         file_path = file_reference.file_path
@@ -755,7 +1128,8 @@ class RackspaceCloudFilesTarget(BackupTarget):
         self._container = None
 
     ###########################################################################
-    def do_put_file(self, file_path, destination_path, metadata=None):
+    def do_put_file(self, file_path, destination_path, metadata=None,
+                    upload_state=None):
 
         # determine single/multi part upload
         file_size = os.path.getsize(file_path)
@@ -779,7 +1153,20 @@ class RackspaceCloudFilesTarget(BackupTarget):
 
             container = self._get_container()
             container_obj = container.create_object(destination_path)
-            container_obj.load_from_filename(file_path)
+            container_obj.load_from_filename(file_path,
+                                             callback=BandwidthMeter())
+        except Exception, ex:
+            if "unauthorized" in safe_stringify(ex).lower():
+                raise errors.TargetConnectionError(self.container_name, ex)
+            else:
+                raise
+
+    ###########################################################################
+    def put_data(self, data, destination_path, metadata=None):
+        try:
+            container_obj = self._get_container().create_object(destination_path)
+            bandwidth.consume(len(data))
+            container_obj.write(data)
         except Exception, ex:
             if "unauthorized" in safe_stringify(ex).lower():
                 raise errors.TargetConnectionError(self.container_name, ex)
@@ -790,36 +1177,79 @@ class RackspaceCloudFilesTarget(BackupTarget):
     def _multi_part_put(self, file_path, destination_path, file_size,
                         metadata=None):
         """
-            Uploads file in chunks using Swift Tool (st) command
-            http://bazaar.launchpad.net/~hudson-openstack/swift/1.2/view/head:/bin/st
-
+            Uploads file segments concurrently then creates a manifest object
+            that joins them (swift large objects)
         """
         logger.info("RackspaceCloudFilesTarget: Starting multi-part put "
                     "for %s " % file_path)
 
-        # calculate chunk size
-        # split into 10 chunks if possible
-        chunk_size = int(file_size / 10)
-        if chunk_size > MAX_SPLIT_SIZE:
-            chunk_size = MAX_SPLIT_SIZE
-
-        st_exe = which("st")
-        st_command = [
-            st_exe,
-            "-A", "https://auth.api.rackspacecloud.com/v1.0",
-            "-U", self.username,
-            "-K", self.api_key,
-            "upload",
-            "--segment-size", str(chunk_size),
-            self.container_name, file_path
-
-        ]
-        logger.info("RackspaceCloudFilesTarget: Executing command: %s" %
-                    " ".join(st_command))
-        execute_command(st_command)
+        chunk_size = self._get_multipart_part_size(file_size)
+        segments_prefix = _segments_prefix(destination_path)
+
+        def upload_segment(part_number, chunk):
+            # cloudfiles connections are not thread safe so each segment
+            # gets its own
+            container = self._connect_to_container()
+            segment = container.create_object("%s%08d" % (segments_prefix,
+                                                          part_number))
+            segment.write(chunk)
+
+        pool = self._new_multipart_upload_pool(upload_segment)
+        try:
+            pool.upload(_file_parts(file_path, chunk_size))
+        except Exception:
+            logger.error("RackspaceCloudFilesTarget: Multi-part put for %s "
+                         "failed. Deleting uploaded segments" % file_path)
+            self._delete_segments(destination_path)
+            raise
+
+        container = self._get_container()
+        manifest = container.create_object(destination_path)
+        manifest.manifest = "%s/%s" % (self.container_name, segments_prefix)
+        manifest.sync_manifest()
+
         logger.info("RackspaceCloudFilesTarget: Multi-part put for %s "
                     "completed successfully!" % file_path)
 
+    ###########################################################################
+    def _get_manifest(self, file_path):
+        """
+            Returns the "container/prefix" of the segments of a multi-part
+            file, None otherwise
+        """
+        try:
+            return self._get_container().get_object(file_path).manifest
+        except cloudfiles.errors.NoSuchObject:
+            return None
+
+    ###########################################################################
+    def _delete_segments(self, file_path, manifest=None):
+        """
+            Deletes the segments of the file that manifest points to. Files
+            uploaded with the old "st" tool have their segments in the
+            "<container>_segments" container. Defaults to the segments
+            _multi_part_put() uploads
+        """
+        manifest = manifest or "%s/%s" % (self.container_name,
+                                          _segments_prefix(file_path))
+        try:
+            segments_container_name, prefix = manifest.split("/", 1)
+            if not prefix:
+                logger.error("RackspaceCloudFilesTarget: Not deleting "
+                             "segments of '%s'. Manifest '%s' has no prefix" %
+                             (file_path, manifest))
+                return
+
+            container = self._get_container()
+            if segments_container_name != self.container_name:
+                container = container.conn.get_container(
+                    segments_container_name)
+            for name in container.list_objects(prefix=prefix):
+                container.delete_object(name)
+        except Exception, ex:
+            logger.error("RackspaceCloudFilesTarget: Error while deleting "
+                         "segments of '%s': %s" % (file_path, ex))
+
 
     ###########################################################################
     def _fetch_file_info(self, destination_path):
@@ -851,8 +1281,8 @@ class RackspaceCloudFilesTarget(BackupTarget):
 
             file_name = file_reference.file_name
             des_file = os.path.join(destination, file_name)
-            container_obj.save_to_filename(des_file,
-                                           callback=_download_progress)
+            container_obj.save_to_filename(
+                des_file, callback=BandwidthMeter(_download_progress))
             print("\nDownload completed successfully!!")
 
         except Exception, e:
@@ -870,7 +1300,11 @@ class RackspaceCloudFilesTarget(BackupTarget):
                         "container '%s'" % (file_path, self.container_name))
 
             container = self._get_container()
+            manifest = self._get_manifest(file_path)
             container.delete_object(file_path)
+            # delete segments in case of a multi-part file
+            if manifest:
+                self._delete_segments(file_path, manifest=manifest)
             logger.info("RackspaceCloudFilesTarget: Successfully deleted '%s' "
                         "from container '%s'" %
                         (file_path, self.container_name))
@@ -906,17 +1340,21 @@ class RackspaceCloudFilesTarget(BackupTarget):
     ###########################################################################
     def _get_container(self):
         if not self._container:
-            try:
-                conn = cloudfiles.get_connection(username=self.username,
-                                                 api_key=self.api_key,
-                                                 timeout=30)
-
-                self._container = conn.get_container(self.container_name)
-            except (AuthenticationFailed, NoSuchContainer), e:
-                raise errors.TargetInaccessibleError(self.container_name,
-                                              cause=e)
+            self._container = self._connect_to_container()
         return self._container
 
+    ###########################################################################
+    def _connect_to_container(self):
+        try:
+            conn = cloudfiles.get_connection(username=self.username,
+                                             api_key=self.api_key,
+                                             timeout=30)
+
+            return conn.get_container(self.container_name)
+        except (AuthenticationFailed, NoSuchContainer), e:
+            raise errors.TargetInaccessibleError(self.container_name,
+                                          cause=e)
+
     ###########################################################################
     @property
     def username(self):
@@ -989,7 +1427,7 @@ class AzureContainerTarget(BackupTarget):
 
     ###########################################################################
     def put_file(self, file_path, destination_path=None,
-                 overwrite_existing=False, metadata=None):
+                 overwrite_existing=False, metadata=None, upload_state=None):
         try:
 
             # calculating file size
@@ -1001,8 +1439,11 @@ class AzureContainerTarget(BackupTarget):
                         (file_path, file_size, self.container_name))
 
 
-            self._single_part_put(file_path, destination_path,
-                                  metadata=metadata)
+            if file_size >= MULTIPART_MIN_SIZE:
+                self._multi_part_put(file_path, destination_path, file_size)
+            else:
+                self._single_part_put(file_path, destination_path,
+                                      metadata=metadata)
 
             logger.info("AzureContainerTarget: Uploading %s (%s bytes) "
                         "to container %s completed successfully!!" %
@@ -1018,14 +1459,70 @@ class AzureContainerTarget(BackupTarget):
 
     ###########################################################################
     def _single_part_put(self, file_path, destination_path, metadata=None):
-        blob_service = self._get_blob_service()
-        fp = open(file_path, 'r').read()
-        blob_service.put_blob(self.container_name, destination_path, fp,
-                              x_ms_blob_type='BlockBlob')
+        """
+            Uploads BANDWIDTH_METER_SIZE blocks one after the other so that
+            the upload draws from the engine bandwidth as it goes. put_blob()
+            sends the whole file at once
+        """
+        if not os.path.getsize(file_path):
+            blob_service = self._get_blob_service()
+            blob_service.put_blob(self.container_name, destination_path, "",
+                                  x_ms_blob_type='BlockBlob')
+            return
+
+        block_blob_service = self._get_block_blob_service()
+        block_list = []
+        for part_number, chunk in _file_parts(file_path, BANDWIDTH_METER_SIZE):
+            try:
+                bandwidth.consume(chunk.size)
+                block_id = _azure_block_id(part_number)
+                block_blob_service.put_block(self.container_name,
+                                             destination_path, chunk.read(),
+                                             block_id)
+                block_list.append(BlobBlock(id=block_id))
+            finally:
+                chunk.close()
+
+        block_blob_service.put_block_list(self.container_name,
+                                          destination_path, block_list)
+
+    ###########################################################################
+    def put_data(self, data, destination_path, metadata=None):
+        bandwidth.consume(len(data))
+        self._get_blob_service().put_blob(self.container_name,
+                                          destination_path, data,
+                                          x_ms_blob_type='BlockBlob')
 
     ###########################################################################
     def _multi_part_put(self, file_path, destination_path, file_size):
-        pass
+        """
+            Uploads blocks concurrently then commits the block list
+        """
+        logger.info("AzureContainerTarget: Starting multi-part put for %s " %
+                    file_path)
+        chunk_size = self._get_multipart_part_size(
+            file_size, max_part_size=AZURE_MAX_BLOCK_SIZE)
+
+        block_blob_service = self._get_block_blob_service()
+
+        def upload_block(part_number, chunk):
+            block_id = _azure_block_id(part_number)
+            block_blob_service.put_block(self.container_name, destination_path,
+                                         chunk.read(), block_id)
+            return block_id
+
+        # uncommitted blocks are garbage collected by azure so there is
+        # nothing to abort on failure
+        pool = self._new_multipart_upload_pool(upload_block)
+        block_ids = pool.upload(_file_parts(file_path, chunk_size))
+
+        block_list = [BlobBlock(id=block_ids[part_number])
+                      for part_number in sorted(block_ids.keys())]
+        block_blob_service.put_block_list(self.container_name,
+                                          destination_path, block_list)
+
+        logger.info("AzureContainerTarget: Multi-part put for %s completed"
+                    " successfully!" % file_path)
 
 
     ###########################################################################
@@ -1051,6 +1548,12 @@ class AzureContainerTarget(BackupTarget):
                                account_key=self.account_key,
                                protocol="https")
 
+    ###########################################################################
+    def _get_block_blob_service(self):
+        return BlockBlobService(account_name=self.account_name,
+                                account_key=self.account_key,
+                                protocol="https")
+
     ###########################################################################
     @property
     def account_name(self):
@@ -1103,67 +1606,414 @@ class AzureContainerTarget(BackupTarget):
         return errors
 
 ###############################################################################
-# Target Reference Classes
+# DedupTarget
 ###############################################################################
-
-class TargetReference(MBSObject):
+class DedupTarget(BackupTarget):
     """
-        Represents a reference to the file that gets uploaded to target
+        Stores files in an underlying target as content-defined chunks named
+        by their hash. Only chunks that are not already stored are uploaded.
+        Each file gets a manifest (listing its chunks) stored next to where
+        the file would have been stored and chunks are reference counted so
+        that a chunk is deleted once no manifest references it.
+        Dedup works best when consecutive archives have mostly identical bytes
+        e.g. uncompressed (compression 'none') or rsyncable archives
     """
     ###########################################################################
-    def __init__(self, preserve=None):
-        super(TargetReference, self).__init__()
-
-        self._preserve = preserve
-        self._deleted_date = None
-        self._source_was_locked = None
+    def __init__(self):
+        BackupTarget.__init__(self)
+        self._target = None
+        self._average_chunk_size = None
+        self._chunks_prefix = None
 
     ###########################################################################
     @property
-    def preserve(self):
-        return self._preserve
+    def target(self):
+        """
+            The target where chunks and manifests are stored
+        """
+        return self._target
 
-    @preserve.setter
-    def preserve(self, val):
-        self._preserve = val
+    @target.setter
+    def target(self, val):
+        self._target = val
 
     ###########################################################################
     @property
-    def deleted_date(self):
-        return self._deleted_date
+    def average_chunk_size(self):
+        return self._average_chunk_size
 
-    @deleted_date.setter
-    def deleted_date(self, val):
-        self._deleted_date = val
+    @average_chunk_size.setter
+    def average_chunk_size(self, val):
+        self._average_chunk_size = val
 
     ###########################################################################
     @property
-    def deleted(self):
-        return self.deleted_date is not None
+    def chunks_prefix(self):
+        return self._chunks_prefix or DEFAULT_CHUNKS_PREFIX
 
+    @chunks_prefix.setter
+    def chunks_prefix(self, val):
+        self._chunks_prefix = val
 
     ###########################################################################
     @property
-    def source_was_locked(self):
+    def container_name(self):
+        return self.target.container_name
+
+    ###########################################################################
+    def put_file(self, file_path, destination_path=None,
+                 overwrite_existing=True, metadata=None, upload_state=None):
         """
-            Set to true if the backup source was locked during backup
+            Chunks the file and uploads chunks that are not stored yet then
+            uploads the file manifest. Returns a DedupFileReference
         """
-        return self._source_was_locked
-
-    @source_was_locked.setter
-    def source_was_locked(self, val):
-        self._source_was_locked = val
+        destination_path = destination_path or os.path.basename(file_path)
+        manifest_path = _manifest_path(destination_path)
+        try:
+            file_size = os.path.getsize(file_path)
+            logger.info("DedupTarget: Uploading '%s' (%s bytes) to '%s' in "
+                        "container %s" % (file_path, file_size,
+                                          destination_path,
+                                          self.container_name))
+
+            if not overwrite_existing and self.file_exists(destination_path):
+                msg = ("File '%s' already exists in container '%s'" %
+                       (destination_path, self.container_name))
+                raise errors.UploadedFileAlreadyExistError(msg)
+
+            chunks = []
+            stored = {
+                "chunks": 0,
+                "bytes": 0
+            }
+            stored_lock = Lock()
+            work_dir = os.path.dirname(os.path.abspath(file_path))
+
+            def upload_chunk(chunk_number, chunk):
+                digest, data = chunk
+                key = self._chunk_key(digest)
+                if not self._chunk_index().add_reference(key, manifest_path,
+                                                         len(data)):
+                    return
+
+                # a chunk may appear in the same file twice so it can get
+                # uploaded twice at worst. Uploaded from memory, the pool
+                # retries failed chunks
+                self.target.put_data(data, self._chunk_path(digest))
+                self._chunk_index().mark_stored(key)
+                with stored_lock:
+                    stored["chunks"] += 1
+                    stored["bytes"] += len(data)
 
-    ###########################################################################
-    def to_document(self, display_only=False):
-        doc = {
+            try:
+                # chunks are accounted for when uploaded to the underlying
+                # target
+                pool = self._new_multipart_upload_pool(upload_chunk,
+                                                       throttle=False)
+                pool.upload(self._file_chunks(file_path, chunks))
+            except Exception:
+                logger.error("DedupTarget: Failed to upload chunks of '%s'. "
+                             "Releasing chunk references" % file_path)
+                self._release_chunks(manifest_path, chunks)
+                raise
 
-        }
+            manifest = {
+                "fileSize": file_size,
+                "averageChunkSize": self.average_chunk_size or
+                                    dedup.DEFAULT_AVERAGE_CHUNK_SIZE,
+                "chunks": chunks
+            }
+            self._put_data(json.dumps(manifest), manifest_path, work_dir,
+                           metadata=metadata)
+
+            logger.info("DedupTarget: Uploading %s completed successfully. "
+                        "Uploaded %s new chunks (%s bytes) out of %s chunks" %
+                        (file_path, stored["chunks"], stored["bytes"],
+                         len(chunks)))
+
+            target_ref = DedupFileReference(file_path=destination_path,
+                                            file_size=file_size)
+            target_ref.manifest_path = manifest_path
+            target_ref.chunk_count = len(chunks)
+            target_ref.stored_size = stored["bytes"]
+            target_ref.preserve = self.preserve
+            return target_ref
 
-        if self.preserve is not None:
-            doc["preserve"] = self.preserve
+        except Exception, e:
+            logger.exception("DedupTarget.put_file(): Exception caught ")
+            if isinstance(e, errors.TargetError):
+                raise
+            elif errors.is_connection_exception(e):
+                raise errors.TargetConnectionError(self.container_name, cause=e)
+            else:
+                raise errors.TargetUploadError(destination_path,
+                                               self.container_name, cause=e)
 
-        if self.deleted_date:
+    ###########################################################################
+    def _file_chunks(self, file_path, chunks):
+        """
+            Generates (chunk number, (hash, data)) tuples and appends the
+            manifest entry of each chunk to chunks
+        """
+        with open(file_path, "rb") as file_obj:
+            chunk_number = 1
+            for data in dedup.content_defined_chunks(
+                    file_obj, average_size=self.average_chunk_size):
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append({
+                    "hash": digest,
+                    "size": len(data)
+                })
+                yield chunk_number, (digest, data)
+                chunk_number += 1
+
+    ###########################################################################
+    def _put_data(self, data, destination_path, work_dir, metadata=None):
+        fd, tmp_path = tempfile.mkstemp(dir=work_dir, suffix=".chunk")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            self.target.put_file(tmp_path, destination_path=destination_path,
+                                 metadata=metadata)
+        finally:
+            os.remove(tmp_path)
+
+    ###########################################################################
+    def supports_stream_download(self):
+        return True
+
+    ###########################################################################
+    def download_to_stream(self, file_reference, out):
+        """
+            Reassembles the file from its chunks which are fetched
+            concurrently
+        """
+        manifest = self._get_manifest(file_reference.file_path)
+        if manifest is None:
+            raise errors.TargetFileNotFoundError(
+                "No such file '%s' in container '%s'" %
+                (file_reference.file_path, self.container_name))
+
+        chunks = {}
+        ranges = []
+        offset = 0
+        for chunk in manifest["chunks"]:
+            chunks[offset] = chunk
+            ranges.append((offset, offset + chunk["size"] - 1))
+            offset += chunk["size"]
+
+        def fetch_range(start, end):
+            return self._get_chunk(chunks[start])
+
+        concurrency = self.multipart_concurrency or DEFAULT_MULTIPART_CONCURRENCY
+        pool = RangedDownloadPool(fetch_range, concurrency=concurrency,
+                                  throttle=False)
+        return pool.download_ranges(ranges, out)
+
+    ###########################################################################
+    def _get_chunk(self, chunk):
+        chunk_ref = FileReference(file_path=self._chunk_path(chunk["hash"]),
+                                  file_size=chunk["size"])
+        data = self._get_data(chunk_ref)
+        if hashlib.sha256(data).hexdigest() != chunk["hash"]:
+            raise errors.ChunkIntegrityError(
+                "Chunk '%s' does not match its hash" % chunk_ref.file_path)
+        return data
+
+    ###########################################################################
+    def _get_data(self, file_reference):
+        if self.target.supports_stream_download():
+            out = StringIO()
+            self.target.download_to_stream(file_reference, out)
+            return out.getvalue()
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.target.get_file(file_reference, tmp_dir)
+            with open(os.path.join(tmp_dir, file_reference.file_name),
+                      "rb") as file_obj:
+                return file_obj.read()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    ###########################################################################
+    def _get_manifest(self, file_path):
+        """
+            Returns the manifest of the specified file or None if it does
+            not exist
+        """
+        manifest_path = _manifest_path(file_path)
+        if not self.target.file_exists(manifest_path):
+            return None
+        return json.loads(self._get_data(FileReference(file_path=manifest_path)))
+
+    ###########################################################################
+    def get_file(self, file_reference, destination):
+        with open(os.path.join(destination, file_reference.file_name),
+                  "wb") as file_obj:
+            self.download_to_stream(file_reference, file_obj)
+
+    ###########################################################################
+    def stream_file(self, file_reference):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.get_file(file_reference, tmp_dir)
+            with open(os.path.join(tmp_dir, file_reference.file_name)) as f:
+                for line in f:
+                    yield line.rstrip("\n")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    ###########################################################################
+    def do_delete_file(self, file_reference):
+        """
+            Releases the chunks of the file then deletes its manifest
+        """
+        manifest_path = _manifest_path(file_reference.file_path)
+        manifest = self._get_manifest(file_reference.file_path)
+        if manifest is None:
+            return False
+
+        # retried deletes release the same references again which is a no-op
+        self._release_chunks(manifest_path, manifest["chunks"])
+        self.target.delete_file(FileReference(file_path=manifest_path))
+        return True
+
+    ###########################################################################
+    def _release_chunks(self, manifest_path, chunks):
+        """
+            Removes the manifest's references to the specified chunks and
+            deletes chunks that are no longer referenced
+        """
+        chunk_index = self._chunk_index()
+        deleted = 0
+        for digest in set(chunk["hash"] for chunk in chunks):
+            key = self._chunk_key(digest)
+            if not chunk_index.remove_reference(key, manifest_path):
+                continue
+            try:
+                self.target.delete_file(
+                    FileReference(file_path=self._chunk_path(digest)))
+                chunk_index.chunk_deleted(key)
+                deleted += 1
+            except Exception:
+                chunk_index.unlock(key)
+                raise
+
+        logger.info("DedupTarget: Released chunks of '%s'. Deleted %s "
+                    "unreferenced chunks" % (manifest_path, deleted))
+
+    ###########################################################################
+    def _fetch_file_info(self, destination_path):
+        return self.target._fetch_file_info(_manifest_path(destination_path))
+
+    ###########################################################################
+    def _chunk_path(self, digest):
+        return "%s%s/%s" % (self.chunks_prefix, digest[:2], digest)
+
+    ###########################################################################
+    def _chunk_key(self, digest):
+        return "%s:%s/%s" % (self.target.target_type, self.container_name,
+                             self._chunk_path(digest))
+
+    ###########################################################################
+    def _chunk_index(self):
+        return dedup.ChunkIndex(mbs.get_mbs().chunk_reference_collection)
+
+    ###########################################################################
+    def load_region(self):
+        self.target.load_region()
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = BackupTarget.to_document(self, display_only=display_only)
+        doc.update({
+            "_type": "DedupTarget",
+            "target": self.target and
+                      self.target.to_document(display_only=display_only)
+        })
+
+        if self.average_chunk_size is not None:
+            doc["averageChunkSize"] = self.average_chunk_size
+
+        if self._chunks_prefix is not None:
+            doc["chunksPrefix"] = self._chunks_prefix
+
+        return doc
+
+    ###########################################################################
+    def has_sufficient_permissions(self):
+        return self.target.has_sufficient_permissions()
+
+    ###########################################################################
+    def validate(self):
+        if not self.target:
+            return ["Missing 'target' property"]
+
+        return self.target.validate()
+
+###############################################################################
+# Target Reference Classes
+###############################################################################
+
+class TargetReference(MBSObject):
+    """
+        Represents a reference to the file that gets uploaded to target
+    """
+    ###########################################################################
+    def __init__(self, preserve=None):
+        super(TargetReference, self).__init__()
+
+        self._preserve = preserve
+        self._deleted_date = None
+        self._source_was_locked = None
+
+    ###########################################################################
+    @property
+    def preserve(self):
+        return self._preserve
+
+    @preserve.setter
+    def preserve(self, val):
+        self._preserve = val
+
+    ###########################################################################
+    @property
+    def deleted_date(self):
+        return self._deleted_date
+
+    @deleted_date.setter
+    def deleted_date(self, val):
+        self._deleted_date = val
+
+    ###########################################################################
+    @property
+    def deleted(self):
+        return self.deleted_date is not None
+
+
+    ###########################################################################
+    @property
+    def source_was_locked(self):
+        """
+            Set to true if the backup source was locked during backup
+        """
+        return self._source_was_locked
+
+    @source_was_locked.setter
+    def source_was_locked(self, val):
+        self._source_was_locked = val
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = {
+
+        }
+
+        if self.preserve is not None:
+            doc["preserve"] = self.preserve
+
+        if self.deleted_date:
             doc["deletedDate"] = self.deleted_date
 
         if self.source_was_locked is not None:
@@ -1186,6 +2036,7 @@ class FileReference(TargetReference):
         self._file_path = file_path
         self._file_size = file_size
         self._cloud_storage_encryption = cloud_storage_encryption
+        self._compression = None
 
     ###########################################################################
     @property
@@ -1214,6 +2065,20 @@ class FileReference(TargetReference):
     def file_size(self, file_size):
         self._file_size = file_size
 
+    ###########################################################################
+    @property
+    def compression(self):
+        """
+            Compression codec of the file. None for files that are not
+            backup archives or were archived before compression was
+            configurable (gzip)
+        """
+        return self._compression
+
+    @compression.setter
+    def compression(self, val):
+        self._compression = val
+
     ###########################################################################
     @property
     def file_name(self):
@@ -1229,6 +2094,9 @@ class FileReference(TargetReference):
             "cloudStorageEncryption": self.cloud_storage_encryption
         })
 
+        if self.compression:
+            doc["compression"] = self.compression
+
         return doc
 
     ###########################################################################
@@ -1236,6 +2104,64 @@ class FileReference(TargetReference):
         return "(File Path: '%s', File Size: '%s')" % (self.file_path,
                                                        self.file_size)
 
+###############################################################################
+# DedupFileReference
+###############################################################################
+class DedupFileReference(FileReference):
+    """
+        Reference to a file stored by DedupTarget. file_path is the logical
+        path of the file while its content lives in the manifest's chunks
+    """
+    ###########################################################################
+    def __init__(self, file_path=None, file_size=None, preserve=None):
+        FileReference.__init__(self, file_path=file_path, file_size=file_size,
+                               preserve=preserve)
+        self._manifest_path = None
+        self._chunk_count = None
+        self._stored_size = None
+
+    ###########################################################################
+    @property
+    def manifest_path(self):
+        return self._manifest_path
+
+    @manifest_path.setter
+    def manifest_path(self, val):
+        self._manifest_path = val
+
+    ###########################################################################
+    @property
+    def chunk_count(self):
+        return self._chunk_count
+
+    @chunk_count.setter
+    def chunk_count(self, val):
+        self._chunk_count = val
+
+    ###########################################################################
+    @property
+    def stored_size(self):
+        """
+            Bytes of new chunks that were uploaded for this file
+        """
+        return self._stored_size
+
+    @stored_size.setter
+    def stored_size(self, val):
+        self._stored_size = val
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        doc = FileReference.to_document(self, display_only=display_only)
+        doc.update({
+            "_type": "DedupFileReference",
+            "manifestPath": self.manifest_path,
+            "chunkCount": self.chunk_count,
+            "storedSize": self.stored_size
+        })
+
+        return doc
+
 ###############################################################################
 # CloudBlockStorageSnapshotReference
 ###############################################################################
@@ -1735,6 +2661,157 @@ class LVMSnapshotReference(CompositeBlockStorageSnapshotReference):
         const_snap_infos = map(lambda s: s.info(), self.constituent_snapshots)
         return "(LVM Snapshot: [%s])" % ",".join(const_snap_infos)
 
+###############################################################################
+# MultipartUploadState
+###############################################################################
+class MultipartUploadState(MBSObject):
+    """
+        Persistable state of an in progress multipart upload so that an
+        interrupted upload can be resumed from the first missing part.
+        Parts are marked completed from concurrent upload threads and every
+        change is reported to the progress listener (e.g. to save the state)
+    """
+    ###########################################################################
+    def __init__(self):
+        MBSObject.__init__(self)
+        self._upload_id = None
+        self._container_name = None
+        self._destination_path = None
+        self._file_size = None
+        self._part_size = None
+        self._completed_parts = {}
+        self._lock = RLock()
+        self._progress_listener = None
+
+    ###########################################################################
+    @property
+    def upload_id(self):
+        return self._upload_id
+
+    @upload_id.setter
+    def upload_id(self, val):
+        self._upload_id = val
+
+    ###########################################################################
+    @property
+    def container_name(self):
+        return self._container_name
+
+    @container_name.setter
+    def container_name(self, val):
+        self._container_name = val
+
+    ###########################################################################
+    @property
+    def destination_path(self):
+        return self._destination_path
+
+    @destination_path.setter
+    def destination_path(self, val):
+        self._destination_path = val
+
+    ###########################################################################
+    @property
+    def file_size(self):
+        return self._file_size
+
+    @file_size.setter
+    def file_size(self, val):
+        self._file_size = val
+
+    ###########################################################################
+    @property
+    def part_size(self):
+        return self._part_size
+
+    @part_size.setter
+    def part_size(self, val):
+        self._part_size = val
+
+    ###########################################################################
+    @property
+    def completed_parts(self):
+        """
+            dict of part number => etag
+        """
+        with self._lock:
+            return dict(self._completed_parts)
+
+    @completed_parts.setter
+    def completed_parts(self, val):
+        # stored as a list of {partNumber, etag} since document keys have to
+        # be strings
+        if isinstance(val, list):
+            val = dict((p["partNumber"], p["etag"]) for p in val)
+        self._completed_parts = val or {}
+
+    ###########################################################################
+    @property
+    def progress_listener(self):
+        return self._progress_listener
+
+    @progress_listener.setter
+    def progress_listener(self, val):
+        self._progress_listener = val
+
+    ###########################################################################
+    def start(self, upload_id, container_name, destination_path, file_size,
+              part_size):
+        with self._lock:
+            self._upload_id = upload_id
+            self._container_name = container_name
+            self._destination_path = destination_path
+            self._file_size = file_size
+            self._part_size = part_size
+            self._completed_parts = {}
+        self._notify_progress()
+
+    ###########################################################################
+    def reset(self):
+        with self._lock:
+            self._upload_id = None
+            self._completed_parts = {}
+        self._notify_progress()
+
+    ###########################################################################
+    def mark_part_completed(self, part_number, etag):
+        with self._lock:
+            self._completed_parts[part_number] = etag
+        self._notify_progress()
+
+    ###########################################################################
+    def matches(self, container_name, destination_path, file_size):
+        return (self.container_name == container_name and
+                self.destination_path == destination_path and
+                self.file_size == file_size and
+                self.part_size is not None)
+
+    ###########################################################################
+    def _notify_progress(self):
+        # called outside of the lock since listeners may serialize the state
+        if self.progress_listener:
+            self.progress_listener(self)
+
+    ###########################################################################
+    def to_document(self, display_only=False):
+        with self._lock:
+            completed_parts = [
+                {
+                    "partNumber": part_number,
+                    "etag": etag
+                }
+                for part_number, etag in sorted(self._completed_parts.items())
+            ]
+            return {
+                "_type": "MultipartUploadState",
+                "uploadId": self.upload_id,
+                "containerName": self.container_name,
+                "destinationPath": self.destination_path,
+                "fileSize": self.file_size,
+                "partSize": self.part_size,
+                "completedParts": completed_parts
+            }
+
 ###############################################################################
 # HELPERS
 ###############################################################################
@@ -1747,19 +2824,83 @@ def _download_progress(transferred, size):
 
 
 
+###############################################################################
+def _num_meter_callbacks(size):
+    # boto calls back at most num_cb times including the first and last ones
+    return size / BANDWIDTH_METER_SIZE + 2
+
+###############################################################################
+def _stream_part_size(part_number, base_part_size=None):
+    growth = (part_number - 1) / STREAM_PART_SIZE_GROWTH_INTERVAL
+    base_part_size = base_part_size or STREAM_PART_SIZE
+    return min(base_part_size * (2 ** growth), MAX_SPLIT_SIZE)
+
+###############################################################################
+def _file_parts(file_path, chunk_size, skip_parts=None):
+    """
+        Generates (part number, FileChunk) tuples for the specified file,
+        excluding part numbers in skip_parts.
+        Chunks are opened lazily so that only parts being uploaded hold open
+        file handles
+    """
+    file_size = os.path.getsize(file_path)
+    part_number = 1
+    offset = 0
+    while offset < file_size:
+        size = min(chunk_size, file_size - offset)
+        if not skip_parts or part_number not in skip_parts:
+            yield part_number, FileChunk(file_path, offset, size)
+        offset += size
+        part_number += 1
+
+###############################################################################
+def _stream_parts(stream, base_part_size=None):
+    """
+        Generates (part number, in memory part) tuples by reading the
+        specified stream until exhausted. At least one part is always
+        generated so that empty streams still produce a file
+    """
+    part_number = 1
+    while True:
+        data = stream.read(_stream_part_size(part_number,
+                                             base_part_size=base_part_size))
+        if not data and part_number > 1:
+            break
+        yield part_number, StringIO(data)
+        if not data:
+            break
+        part_number += 1
+
+###############################################################################
+def _segments_prefix(file_path):
+    return "%s_segments/" % file_path
+
+###############################################################################
+def _azure_block_id(part_number):
+    return base64.b64encode("%08d" % part_number)
+
+###############################################################################
+def _manifest_path(file_path):
+    return "%s.manifest" % file_path
+
 ###############################################################################
 # Concurrent multi target upload
 ###############################################################################
 def multi_target_upload_file(targets,
-                             file_path, **upload_kargs):
-
+                             file_path, upload_states=None, **upload_kargs):
+    """
+        upload_states: optional list of MultipartUploadState, one per target
+    """
     logger.info("MULTI TARGET UPLOAD: Starting concurrent target upload for "
                 "file '%s'" % file_path)
     uploaders = []
 
     # first kick off the uploads
-    for target in targets:
-        target_uploader = TargetUploader(target, file_path, **upload_kargs)
+    for i, target in enumerate(targets):
+        target_kargs = dict(upload_kargs)
+        if upload_states:
+            target_kargs["upload_state"] = upload_states[i]
+        target_uploader = TargetUploader(target, file_path, **target_kargs)
         uploaders.append(target_uploader)
         logger.info("Starting uploader for target: %s" % target)
         target_uploader.start()
@@ -1825,3 +2966,511 @@ class TargetUploader(Thread):
     def completed(self):
         return self.target_reference is not None or self.error is not None
 
+###############################################################################
+# UploadStream class
+###############################################################################
+class UploadStream(object):
+    """
+        Wraps a file object that is being written by a producer (e.g. a pipe)
+        and keeps track of bytes read. When the underlying file is exhausted,
+        reads block until the producer reports the outcome through finish() so
+        that a failed producer never results in a truncated upload
+    """
+    ###########################################################################
+    def __init__(self, file_obj):
+        self._file_obj = file_obj
+        self._bytes_read = 0
+        self._start_time = None
+        self._end_time = None
+        self._producer_finished = Event()
+        self._producer_error = None
+
+    ###########################################################################
+    def read(self, size):
+        if self._start_time is None:
+            self._start_time = time.time()
+
+        data = self._file_obj.read(size)
+        if data:
+            self._bytes_read += len(data)
+            return data
+
+        # end of stream. wait for the producer to report
+        self._producer_finished.wait()
+        self._end_time = time.time()
+        if self._producer_error:
+            raise errors.UploadStreamAbortedError(
+                "Upload stream aborted after %s bytes" % self._bytes_read,
+                cause=self._producer_error)
+        return data
+
+    ###########################################################################
+    def finish(self, error=None):
+        self._producer_error = error
+        self._producer_finished.set()
+
+    ###########################################################################
+    @property
+    def bytes_read(self):
+        return self._bytes_read
+
+    ###########################################################################
+    @property
+    def duration_in_seconds(self):
+        if self._start_time is not None:
+            return (self._end_time or time.time()) - self._start_time
+
+###############################################################################
+# TargetStreamUploader class
+###############################################################################
+class TargetStreamUploader(Thread):
+    """
+        Uploads the contents of a pipe to a target. The pipe is opened inside
+        the thread since opening a named pipe blocks until the writer opens it
+    """
+    ###########################################################################
+    def __init__(self, target, pipe_path, destination_path, metadata=None):
+        Thread.__init__(self)
+        self._target = target
+        self._pipe_path = pipe_path
+        self._destination_path = destination_path
+        self._metadata = metadata
+        self._stream = None
+        self._target_reference = None
+        self._error = None
+        self._stream_opened = Event()
+
+    ###########################################################################
+    def run(self):
+        try:
+            with open(self._pipe_path, "rb") as pipe:
+                self._stream = UploadStream(pipe)
+                self._stream_opened.set()
+                self._target_reference = self._target.put_stream(
+                    self._stream, self._destination_path,
+                    metadata=self._metadata)
+        except Exception, ex:
+            self._error = ex
+        finally:
+            self._stream_opened.set()
+
+    ###########################################################################
+    def finish(self, error=None):
+        """
+            Called by the producer when it is done writing to the pipe
+        """
+        # unblock the reader if the producer never opened the pipe
+        while self.is_alive() and not self._stream_opened.is_set():
+            try:
+                fd = os.open(self._pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                # reader did not open the pipe yet
+                pass
+            self._stream_opened.wait(1)
+
+        if self._stream:
+            self._stream.finish(error=error)
+
+    ###########################################################################
+    @property
+    def target(self):
+        return self._target
+
+    ###########################################################################
+    @property
+    def stream(self):
+        return self._stream
+
+    ###########################################################################
+    @property
+    def target_reference(self):
+        return self._target_reference
+
+    ###########################################################################
+    @property
+    def error(self):
+        return self._error
+
+###############################################################################
+# TargetStreamDownloader class
+###############################################################################
+class TargetStreamDownloader(Thread):
+    """
+        Downloads a file from a target into a pipe. The pipe is opened inside
+        the thread since opening a named pipe blocks until the reader opens it
+    """
+    ###########################################################################
+    def __init__(self, target, file_reference, pipe_path):
+        Thread.__init__(self)
+        self._target = target
+        self._file_reference = file_reference
+        self._pipe_path = pipe_path
+        self._downloaded_bytes = None
+        self._error = None
+        self._pipe_opened = Event()
+        self._finished = Event()
+
+    ###########################################################################
+    def run(self):
+        try:
+            with open(self._pipe_path, "wb") as pipe:
+                self._pipe_opened.set()
+                if self._finished.is_set():
+                    # reader exited without reading anything
+                    return
+                self._downloaded_bytes = self._target.download_to_stream(
+                    self._file_reference, pipe)
+        except Exception, ex:
+            # a reader that exited early reports its own error
+            if (not self._finished.is_set() and
+                    getattr(ex, "errno", None) != errno.EPIPE):
+                self._error = ex
+        finally:
+            self._pipe_opened.set()
+
+    ###########################################################################
+    def finish(self):
+        """
+            Called by the consumer when it is done reading from the pipe
+        """
+        self._finished.set()
+        # unblock the writer if the consumer never opened the pipe
+        while self.is_alive() and not self._pipe_opened.is_set():
+            try:
+                fd = os.open(self._pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+                self._pipe_opened.wait(1)
+                os.close(fd)
+            except OSError:
+                self._pipe_opened.wait(1)
+
+    ###########################################################################
+    @property
+    def target(self):
+        return self._target
+
+    ###########################################################################
+    @property
+    def downloaded_bytes(self):
+        return self._downloaded_bytes
+
+    ###########################################################################
+    @property
+    def error(self):
+        return self._error
+
+###############################################################################
+# BandwidthMeter class
+###############################################################################
+class BandwidthMeter(object):
+    """
+        Transfer progress callback (transferred, size) that draws transferred
+        bytes from the engine bandwidth every BANDWIDTH_METER_SIZE bytes so
+        that transfers are throttled as they go. Progress is passed on to
+        progress_callback
+    """
+    ###########################################################################
+    def __init__(self, progress_callback=None):
+        self._progress_callback = progress_callback
+        self._consumed = 0
+
+    ###########################################################################
+    def __call__(self, transferred, size):
+        # the transfer was restarted
+        if transferred < self._consumed:
+            self._consumed = 0
+
+        if (transferred - self._consumed >= BANDWIDTH_METER_SIZE or
+                (size and transferred >= size)):
+            bandwidth.consume(transferred - self._consumed)
+            self._consumed = transferred
+
+        if self._progress_callback and size:
+            self._progress_callback(transferred, size)
+
+###############################################################################
+# FileChunk class
+###############################################################################
+class FileChunk(object):
+    """
+        A read only file-like view over a section of a file. Each chunk has
+        its own file handle so chunks can be uploaded concurrently
+    """
+    ###########################################################################
+    def __init__(self, file_path, offset, size):
+        self._file = open(file_path, "rb")
+        self._offset = offset
+        self._size = size
+        self._file.seek(offset)
+
+    ###########################################################################
+    @property
+    def size(self):
+        return self._size
+
+    ###########################################################################
+    def tell(self):
+        return self._file.tell() - self._offset
+
+    ###########################################################################
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.tell()
+        elif whence == os.SEEK_END:
+            pos += self._size
+        pos = max(0, min(pos, self._size))
+        self._file.seek(self._offset + pos)
+
+    ###########################################################################
+    def __len__(self):
+        # size of uploads that are not given a file (e.g. cloudfiles)
+        return self._size
+
+    ###########################################################################
+    def read(self, size=-1):
+        remaining = self._size - self.tell()
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ""
+        return self._file.read(size)
+
+    ###########################################################################
+    def close(self):
+        self._file.close()
+
+###############################################################################
+# MultipartUploadPool class
+###############################################################################
+class MultipartUploadPool(object):
+    """
+        Uploads parts of a multipart upload concurrently using a bounded number
+        of worker threads. upload_part(part_number, part) does the actual
+        upload of a single part and its return value is collected per part
+        number. A failed part is retried on its own. Once a part fails for
+        good, remaining parts are dropped and the error is raised so that the
+        caller can abort the multipart upload. Unless throttle is False,
+        each part draws its size from the engine bandwidth before uploading
+    """
+    ###########################################################################
+    def __init__(self, upload_part, concurrency=DEFAULT_MULTIPART_CONCURRENCY,
+                 throttle=True):
+        self._upload_part = upload_part
+        self._concurrency = max(1, concurrency)
+        self._throttle = throttle
+        # bounded so that parts are read only as fast as they are uploaded
+        self._queue = Queue.Queue(maxsize=self._concurrency)
+        self._results = {}
+        self._errors = []
+        self._lock = Lock()
+        self._aborted = Event()
+
+    ###########################################################################
+    def upload(self, parts):
+        """
+            Uploads the specified iterable of (part number, part) tuples.
+            Returns a dict of part number => upload_part() result
+        """
+        workers = []
+        for i in range(self._concurrency):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        try:
+            for part in parts:
+                if self._aborted.is_set():
+                    _close_part(part[1])
+                    break
+                self._queue.put(part)
+        except Exception, ex:
+            self._fail(ex)
+            raise
+        finally:
+            for worker in workers:
+                self._queue.put(None)
+            for worker in workers:
+                worker.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+        return self._results
+
+    ###########################################################################
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            part_number, part = item
+            try:
+                # drain the queue after a failure
+                if not self._aborted.is_set():
+                    result = self._robustified_upload_part(part_number, part)
+                    with self._lock:
+                        self._results[part_number] = result
+            except Exception, ex:
+                logger.error("MultipartUploadPool: Failed to upload part %s: "
+                             "%s" % (part_number, ex))
+                self._fail(ex)
+            finally:
+                _close_part(part)
+
+    ###########################################################################
+    def _fail(self, error):
+        with self._lock:
+            self._errors.append(error)
+        self._aborted.set()
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5,
+               backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_upload_part(self, part_number, part):
+        logger.info("Uploading part %d" % part_number)
+        if self._throttle:
+            bandwidth.consume(_part_size(part))
+        # rewind in case of a retry
+        if hasattr(part, "seek"):
+            part.seek(0)
+        return self._upload_part(part_number, part)
+
+###############################################################################
+# RangedDownloadPool class
+###############################################################################
+class RangedDownloadPool(object):
+    """
+        Downloads a file with concurrent range requests and writes ranges to
+        the output in order. fetch_range(start, end) returns the bytes of the
+        inclusive range. At most 2 * concurrency ranges are held in memory.
+        Unless throttle is False, each range draws its size from the engine
+        bandwidth before being fetched
+    """
+    ###########################################################################
+    def __init__(self, fetch_range, concurrency=DEFAULT_MULTIPART_CONCURRENCY,
+                 throttle=True):
+        self._fetch_range = fetch_range
+        self._concurrency = max(1, concurrency)
+        self._throttle = throttle
+        self._queue = Queue.Queue()
+        # limits ranges fetched but not written yet
+        self._window = Semaphore(2 * self._concurrency)
+        self._results = {}
+        self._errors = []
+        self._condition = Condition()
+        self._aborted = Event()
+
+    ###########################################################################
+    def download(self, file_size, part_size, out):
+        """
+            Returns the number of bytes written to out
+        """
+        ranges = []
+        start = 0
+        while start < file_size:
+            end = min(start + part_size, file_size) - 1
+            ranges.append((start, end))
+            start = end + 1
+
+        return self.download_ranges(ranges, out)
+
+    ###########################################################################
+    def download_ranges(self, ranges, out):
+        """
+            Downloads the specified list of consecutive inclusive
+            (start, end) ranges. Returns the number of bytes written to out
+        """
+        # workers take a window slot before taking a range so that ranges
+        # are always fetched in order of need
+        for i, byte_range in enumerate(ranges):
+            self._queue.put((i, byte_range))
+
+        workers = []
+        for i in range(min(self._concurrency, len(ranges))):
+            self._queue.put(None)
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        bytes_written = 0
+        try:
+            for i in range(len(ranges)):
+                data = self._wait_for_range(i)
+                out.write(data)
+                bytes_written += len(data)
+                self._window.release()
+        except Exception:
+            self._aborted.set()
+            # unblock workers waiting for a window slot
+            for worker in workers:
+                self._window.release()
+            raise
+
+        for worker in workers:
+            worker.join()
+
+        return bytes_written
+
+    ###########################################################################
+    def _wait_for_range(self, index):
+        with self._condition:
+            while index not in self._results and not self._errors:
+                self._condition.wait(1)
+            if self._errors:
+                raise self._errors[0]
+            return self._results.pop(index)
+
+    ###########################################################################
+    def _work(self):
+        while not self._aborted.is_set():
+            self._window.acquire()
+            item = self._queue.get()
+            if item is None or self._aborted.is_set():
+                break
+
+            index, (start, end) = item
+            try:
+                data = self._robustified_fetch_range(start, end)
+                with self._condition:
+                    self._results[index] = data
+                    self._condition.notify_all()
+            except Exception, ex:
+                logger.error("RangedDownloadPool: Failed to download range "
+                             "%s-%s: %s" % (start, end, ex))
+                self._aborted.set()
+                with self._condition:
+                    self._errors.append(ex)
+                    self._condition.notify_all()
+
+    ###########################################################################
+    @robustify(max_attempts=5, retry_interval=5,
+               backoff=2,
+               do_on_exception=errors.raise_if_not_retriable,
+               do_on_failure=errors.raise_exception)
+    def _robustified_fetch_range(self, start, end):
+        if self._throttle:
+            bandwidth.consume(end - start + 1)
+        data = self._fetch_range(start, end)
+        expected_size = end - start + 1
+        if len(data) != expected_size:
+            raise errors.TargetConnectionError(
+                cause=Exception("IncompleteRead: got %s bytes of range %s-%s" %
+                                (len(data), start, end)))
+        return data
+
+###############################################################################
+def _part_size(part):
+    if isinstance(part, FileChunk):
+        return part.size
+    part.seek(0, os.SEEK_END)
+    return part.tell()
+
+###############################################################################
+def _close_part(part):
+    if hasattr(part, "close"):
+        part.close()
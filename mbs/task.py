@@ -1,8 +1,8 @@
 __author__ = 'abdul'
 
-
-from date_utils import date_now
+from date_utils import date_now, date_plus_seconds
 from base import MBSObject
+from utils import document_key_attribute_name
 
 from globals import *
 ###############################################################################
@@ -10,6 +10,11 @@ from globals import *
 ###############################################################################
 EVENT_STATE_CHANGE = "STATE_CHANGE"
 
+# Each priority level delays when a scheduled task gets claimed by this many
+# seconds. A task that waited longer than that gets ahead of newer tasks with
+# higher priority (anti-starvation)
+PRIORITY_AGING_SECONDS = 60
+
 ###############################################################################
 # MBSTask
 ###############################################################################
@@ -24,11 +29,14 @@ class MBSTask(MBSObject):
         self._engine_guid = None
         self._strategy = None
         self._logs = []
+        self._archived_event_counts = None
+        self._index_logs()
         self._start_date = None
         self._end_date = None
         self._tags = None
         self._try_count = 0
         self._priority = Priority.LOW
+        self._priority_date = None
         self._queue_latency_in_minutes = None
         self._log_target_reference = None
         self._next_retry_date = None
@@ -119,6 +127,37 @@ class MBSTask(MBSObject):
     @logs.setter
     def logs(self, logs):
         self._logs = logs
+        self._index_logs()
+
+    ###########################################################################
+    @property
+    def archived_event_counts(self):
+        """
+            Event name => number of log entries of that event that were
+            archived out of logs
+        """
+        return self._archived_event_counts
+
+    @archived_event_counts.setter
+    def archived_event_counts(self, val):
+        self._archived_event_counts = val
+
+    ###########################################################################
+    def _index_logs(self):
+        """
+            Indexes log entries so that event queries do not scan the logs
+        """
+        self._logs_by_name = {}
+        self._logs_by_type = {}
+        self._state_first_entries = {}
+        for log_entry in self._logs:
+            self._index_log_entry(log_entry)
+
+    ###########################################################################
+    def _index_log_entry(self, log_entry):
+        self._logs_by_name.setdefault(log_entry.name, []).append(log_entry)
+        self._logs_by_type.setdefault(log_entry.event_type, []).append(log_entry)
+        self._state_first_entries.setdefault(log_entry.state, log_entry)
 
     ###########################################################################
     @property
@@ -188,6 +227,28 @@ class MBSTask(MBSObject):
     def priority(self, val):
         self._priority = val
 
+    ###########################################################################
+    @property
+    def priority_date(self):
+        """
+            Scheduled tasks are claimed in order of priority date
+        """
+        return self._priority_date
+
+    @priority_date.setter
+    def priority_date(self, val):
+        self._priority_date = val
+
+    ###########################################################################
+    def reset_priority_date(self):
+        """
+            Sets the priority date to now delayed by the task priority. Should
+            be called whenever the task gets (re)scheduled
+        """
+        priority = Priority.LOW if self.priority is None else self.priority
+        self.priority_date = date_plus_seconds(
+            date_now(), priority * PRIORITY_AGING_SECONDS)
+
     ###########################################################################
     @property
     def queue_latency_in_minutes(self):
@@ -228,8 +289,6 @@ class MBSTask(MBSObject):
     ###########################################################################
     def log_event(self, event_type=EventType.INFO, name=None, message=None,
                   details=None, error_code=None):
-        logs = self.logs
-
         log_entry = EventLogEntry()
         log_entry.event_type = event_type
         log_entry.name = name
@@ -239,10 +298,51 @@ class MBSTask(MBSObject):
         log_entry.details = details
         log_entry.error_code = error_code
 
-        logs.append(log_entry)
-        self.logs = logs
+        self._logs.append(log_entry)
+        self._index_log_entry(log_entry)
         return log_entry
 
+    ###########################################################################
+    def get_archivable_logs(self, max_entries):
+        """
+            Returns the oldest log entries to remove so that at most
+            max_entries remain, when possible. Entries that event queries
+            depend on are never archived: state changes, warnings/errors,
+            the first entry of each state and the last entry of each event
+        """
+        excess = len(self._logs) - max_entries
+        if excess <= 0:
+            return []
+
+        keep = set(id(entry) for entry in self._state_first_entries.values())
+        keep.update(id(entries[-1]) for entries in self._logs_by_name.values())
+
+        archivable = []
+        for log_entry in self._logs:
+            if len(archivable) == excess:
+                break
+            if (id(log_entry) not in keep and
+                    log_entry.event_type == EventType.INFO and
+                    log_entry.name != EVENT_STATE_CHANGE):
+                archivable.append(log_entry)
+
+        return archivable
+
+    ###########################################################################
+    def archive_logs(self, log_entries):
+        """
+            Removes the specified entries (from get_archivable_logs()) from
+            logs while keeping their counts for event_logged_count()
+        """
+        archived = set(id(entry) for entry in log_entries)
+        counts = self.archived_event_counts or {}
+        for log_entry in log_entries:
+            if log_entry.name:
+                counts[log_entry.name] = counts.get(log_entry.name, 0) + 1
+
+        self.archived_event_counts = counts
+        self.logs = filter(lambda entry: id(entry) not in archived, self._logs)
+
 
     ###########################################################################
     def exceeded_max_tries(self):
@@ -259,9 +359,7 @@ class MBSTask(MBSObject):
 
     ###########################################################################
     def has_failed(self):
-        if self.logs:
-            failures = filter(lambda l: l.state == State.FAILED, self.logs)
-            return failures and len(failures) > 0
+        return State.FAILED in self._state_first_entries
 
     ###########################################################################
     def has_warnings(self):
@@ -292,19 +390,18 @@ class MBSTask(MBSObject):
 
     ###########################################################################
     def get_last_scheduled_date(self):
-        scheduled_events = filter(lambda entry: (entry.name == EVENT_STATE_CHANGE and
-                                                 entry.state == State.SCHEDULED),
-                                  self.logs)
-        if scheduled_events:
-            return scheduled_events[-1].date
+        state_changes = self._logs_by_name.get(EVENT_STATE_CHANGE, [])
+        for log_entry in reversed(state_changes):
+            if log_entry.state == State.SCHEDULED:
+                return log_entry.date
 
     ###########################################################################
     def _get_logs_by_event_type(self, event_type):
-        return filter(lambda entry: entry.event_type == event_type, self.logs)
+        return list(self._logs_by_type.get(event_type, []))
 
     ###########################################################################
     def _get_logs_by_event_name(self, event_name):
-        return filter(lambda entry: entry.name == event_name, self.logs)
+        return list(self._logs_by_name.get(event_name, []))
 
     ###########################################################################
     def is_event_logged(self, event_name):
@@ -318,15 +415,16 @@ class MBSTask(MBSObject):
 
     ###########################################################################
     def event_logged_count(self, event_name):
-        logs = filter(lambda entry: entry.name == event_name, self.logs)
-        return len(logs)
+        count = len(self._logs_by_name.get(event_name, []))
+        if self.archived_event_counts:
+            count += self.archived_event_counts.get(event_name, 0)
+        return count
 
     ###########################################################################
     def get_last_event_entry(self, event_name):
-        if self.logs:
-            event_logs = self._get_logs_by_event_name(event_name)
-            if event_logs:
-                return event_logs[-1]
+        event_logs = self._logs_by_name.get(event_name)
+        if event_logs:
+            return event_logs[-1]
 
     ###########################################################################
     def _get_state_set_date(self, state):
@@ -335,9 +433,9 @@ class MBSTask(MBSObject):
            None if state was never set
         """
 
-        state_logs = filter(lambda entry: entry.state == state, self.logs)
-        if state_logs:
-            return state_logs[0].date
+        log_entry = self._state_first_entries.get(state)
+        if log_entry:
+            return log_entry.date
 
     ###########################################################################
     def to_document(self, display_only=False):
@@ -368,6 +466,9 @@ class MBSTask(MBSObject):
         if self.priority is not None:
             doc["priority"] = self.priority
 
+        if self.priority_date is not None:
+            doc["priorityDate"] = self.priority_date
+
         if self.queue_latency_in_minutes is not None:
             doc["queueLatencyInMinutes"] = self.queue_latency_in_minutes
 
@@ -377,8 +478,42 @@ class MBSTask(MBSObject):
         if self.worker_info:
             doc["workerInfo"] = self.worker_info
 
+        if self.archived_event_counts:
+            doc["archivedEventCounts"] = self.archived_event_counts
+
+        return doc
+
+    ###########################################################################
+    def export_properties(self, properties):
+        """
+            Returns the document values of the specified properties (document
+            keys) without serializing the whole task like to_document()
+        """
+        doc = {}
+        full_doc = None
+        for prop in properties:
+            value = self.export_property(prop)
+            if value is _NOT_EXPORTED:
+                # not backed by a property so it takes a full serialization
+                if full_doc is None:
+                    full_doc = self.to_document()
+                value = full_doc.get(prop)
+            doc[prop] = value
+
         return doc
 
+    ###########################################################################
+    def export_property(self, prop):
+        """
+            Exports the property backing the specified document key. Can be
+            overridden by subclasses for keys exported differently
+        """
+        attr = document_key_attribute_name(prop)
+        if not isinstance(getattr(type(self), attr, None), property):
+            return _NOT_EXPORTED
+
+        return _export_value(getattr(self, attr))
+
     ###########################################################################
     def export_logs(self, event_type=None):
         result = []
@@ -404,6 +539,20 @@ class MBSTask(MBSObject):
             return exported_tags
 
 
+###############################################################################
+_NOT_EXPORTED = object()
+
+###############################################################################
+def _export_value(value):
+    if isinstance(value, MBSObject):
+        return value.to_document()
+    elif isinstance(value, list):
+        return map(_export_value, value)
+    elif isinstance(value, dict):
+        return dict((k, _export_value(v)) for k, v in value.items())
+    else:
+        return value
+
 ###############################################################################
 # EventLogEntry
 ###############################################################################
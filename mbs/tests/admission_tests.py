@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+
+from mock import patch, Mock
+
+import mbs.admission
+
+from . import BaseTest
+
+
+###############################################################################
+# AdmissionControllerTest
+###############################################################################
+class AdmissionControllerTest(BaseTest):
+
+    ###########################################################################
+    def test_budget_counts_unwritten_reservations(self):
+        mb = 1024 * 1024
+        workspace_dir = tempfile.mkdtemp()
+        try:
+            controller = mbs.admission.AdmissionController()
+            controller.workspace_headroom_percentage = 0
+            task = Mock(id='task1', type_name='Backup')
+            with patch.object(controller, 'estimate_workspace_size',
+                              return_value=10 * mb), \
+                 patch.object(controller, '_get_task_workspace_dir',
+                              return_value=workspace_dir):
+                controller.reserve(task)
+
+            # the running task wrote 4 of its 10 MB. Free space reflects them
+            with open(os.path.join(workspace_dir, 'dump'), 'wb') as dump:
+                dump.write('x' * 4 * mb)
+
+            disk = Mock(f_blocks=100, f_bavail=50, f_frsize=mb)
+            with patch.object(mbs.admission.os, 'statvfs',
+                              return_value=disk), \
+                 patch.object(controller, '_get_workspace_dir',
+                              return_value=workspace_dir), \
+                 patch.object(controller, '_get_outbound_rate',
+                              return_value=0):
+                budget = controller._get_budget()
+
+            self.assertEqual(budget['reservedWorkspaceBytes'], 6 * mb)
+            self.assertEqual(budget['availableWorkspaceBytes'], 44 * mb)
+        finally:
+            shutil.rmtree(workspace_dir)
@@ -0,0 +1,92 @@
+from datetime import timedelta
+
+from mock import patch, Mock
+
+import mbs.backup_system
+import mbs.scheduler
+
+from mbs.date_utils import date_now
+from mbs.plan import BackupPlan
+from mbs.schedule import Schedule
+from mbs.source import MongoSource
+from mbs.strategy import DumpStrategy
+from mbs.target import S3BucketTarget
+
+from . import BaseTest
+
+
+###############################################################################
+# BackupSystemTest
+###############################################################################
+class BackupSystemTest(BaseTest):
+
+    ###########################################################################
+    def _make_due_plan(self):
+        plan = BackupPlan()
+        plan.id = 'plan1'
+        plan.schedule = Schedule(frequency_in_seconds=3600)
+        plan.next_occurrence = date_now() - timedelta(seconds=5)
+        plan.strategy = DumpStrategy()
+        plan.source = MongoSource()
+        plan.target = S3BucketTarget()
+        return plan
+
+    ###########################################################################
+    def test_schedule_plan_backups_next_occurrence(self):
+        plan = self._make_due_plan()
+        due_occurrence = plan.next_occurrence
+
+        def insert_many(docs, ordered=True):
+            for i, doc in enumerate(docs):
+                doc['_id'] = i
+
+        mbs_mock = Mock()
+        insert_many_mock = mbs_mock.backup_collection.collection.insert_many
+        insert_many_mock.side_effect = insert_many
+
+        def find_past_cycle(q, projection=None):
+            docs = insert_many_mock.call_args[0][0]
+            return [Mock(id=doc['_id']) for doc in docs
+                    if doc['plan']['nextOccurrence'] <=
+                    q['plan.nextOccurrence']['$lte']]
+        mbs_mock.backup_collection.find.side_effect = find_past_cycle
+        backup_system = mbs.backup_system.BackupSystem.__new__(
+            mbs.backup_system.BackupSystem)
+        backup_system._scheduler = Mock()
+        with patch.object(mbs.backup_system, 'get_mbs', return_value=mbs_mock), \
+             patch.object(mbs.scheduler, 'get_mbs', return_value=mbs_mock), \
+             patch.object(backup_system, '_resolve_task_tags'), \
+             patch.object(backup_system, '_request_plan_retention'), \
+             patch.object(backup_system, 'info'):
+            backups = backup_system.schedule_plan_backups([plan])
+            scheduler = mbs.scheduler.BackupScheduler(backup_system)
+            scheduler._cancel_past_cycle_backups()
+
+        self.assertEqual(len(backups), 1)
+        backup_doc = insert_many_mock.call_args[0][0][0]
+        self.assertEqual(backup_doc['planOccurrence'], due_occurrence)
+        # the backup carries the advanced next occurrence so that it is not
+        # canceled as past its cycle
+        self.assertGreater(backup_doc['plan']['nextOccurrence'], date_now())
+        self.assertFalse(mbs_mock.backup_collection.update_task.called)
+
+    ###########################################################################
+    def test_schedule_plan_backups_failed_insert(self):
+        plan = self._make_due_plan()
+        due_occurrence = plan.next_occurrence
+
+        mbs_mock = Mock()
+        mbs_mock.backup_collection.collection.insert_many.side_effect = \
+            Exception('insert failed')
+        backup_system = mbs.backup_system.BackupSystem.__new__(
+            mbs.backup_system.BackupSystem)
+        backup_system._scheduler = Mock()
+        with patch.object(mbs.backup_system, 'get_mbs', return_value=mbs_mock), \
+             patch.object(backup_system, '_resolve_task_tags'), \
+             patch.object(backup_system, 'info'):
+            self.assertRaises(Exception, backup_system.schedule_plan_backups,
+                              [plan])
+
+        # still due
+        self.assertEqual(plan.next_occurrence, due_occurrence)
+        self.assertFalse(backup_system._scheduler.plan_updated.called)
@@ -0,0 +1,335 @@
+import random
+import threading
+import time
+
+from datetime import timedelta
+
+from bson import ObjectId
+from makerpy.maker import Maker
+from pymongo import MongoClient
+
+from mbs.backup import Backup
+from mbs.collection import MBSTaskCollection
+from mbs.date_utils import date_now, date_plus_seconds
+from mbs.engine import claim_next_task
+from mbs.globals import State, Priority
+from mbs.indexes import MBS_INDEXES
+from mbs.object_maker import ObjectMaker
+from mbs.schedule import CronSchedule
+from mbs.scheduler import PlanOccurrenceHeap
+from mbs.task import PRIORITY_AGING_SECONDS
+from mbs.type_bindings import TYPE_BINDINGS
+
+from . import BaseTest
+
+
+###############################################################################
+def _percentile(values, percentile):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percentile / 100.0))
+    return values[index]
+
+
+###############################################################################
+def _print_latencies(name, latencies):
+    print("%s: %s ops, p50 %.2f ms, p99 %.2f ms, max %.2f ms" %
+          (name, len(latencies),
+           _percentile(latencies, 50) * 1000,
+           _percentile(latencies, 99) * 1000,
+           max(latencies) * 1000))
+
+
+###############################################################################
+def _backup_document(plan_id, now):
+    logs = []
+    for i, state in enumerate([State.SCHEDULED, State.IN_PROGRESS,
+                               State.SUCCEEDED]):
+        logs.append({
+            "_type": "EventLogEntry",
+            "name": "STATE_CHANGE",
+            "eventType": "INFO",
+            "date": date_plus_seconds(now, i),
+            "state": state,
+            "message": "State changed to %s" % state
+        })
+
+    return {
+        "_type": "Backup",
+        "state": State.SUCCEEDED,
+        "createdDate": now,
+        "engineGuid": "engine-1",
+        "plan": {
+            "_type": "Plan",
+            "_id": plan_id,
+            "description": "benchmark plan",
+            "schedule": {
+                "_type": "Schedule",
+                "frequencyInSeconds": 24 * 60 * 60
+            },
+            "source": {
+                "_type": "MongoSource",
+                "uri": "mongodb://localhost:27017/benchmark"
+            },
+            "target": {
+                "_type": "S3BucketTarget",
+                "bucketName": "benchmark-bucket"
+            },
+            "strategy": {
+                "_type": "DumpStrategy"
+            }
+        },
+        "source": {
+            "_type": "MongoSource",
+            "uri": "mongodb://localhost:27017/benchmark"
+        },
+        "target": {
+            "_type": "S3BucketTarget",
+            "bucketName": "benchmark-bucket"
+        },
+        "strategy": {
+            "_type": "DumpStrategy"
+        },
+        "targetReference": {
+            "_type": "FileReference",
+            "fileName": "backup.tgz",
+            "fileSize": 1024 * 1024
+        },
+        "logs": logs
+    }
+
+
+###############################################################################
+def _restore_document(backup_doc):
+    return {
+        "_type": "Restore",
+        "state": State.SUCCEEDED,
+        "createdDate": backup_doc["createdDate"],
+        "sourceBackup": backup_doc,
+        "sourceDatabaseName": "benchmark",
+        "destination": {
+            "_type": "MongoSource",
+            "uri": "mongodb://localhost:27017/restored"
+        },
+        "dataStats": {},
+        "valid": True,
+        "logs": backup_doc["logs"]
+    }
+
+
+###############################################################################
+def _time_per_op(func, num_ops):
+    start = time.time()
+    for i in xrange(num_ops):
+        func()
+    return (time.time() - start) / num_ops
+
+
+###############################################################################
+# BenchmarkTest
+###############################################################################
+class BenchmarkTest(BaseTest):
+    """
+        Benchmarks against a live mongod. Requires MBS_RUN_INT_TESTS and
+        MBS_BENCHMARK_MONGO_URI (database is dropped!)
+    """
+
+    ###########################################################################
+    def _get_benchmark_db(self):
+        self._check_run_int_tests_else_skip()
+        uri = self._get_env_var_or_skip('MBS_BENCHMARK_MONGO_URI')
+        return MongoClient(uri).get_default_database()
+
+    ###########################################################################
+    def test_claim_latency(self):
+        num_tasks = 10000
+        num_engines = 4
+
+        db = self._get_benchmark_db()
+        collection = db["backups"]
+        collection.drop()
+        for index in MBS_INDEXES["backups"]:
+            collection.create_index(index["index"])
+
+        now = date_now()
+        priorities = [Priority.HIGH, Priority.MEDIUM, Priority.LOW]
+        docs = []
+        for i in range(num_tasks):
+            priority = random.choice(priorities)
+            docs.append({
+                "_type": "Backup",
+                "state": State.SCHEDULED,
+                "engineGuid": None,
+                "priority": priority,
+                "priorityDate": date_plus_seconds(
+                    now, i + priority * PRIORITY_AGING_SECONDS),
+                "logs": []
+            })
+        collection.insert_many(docs)
+
+        latencies = []
+        claimed = []
+        lock = threading.Lock()
+
+        def engine(engine_guid):
+            while True:
+                start = time.time()
+                doc = claim_next_task(collection, {"state": State.SCHEDULED},
+                                      engine_guid)
+                elapsed = time.time() - start
+                if not doc:
+                    break
+                with lock:
+                    latencies.append(elapsed)
+                    claimed.append(doc["_id"])
+
+        engines = [threading.Thread(target=engine, args=("engine-%s" % i,))
+                   for i in range(num_engines)]
+        for thread in engines:
+            thread.start()
+        for thread in engines:
+            thread.join()
+
+        _print_latencies("claim (%s tasks, %s engines)" %
+                         (num_tasks, num_engines), latencies)
+
+        # every task is claimed exactly once
+        self.assertEqual(len(claimed), num_tasks)
+        self.assertEqual(len(set(claimed)), num_tasks)
+        collection.drop()
+
+    ###########################################################################
+    def test_projected_loading(self):
+        num_backups = 1000000
+        num_plans = 1000
+
+        db = self._get_benchmark_db()
+        db["backups"].drop()
+        backups = MBSTaskCollection(db["backups"], clazz=Backup,
+                                    type_bindings=TYPE_BINDINGS)
+
+        now = date_now()
+        plan_ids = [ObjectId() for i in range(num_plans)]
+        docs = []
+        for i in range(num_backups):
+            docs.append(_backup_document(plan_ids[i % num_plans], now))
+            if len(docs) == 10000:
+                backups.collection.insert_many(docs)
+                docs = []
+
+        def timed(name, **find_kwargs):
+            start = time.time()
+            plan_ids_read = set()
+            for backup in backups.find_iter({}, **find_kwargs):
+                # what the retention loops read from every backup
+                if backup.state == State.SUCCEEDED:
+                    plan_ids_read.add(backup.plan.id)
+            elapsed = time.time() - start
+            print("%s: %s backups in %.1f s" % (name, num_backups, elapsed))
+            self.assertEqual(len(plan_ids_read), num_plans)
+            return elapsed
+
+        full = timed("full")
+        lazy = timed("lazy", lazy=True)
+        projected = timed("projected", projection=["state", "plan._id"])
+
+        self.assertLess(lazy, full)
+        self.assertLess(projected, lazy)
+        db["backups"].drop()
+
+    ###########################################################################
+    def test_object_making(self):
+        self._check_run_int_tests_else_skip()
+        num_ops = 20000
+
+        backup_doc = _backup_document(ObjectId(), date_now())
+        backup_doc["_id"] = ObjectId()
+        docs = {
+            "Backup": backup_doc,
+            "BackupPlan": backup_doc["plan"],
+            "Restore": _restore_document(backup_doc)
+        }
+
+        maker = Maker(type_bindings=TYPE_BINDINGS)
+        object_maker = ObjectMaker(type_bindings=TYPE_BINDINGS)
+        for name, doc in sorted(docs.items()):
+            obj = object_maker.make(doc)
+            self.assertEqual(obj.to_document(), maker.make(doc).to_document())
+
+            make = _time_per_op(lambda: maker.make(doc), num_ops)
+            compiled_make = _time_per_op(lambda: object_maker.make(doc),
+                                         num_ops)
+            to_document = _time_per_op(obj.to_document, num_ops)
+            print("%s: make %.1f us, compiled make %.1f us, "
+                  "to_document %.1f us" %
+                  (name, make * 1e6, compiled_make * 1e6, to_document * 1e6))
+
+            self.assertLess(compiled_make, make)
+
+    ###########################################################################
+    def test_plan_occurrences(self):
+        num_plans = 100000
+
+        db = self._get_benchmark_db()
+        collection = db["plans"]
+        collection.drop()
+        for index in MBS_INDEXES["plans"]:
+            collection.create_index(index["index"])
+
+        # all plans occur at the top of the hour
+        top_of_hour = date_now().replace(minute=0, second=0, microsecond=0)
+        collection.insert_many([{
+            "_type": "Plan",
+            "nextOccurrence": top_of_hour,
+            "priority": random.choice([Priority.HIGH, Priority.LOW])
+        } for i in range(num_plans)])
+
+        start = time.time()
+        heap = PlanOccurrenceHeap()
+        projection = {"_id": 1, "nextOccurrence": 1, "priority": 1}
+        for plan_doc in collection.find({"nextOccurrence": {"$lte": top_of_hour}}, projection):
+            heap.set(plan_doc["_id"], plan_doc["nextOccurrence"], priority=plan_doc["priority"])
+        load_time = time.time() - start
+
+        start = time.time()
+        due = heap.pop_due(top_of_hour)
+        pop_time = time.time() - start
+
+        print("plan occurrences: loaded %s plans in %.2f s (%d plans/s), "
+              "popped in %.2f s (%d plans/s)" %
+              (num_plans, load_time, num_plans / load_time,
+               pop_time, num_plans / max(pop_time, 1e-6)))
+
+        self.assertEqual(len(due), num_plans)
+        collection.drop()
+
+    ###########################################################################
+    def test_cron_occurrences(self):
+        self._check_run_int_tests_else_skip()
+        num_days = 30
+
+        for expression in ['* * * * *', '*/5 * * * *', '0 2 * * 1,2']:
+            cron_sched = CronSchedule()
+            cron_sched.expression = expression
+            croniter_sched = CronSchedule()
+            croniter_sched.expression = expression
+            croniter_sched._compiled_cron = False
+
+            # what the plan schedule auditor computes for a month of audits
+            days = [date_now().replace(hour=0, minute=0, second=0,
+                                       microsecond=0) - timedelta(days=i)
+                    for i in range(num_days)]
+            start = time.time()
+            expected = [croniter_sched.natural_occurrences_as_of(day)
+                        for day in days]
+            croniter_time = time.time() - start
+
+            start = time.time()
+            occurrences = [cron_sched.natural_occurrences_as_of(day)
+                           for day in days]
+            compiled_time = time.time() - start
+
+            print("cron '%s': %s days, croniter %.3f s, compiled %.3f s" %
+                  (expression, num_days, croniter_time, compiled_time))
+
+            self.assertEqual(occurrences, expected)
+            self.assertLess(compiled_time, croniter_time)
@@ -0,0 +1,52 @@
+from mock import patch, Mock
+
+import mbs.engine
+
+from . import BaseTest
+
+
+###############################################################################
+# TaskQueueProcessorTest
+###############################################################################
+class TaskQueueProcessorTest(BaseTest):
+
+    ###########################################################################
+    def test_cancel_pooled_task(self):
+        task = Mock(id='task1', type_name='Backup')
+        engine = Mock()
+        engine.get_task_collection_by_name.return_value.find_iter.side_effect = \
+            lambda q: [task]
+        pool = Mock()
+        pool.run_task.side_effect = lambda request: Mock(
+            pid=len(pool.run_task.call_args_list),
+            **{'read_result.return_value': {'exitCode': 0}})
+
+        processor = mbs.engine.TaskQueueProcessor('backups', 'Backup',
+                                                  'backups', engine)
+        processor._worker_pool = pool
+        processor._start_new_worker(task)
+
+        with patch.object(mbs.engine, 'force_kill_process_and_children') as kill:
+            processor._monitor_cancel_requests()
+            # the task process is killed and a pooled cleaner is started
+            kill.assert_called_once_with(1)
+            self.assertTrue(pool.run_task.call_args[0][0]['clean'])
+
+            # later polls leave the running cleaner alone
+            processor._monitor_cancel_requests()
+            processor._monitor_cancel_requests()
+            self.assertEqual(kill.call_count, 1)
+            self.assertEqual(pool.run_task.call_count, 2)
+
+    ###########################################################################
+    def test_failed_task_start_releases_reservation(self):
+        task = Mock(id='task1', type_name='Backup')
+        engine = Mock()
+        processor = mbs.engine.TaskQueueProcessor('backups', 'Backup',
+                                                  'backups', engine)
+        with patch.object(processor, '_admit_next_task', return_value=task), \
+             patch.object(processor, '_start_new_worker',
+                          side_effect=Exception('no worker')):
+            self.assertRaises(Exception, processor._start_next_tasks)
+
+        engine.admission_control.release.assert_called_once_with(task)
@@ -95,3 +95,28 @@ class MBSTest(BaseTest):
             if tempdir2 is not None:
                 shutil.rmtree(tempdir2)
 
+
+    ###########################################################################
+    def test_ensure_mbs_indexes_failure(self):
+        database = mock.MagicMock()
+        ensure_index = database.__getitem__.return_value.ensure_index
+
+        def fail_unique(index, **kwargs):
+            if kwargs.get('unique'):
+                raise Exception('E11000 duplicate key error')
+        ensure_index.side_effect = fail_unique
+
+        class InlineThread(object):
+            def __init__(self, target):
+                self._target = target
+
+            def start(self):
+                self._target()
+
+        with mock.patch.object(mbs.mbs.MBS, 'database', database), \
+             mock.patch.object(mbs.mbs.threading, 'Thread', InlineThread):
+            mbs.mbs.MBS.__new__(mbs.mbs.MBS).ensure_mbs_indexes()
+
+        # a failed index does not stop the others from being ensured
+        total = sum(len(indexes) for indexes in mbs.mbs.MBS_INDEXES.values())
+        self.assertEqual(ensure_index.call_count, total)
@@ -110,3 +110,96 @@ class CronScheduleTest(BaseTest):
             cron_sched._max_acceptable_lag_for_period(timedelta(1)),
             cron_sched.max_acceptable_lag(datetime(2012, 10, 8, 3)))
 
+
+    ###########################################################################
+    def test_compiled_cron(self):
+        start = datetime(2012, 10, 1, 3, 5, 2)
+        for expression in ['*/5 * * * *', '0 2 * * 1,2', '15 3 1,15 * 5',
+                           '30 */6 * jan-mar sun']:
+            cron_sched = self.mbs.maker.make({'_type': 'CronSchedule',
+                                              'expression': expression})
+            self.assertTrue(cron_sched._get_compiled_cron())
+            croniter_sched = self.mbs.maker.make({'_type': 'CronSchedule',
+                                                  'expression': expression})
+            croniter_sched._compiled_cron = False
+
+            for dt in [start, start.replace(second=0), datetime(2012, 10, 8)]:
+                for method in ['next_natural_occurrence',
+                               'last_natural_occurrence', '_is_occurrence',
+                               'max_acceptable_lag']:
+                    self.assertEqual(getattr(cron_sched, method)(dt),
+                                     getattr(croniter_sched, method)(dt))
+            self.assertSequenceEqual(
+                cron_sched.natural_occurrences_between(start,
+                                                       start + timedelta(30)),
+                croniter_sched.natural_occurrences_between(
+                    start, start + timedelta(30)))
+
+        # not supported by CompiledCron
+        self.assertIsNone(schedule.compile_cron('5 4 * * mon#2'))
+
+
+###############################################################################
+# ScheduleTest
+###############################################################################
+class ScheduleTest(BaseTest):
+
+    ###########################################################################
+    def test_occurrence_arithmetic(self):
+        sched = self.mbs.maker.make({'_type': 'Schedule',
+                                     'frequencyInSeconds': 300,
+                                     'offset': datetime(2012, 1, 1, 0, 2)})
+        start = datetime(2012, 10, 1, 3, 5, 2)
+        end = start + timedelta(days=3, seconds=11)
+        occurrences = sched.natural_occurrences_between(start, end)
+
+        self.assertEqual(occurrences[0], datetime(2012, 10, 1, 3, 7))
+        self.assertEqual(sched.count_natural_occurrences_between(start, end),
+                         len(occurrences))
+        self.assertEqual(sched.nth_natural_occurrence(10, start),
+                         occurrences[10])
+        self.assertTrue(sched.is_natural_occurrence_between(occurrences[-1],
+                                                            start, end))
+        self.assertFalse(sched.is_natural_occurrence_between(
+            occurrences[-1] + timedelta(seconds=1), start, end))
+
+        # composite occurrences are merged without duplicates
+        cron_sched = self.mbs.maker.make({'_type': 'CronSchedule',
+                                          'expression': '*/10 * * * *'})
+        composite = schedule.CompositeSchedule([sched, cron_sched])
+        expected = sorted(set(occurrences +
+                              cron_sched.natural_occurrences_between(start,
+                                                                     end)))
+        self.assertSequenceEqual(
+            composite.natural_occurrences_between(start, end), expected)
+        self.assertEqual(
+            composite.count_natural_occurrences_between(start, end),
+            len(expected))
+        self.assertEqual(composite.nth_natural_occurrence(3, start),
+                         expected[3])
+
+
+###############################################################################
+# PlanOccurrenceHeapTest
+###############################################################################
+class PlanOccurrenceHeapTest(BaseTest):
+
+    ###########################################################################
+    def test_pop_due(self):
+        from mbs.scheduler import PlanOccurrenceHeap
+
+        now = datetime(2020, 1, 1)
+        heap = PlanOccurrenceHeap()
+        heap.set('a', now + timedelta(seconds=10))
+        heap.set('b', now, priority=5)
+        heap.set('c', now, priority=1)
+        heap.set('d', now)
+        heap.remove('d')
+        # moved to later
+        heap.set('b', now + timedelta(seconds=20))
+
+        self.assertEqual(heap.pop_due(now), ['c'])
+        self.assertEqual(heap.next_occurrence(), now + timedelta(seconds=10))
+        self.assertEqual(heap.pop_due(now + timedelta(seconds=30)), ['a', 'b'])
+        self.assertEqual(len(heap), 0)
+        self.assertIsNone(heap.next_occurrence())
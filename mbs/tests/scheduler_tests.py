@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from bson.objectid import ObjectId
+from mock import patch, Mock
+
+import mbs.scheduler
+
+from mbs.date_utils import date_now
+
+from . import BaseTest
+
+
+###############################################################################
+# BackupSchedulerTest
+###############################################################################
+class BackupSchedulerTest(BaseTest):
+
+    ###########################################################################
+    def test_plan_updated_while_loading(self):
+        scheduler = mbs.scheduler.BackupScheduler(Mock())
+        scheduler._loaded_until = date_now()
+        plan = Mock(id=ObjectId(), priority=None,
+                    next_occurrence=date_now() + timedelta(seconds=10))
+
+        def add_plan_occurrences(q):
+            # the plan moves within the range being loaded after it was read
+            scheduler.plan_updated(plan)
+            return 0
+
+        with patch.object(scheduler, '_add_plan_occurrences',
+                          side_effect=add_plan_occurrences):
+            scheduler._load_upcoming_plans()
+
+        self.assertTrue(plan.id in scheduler._occurrences)
+        self.assertTrue(scheduler._loaded_until > plan.next_occurrence)
+
+    ###########################################################################
+    def test_failed_load(self):
+        scheduler = mbs.scheduler.BackupScheduler(Mock())
+        loaded_until = date_now()
+        scheduler._loaded_until = loaded_until
+
+        with patch.object(scheduler, '_add_plan_occurrences',
+                          side_effect=Exception('find failed')):
+            self.assertRaises(Exception, scheduler._load_upcoming_plans)
+
+        # the same range is read again on the next load
+        self.assertEqual(scheduler._loaded_until, loaded_until)
@@ -0,0 +1,206 @@
+from bson.timestamp import Timestamp
+from mock import patch, Mock
+
+import mbs.strategy
+
+from mbs.backup import Backup
+from mbs.date_utils import date_now, seconds_to_date
+from mbs.globals import State
+from mbs.retention.policy import RetainLastNPolicy
+
+from . import BaseTest
+
+
+###############################################################################
+# DumpStrategyTest
+###############################################################################
+class DumpStrategyTest(BaseTest):
+
+    ###########################################################################
+    def _restore_archive_options(self, dest_uri, source_database_name):
+        strategy = mbs.strategy.DumpStrategy()
+        strategy.backup_assistant = Mock()
+        restore = Mock(**{'source_backup.name': 'foo_backup'})
+        with patch.object(mbs.strategy, 'update_restore'), \
+             patch.object(strategy, '_is_stream_restore',
+                          Mock(return_value=False)):
+            strategy._restore_archive(restore, dest_uri, Mock(),
+                                      source_database_name, [])
+
+        run_restore = strategy.backup_assistant.run_mongo_archive_restore
+        return run_restore.call_args[1]['options']
+
+    ###########################################################################
+    def test_restore_archive_into_other_database(self):
+        options = self._restore_archive_options(
+            'mongodb://localhost:27017/bar', 'foo')
+        self.assertEqual(options, ['--nsInclude', 'foo.*',
+                                   '--nsFrom', 'foo.*',
+                                   '--nsTo', 'bar.*'])
+
+        options = self._restore_archive_options(
+            'mongodb://localhost:27017/foo', 'foo')
+        self.assertEqual(options, ['--nsInclude', 'foo.*'])
+
+
+###############################################################################
+# IncrementalOplogStrategyTest
+###############################################################################
+class IncrementalOplogStrategyTest(BaseTest):
+
+    ###########################################################################
+    def _make_backup(self, backup_id, previous_backup=None, oplog_end=None):
+        backup = Backup()
+        backup.id = backup_id
+        backup.name = backup_id
+        backup.state = State.SUCCEEDED
+        backup.oplog_end_ts = oplog_end and Timestamp(oplog_end, 1)
+        if previous_backup:
+            backup.base_backup_id = (previous_backup.base_backup_id or
+                                     previous_backup.id)
+            backup.previous_backup_id = previous_backup.id
+            backup.oplog_start_ts = previous_backup.oplog_end_ts
+        return backup
+
+    ###########################################################################
+    def _make_chain(self, incremental_count):
+        chain = [self._make_backup('b0', oplog_end=1000)]
+        for i in range(1, incremental_count + 1):
+            chain.append(self._make_backup('b%s' % i, previous_backup=chain[-1],
+                                           oplog_end=1000 + i * 100))
+        return chain
+
+    ###########################################################################
+    def _select_backup_type(self, previous_backup, chain_length):
+        strategy = mbs.strategy.IncrementalOplogStrategy()
+        strategy.max_incrementals = 3
+        backup = Backup()
+        mongo_connector = Mock()
+        mongo_connector.get_oplog_last_ts.return_value = Timestamp(5000, 1)
+        mongo_connector.get_oplog_first_ts.return_value = Timestamp(500, 1)
+        with patch.object(mbs.strategy, 'update_backup') as update_backup, \
+             patch.object(strategy, '_is_incremental_capable',
+                          Mock(return_value=True)), \
+             patch.object(strategy, '_get_previous_backup',
+                          Mock(return_value=previous_backup)), \
+             patch.object(strategy, '_get_chain_length',
+                          Mock(return_value=chain_length)):
+            strategy._select_backup_type(backup, mongo_connector)
+
+        return backup, update_backup.call_args[1]['event_name']
+
+    ###########################################################################
+    def test_select_incremental(self):
+        chain = self._make_chain(2)
+
+        # chained to the previous backup and to the base of its chain
+        backup, event_name = self._select_backup_type(chain[-1], 2)
+        self.assertEqual(event_name, mbs.strategy.EVENT_SELECT_INCREMENTAL)
+        self.assertEqual(backup.base_backup_id, 'b0')
+        self.assertEqual(backup.previous_backup_id, 'b2')
+        self.assertEqual(backup.oplog_start_ts, chain[-1].oplog_end_ts)
+        self.assertEqual(backup.oplog_end_ts, Timestamp(5000, 1))
+
+        # the first incremental after a full dump
+        backup, event_name = self._select_backup_type(chain[0], 0)
+        self.assertEqual(backup.base_backup_id, 'b0')
+        self.assertEqual(backup.previous_backup_id, 'b0')
+
+    ###########################################################################
+    def test_select_full_dump(self):
+        chain = self._make_chain(3)
+
+        # max incrementals reached
+        backup, event_name = self._select_backup_type(chain[-1], 3)
+        self.assertEqual(event_name, mbs.strategy.EVENT_SELECT_FULL_DUMP)
+        self.assertFalse(backup.is_incremental())
+
+        # the oplog does not go back to the previous backup
+        chain[-1].oplog_end_ts = Timestamp(400, 1)
+        backup, event_name = self._select_backup_type(chain[-1], 1)
+        self.assertEqual(event_name, mbs.strategy.EVENT_SELECT_FULL_DUMP)
+        self.assertFalse(backup.is_incremental())
+
+        # no previous backup
+        backup, event_name = self._select_backup_type(None, 0)
+        self.assertEqual(event_name, mbs.strategy.EVENT_SELECT_FULL_DUMP)
+
+    ###########################################################################
+    def _get_restore_chain(self, backups, source_backup, point_in_time=None):
+        backups_by_id = dict((backup.id, backup) for backup in backups)
+        restore = Mock(source_backup=source_backup,
+                       point_in_time=point_in_time)
+        strategy = mbs.strategy.IncrementalOplogStrategy()
+        with patch.object(mbs.strategy.persistence, 'get_backup',
+                          side_effect=backups_by_id.get):
+            return strategy._get_restore_chain(restore)
+
+    ###########################################################################
+    def test_get_restore_chain(self):
+        chain = self._make_chain(3)
+
+        restore_chain = self._get_restore_chain(chain, chain[2])
+        self.assertEqual([b.id for b in restore_chain], ['b0', 'b1', 'b2'])
+
+        # stops at the first incremental covering the point in time
+        restore_chain = self._get_restore_chain(
+            chain, chain[3], point_in_time=seconds_to_date(1150))
+        self.assertEqual([b.id for b in restore_chain], ['b0', 'b1', 'b2'])
+
+        # an expired link breaks the chain
+        chain[1].expired_date = date_now()
+        self.assertRaises(mbs.strategy.IncrementalChainError,
+                          self._get_restore_chain, chain, chain[3])
+
+    ###########################################################################
+    def test_restore_oplog_limit(self):
+        chain = self._make_chain(2)
+        strategy = mbs.strategy.IncrementalOplogStrategy()
+        restore = Mock(source_backup=chain[-1],
+                       point_in_time=seconds_to_date(1150))
+        restore.event_logged_count.return_value = 0
+        with patch.object(mbs.strategy.DumpStrategy, '_do_run_restore'), \
+             patch.object(strategy, '_get_restore_chain',
+                          Mock(return_value=chain)), \
+             patch.object(strategy, '_replay_incremental') as replay:
+            strategy._do_run_restore(restore)
+
+        # only the last incremental is replayed up to the point in time
+        self.assertEqual([(c[0][1].id, c[1]['oplog_limit'])
+                          for c in replay.call_args_list],
+                         [('b1', None), ('b2', 1150)])
+
+        strategy.backup_assistant = Mock()
+        mongo_connector = Mock()
+        mongo_connector.get_mongo_version.return_value = \
+            mbs.strategy.MongoNormalizedVersion("2.2.0")
+        chain[-1].target_reference = Mock(file_name='b2.tgz',
+                                          compression=None)
+        with patch.object(mbs.strategy, 'update_restore'), \
+             patch.object(strategy, 'get_restore_mongo_connector',
+                          Mock(return_value=mongo_connector)):
+            strategy._replay_incremental(restore, chain[-1], oplog_limit=1150)
+
+        run_restore = strategy.backup_assistant.run_mongo_restore
+        self.assertEqual(run_restore.call_args[1]['options'],
+                         ['--oplogReplay', '--oplogLimit', '1150:0'])
+        self.assertEqual(restore.source_backup, chain[-1])
+
+    ###########################################################################
+    def test_retention_keeps_needed_bases(self):
+        chain = self._make_chain(3)
+        full_dump = self._make_backup('c0', oplog_end=2000)
+        backups = chain + [full_dump]
+        for i, backup in enumerate(backups):
+            backup.created_date = seconds_to_date(1000 + i * 100)
+
+        # the last 2 backups are retained, b3 is one of them so its base and
+        # the incrementals before it are not expired
+        policy = RetainLastNPolicy(retain_count=2)
+        self.assertEqual(policy.filter_backups_due_for_expiration(backups), [])
+
+        # once no retained incremental needs the chain it is expired
+        policy = RetainLastNPolicy(retain_count=1)
+        due_backups = policy.filter_backups_due_for_expiration(backups)
+        self.assertEqual(sorted(b.id for b in due_backups),
+                         ['b0', 'b1', 'b2', 'b3'])
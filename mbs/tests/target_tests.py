@@ -3,8 +3,9 @@ import math
 
 from tempfile import NamedTemporaryFile
 
-from mock import patch, Mock
+from mock import patch, Mock, MagicMock
 
+import mbs.errors
 import mbs.target
 
 from . import BaseTest
@@ -18,9 +19,10 @@ class TargetTest(BaseTest):
 
     ###########################################################################
     def test_multi_part_put(self):
-        hash_ = hashlib.md5()
+        # parts are uploaded concurrently so collect them by part number
+        parts = {}
         mp_upload_mock = Mock(**{'upload_part_from_file.side_effect':
-                                 lambda data, i: hash_.update(data.read()),
+                                 lambda data, i: parts.update({i: data.read()}),
                                  'complete_upload': Mock()})
         with NamedTemporaryFile() as dump, \
              open('/dev/urandom', 'rb') as random_data, \
@@ -31,14 +33,302 @@ class TargetTest(BaseTest):
                                 **{'initiate_multipart_upload.return_value':
                                    mp_upload_mock}))):
             dump.write(random_data.read(10000))
+            dump.flush()
             target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
             target._multi_part_put(dump.name, 'com.foo.bar', 10000)
 
             self.assertEqual(mp_upload_mock.upload_part_from_file.call_count,
-                             math.ceil(10000/1024))
+                             math.ceil(10000/1024.0))
             self.assertTrue(mp_upload_mock.complete_upload.called)
-            self.assertEqual(hash_.hexdigest(), md5(dump.name))
+            self.assertEqual(_parts_md5(parts), md5(dump.name))
 
+    ###########################################################################
+    def test_rackspace_multi_part_put(self):
+        from cloudfiles.storage_object import Object
+
+        # segments are written through cloudfiles to a fake connection
+        segments = {}
+
+        def create_object(name):
+            http = Mock(**{'getresponse.return_value':
+                           Mock(status=201, **{'read.return_value': ''})})
+            sent = []
+            http.send.side_effect = sent.append
+            segments[name] = sent
+            conn = Mock(uri='https://storage/v1', token='t', user_agent='mbs',
+                        connection=http, **{'make_request.return_value':
+                                            Mock(status=201)})
+            container = Mock(conn=conn)
+            container.name = 'foo'
+            return Object(container, name=name, object_record={
+                'name': name, 'content_type': None, 'bytes': 0,
+                'last_modified': None, 'hash': None})
+
+        container_mock = Mock(**{'create_object.side_effect': create_object})
+        with NamedTemporaryFile() as dump, \
+             patch.object(mbs.target.RackspaceCloudFilesTarget,
+                          '_connect_to_container',
+                          Mock(return_value=container_mock)):
+            dump.write('x' * 2500)
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'RackspaceCloudFilesTarget',
+                                          'containerName': 'foo',
+                                          'multipartPartSize': 1000})
+            target._multi_part_put(dump.name, 'com.foo.bar', 2500)
+
+            segment_sizes = dict((name, len(''.join(data)))
+                                 for name, data in segments.items()
+                                 if name != 'com.foo.bar')
+            self.assertEqual(segment_sizes, {
+                'com.foo.bar_segments/00000001': 1000,
+                'com.foo.bar_segments/00000002': 1000,
+                'com.foo.bar_segments/00000003': 500
+            })
+
+    ###########################################################################
+    def test_rackspace_delete_st_segments(self):
+        segments_container = Mock(**{'list_objects.return_value':
+                                      ['com.foo.bar/1/2500/00000000']})
+        container_mock = Mock(**{
+            'get_object.return_value': Mock(
+                manifest='foo_segments/com.foo.bar/1/2500/'),
+            'conn.get_container.return_value': segments_container})
+        with patch.object(mbs.target.RackspaceCloudFilesTarget,
+                          '_connect_to_container',
+                          Mock(return_value=container_mock)):
+            target = self.mbs.maker.make({'_type': 'RackspaceCloudFilesTarget',
+                                          'containerName': 'foo'})
+            target.do_delete_file(mbs.target.FileReference(
+                file_path='com.foo.bar'))
+
+            container_mock.conn.get_container.assert_called_with('foo_segments')
+            segments_container.list_objects.assert_called_with(
+                prefix='com.foo.bar/1/2500/')
+            segments_container.delete_object.assert_called_with(
+                'com.foo.bar/1/2500/00000000')
+
+    ###########################################################################
+    def test_stream_put(self):
+        parts = {}
+        mp_upload_mock = Mock(**{'upload_part_from_file.side_effect':
+                                 lambda data, i: parts.update({i: data.read()}),
+                                 'complete_upload': Mock()})
+        with NamedTemporaryFile() as dump, \
+             open('/dev/urandom', 'rb') as random_data, \
+             patch.object(mbs.target, 'STREAM_PART_SIZE', 1024), \
+             patch.object(mbs.target.S3BucketTarget,
+                          '_fetch_file_info',
+                          Mock(return_value={'cloud_storage_encryption': None})), \
+             patch.object(mbs.target.S3BucketTarget,
+                          '_get_bucket',
+                          Mock(return_value=Mock(
+                                **{'initiate_multipart_upload.return_value':
+                                   mp_upload_mock}))):
+            dump.write(random_data.read(10000))
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
+            with open(dump.name, 'rb') as f:
+                stream = mbs.target.UploadStream(f)
+                stream.finish()
+                ref = target.do_put_stream(stream, 'com.foo.bar')
+
+            self.assertEqual(mp_upload_mock.upload_part_from_file.call_count,
+                             math.ceil(10000/1024.0))
+            self.assertTrue(mp_upload_mock.complete_upload.called)
+            self.assertEqual(ref.file_size, 10000)
+            self.assertEqual(stream.bytes_read, 10000)
+            self.assertEqual(_parts_md5(parts), md5(dump.name))
+
+    ###########################################################################
+    def test_multi_part_put_failed_part(self):
+        attempts = {}
+
+        def upload_part(data, i):
+            attempts[i] = attempts.get(i, 0) + 1
+            if i == 3:
+                raise Exception("bad part")
+
+        mp_upload_mock = Mock(**{'upload_part_from_file.side_effect':
+                                 upload_part})
+        with NamedTemporaryFile() as dump, \
+             patch.object(mbs.target.S3BucketTarget,
+                          '_get_bucket',
+                          Mock(return_value=Mock(
+                                **{'initiate_multipart_upload.return_value':
+                                   mp_upload_mock}))):
+            dump.write('x' * 10000)
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget',
+                                          'multipartPartSize': 1000,
+                                          'multipartConcurrency': 2})
+            self.assertRaises(Exception, target._multi_part_put,
+                              dump.name, 'com.foo.bar', 10000)
+
+            # non retriable errors are not retried
+            self.assertEqual(attempts[3], 1)
+            self.assertTrue(mp_upload_mock.cancel_upload.called)
+            self.assertFalse(mp_upload_mock.complete_upload.called)
+
+    ###########################################################################
+    def test_aborted_stream_put(self):
+        mp_upload_mock = Mock()
+        with NamedTemporaryFile() as dump, \
+             patch.object(mbs.target, 'STREAM_PART_SIZE', 1024), \
+             patch.object(mbs.target.S3BucketTarget,
+                          '_get_bucket',
+                          Mock(return_value=Mock(
+                                **{'initiate_multipart_upload.return_value':
+                                   mp_upload_mock}))):
+            dump.write('x' * 3000)
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget'})
+            with open(dump.name, 'rb') as f:
+                stream = mbs.target.UploadStream(f)
+                stream.finish(error=Exception("dump failed"))
+                self.assertRaises(mbs.errors.UploadStreamAbortedError,
+                                  target.do_put_stream, stream, 'com.foo.bar')
+
+            self.assertTrue(mp_upload_mock.cancel_upload.called)
+            self.assertFalse(mp_upload_mock.complete_upload.called)
+
+    ###########################################################################
+    def test_resume_multi_part_put(self):
+        uploaded = []
+        part_etags = [Mock(part_number=1, etag='"e1"'),
+                      Mock(part_number=2, etag='"e2"')]
+        mp_upload_mock = MagicMock(**{
+            'id': 'upload-1',
+            'upload_part_from_file.side_effect':
+                lambda data, i: uploaded.append(i) or Mock(etag='"e%s"' % i)})
+        mp_upload_mock.__iter__.return_value = iter(part_etags)
+        bucket_mock = Mock(**{'get_all_multipart_uploads.return_value':
+                              [mp_upload_mock]})
+
+        upload_state = mbs.target.MultipartUploadState()
+        upload_state.upload_id = 'upload-1'
+        upload_state.container_name = 'foo'
+        upload_state.destination_path = 'com.foo.bar'
+        upload_state.file_size = 10000
+        upload_state.part_size = 1000
+        # part 2 etag does not match what s3 has so it has to be re-uploaded
+        upload_state.completed_parts = [{'partNumber': 1, 'etag': '"e1"'},
+                                        {'partNumber': 2, 'etag': '"bad"'}]
+        saves = []
+        upload_state.progress_listener = lambda state: saves.append(state)
+
+        with NamedTemporaryFile() as dump, \
+             patch.object(mbs.target.S3BucketTarget,
+                          '_get_bucket', Mock(return_value=bucket_mock)):
+            dump.write('x' * 10000)
+            dump.flush()
+            target = self.mbs.maker.make({'_type': 'S3BucketTarget',
+                                          'bucketName': 'foo'})
+            target._multi_part_put(dump.name, 'com.foo.bar', 10000,
+                                   upload_state=upload_state)
+
+            self.assertFalse(bucket_mock.initiate_multipart_upload.called)
+            self.assertEqual(sorted(uploaded), range(2, 11))
+            self.assertTrue(mp_upload_mock.complete_upload.called)
+            self.assertEqual(len(upload_state.completed_parts), 10)
+            self.assertEqual(len(saves), 9)
+
+    ###########################################################################
+    def test_ranged_download(self):
+        from StringIO import StringIO
+        data = ''.join(chr(i % 256) for i in range(10001))
+        out = StringIO()
+        pool = mbs.target.RangedDownloadPool(
+            lambda start, end: data[start:end + 1], concurrency=3)
+        self.assertEqual(pool.download(len(data), 1000, out), len(data))
+        self.assertEqual(out.getvalue(), data)
+
+    ###########################################################################
+    def test_bandwidth_shares(self):
+        from mbs.bandwidth import BandwidthManager
+        from mbs.globals import Priority
+
+        mb = 1024 * 1024
+        manager = BandwidthManager()
+        self.assertEqual(manager.acquire('high', 100 * mb), 0)
+
+        manager.max_mb_per_second = 12
+        manager.register('high', Priority.HIGH)
+        manager.register('low', Priority.LOW)
+        manager.acquire('high', 12 * mb)
+        manager.acquire('low', 12 * mb)
+
+        # 11 MB/s vs 1 MB/s once both are transferring
+        self.assertAlmostEqual(manager.acquire('high', 11 * mb), 1, places=1)
+        self.assertAlmostEqual(manager.acquire('low', mb), 12, places=1)
+
+    ###########################################################################
+    def test_bandwidth_meter(self):
+        mb = 1024 * 1024
+        progress = Mock()
+        with patch.object(mbs.target, 'BANDWIDTH_METER_SIZE', mb), \
+             patch.object(mbs.target.bandwidth, 'consume') as consume:
+            meter = mbs.target.BandwidthMeter(progress)
+            for transferred in range(0, 3 * mb, 512 * 1024) + [3 * mb - 1]:
+                meter(transferred, 3 * mb - 1)
+
+        # drawn as the transfer goes rather than all up front
+        self.assertEqual([c[0][0] for c in consume.call_args_list],
+                         [mb, mb, mb - 1])
+        self.assertEqual(progress.call_count, 7)
+
+    ###########################################################################
+    def test_content_defined_chunks(self):
+        import os
+        from StringIO import StringIO
+        from mbs.dedup import content_defined_chunks
+
+        def chunk_hashes(content):
+            return [hashlib.sha256(chunk).hexdigest() for chunk in
+                    content_defined_chunks(StringIO(content),
+                                           average_size=64 * 1024)]
+
+        data = os.urandom(4 * 1024 * 1024)
+        chunks = list(content_defined_chunks(StringIO(data),
+                                             average_size=64 * 1024))
+        self.assertEqual(''.join(chunks), data)
+        self.assertTrue(all(len(c) <= 4 * 64 * 1024 for c in chunks))
+
+        # an insert only changes the chunk around it
+        edited = data[:1000] + 'inserted' + data[1000:]
+        original = chunk_hashes(data)
+        self.assertEqual(len(set(original) - set(chunk_hashes(edited))), 1)
+
+    ###########################################################################
+    def test_dedup_put_file(self):
+        import os
+        import json
+
+        target = mbs.target.DedupTarget()
+        target.target = Mock()
+        target.average_chunk_size = 64 * 1024
+        chunk_index = Mock()
+        chunk_index.add_reference.return_value = True
+        uploaded = {}
+
+        def put_file(file_path, destination_path=None, metadata=None):
+            uploaded[destination_path] = open(file_path).read()
+        target.target.put_file.side_effect = put_file
+
+        with NamedTemporaryFile() as f, \
+             patch.object(target, '_chunk_index', return_value=chunk_index):
+            f.write(os.urandom(512 * 1024))
+            f.flush()
+            target.put_file(f.name, destination_path='foo.tgz')
+
+        # chunks are put from memory, only the manifest goes through put_file
+        manifest = json.loads(uploaded.values()[0])
+        self.assertEqual(uploaded.keys(), ['foo.tgz.manifest'])
+        self.assertEqual(target.target.put_data.call_count,
+                         len(manifest["chunks"]))
+        self.assertEqual(chunk_index.mark_stored.call_count,
+                         len(manifest["chunks"]))
+
+    ###########################################################################
     def test_s3_validate(self):
         target = self.mbs.maker.make({
             '_type': 'S3BucketTarget',
@@ -87,3 +377,10 @@ class TargetTest(BaseTest):
         })
         self.assertGreater(len(target.has_sufficient_permissions()), 0)
 
+
+###############################################################################
+def _parts_md5(parts):
+    hash_ = hashlib.md5()
+    for i in sorted(parts.keys()):
+        hash_.update(parts[i])
+    return hash_.hexdigest()
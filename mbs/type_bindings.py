@@ -4,6 +4,7 @@ TYPE_BINDINGS = {
     "BackupSystem": "mbs.backup_system.BackupSystem",
     "BackupSystemApiServer": "mbs.api.backup_system_api.BackupSystemApiServer",
     "BackupEngine": "mbs.engine.BackupEngine",
+    "AdmissionController": "mbs.admission.AdmissionController",
     "Backup": "mbs.backup.Backup",
     "Restore": "mbs.restore.Restore",
     #TODO Completely remove BackupLogEntry because it was changed to EventLogEntry
@@ -15,6 +16,7 @@ TYPE_BINDINGS = {
     "CompositeSchedule": "mbs.schedule.CompositeSchedule",
     "Strategy": "mbs.strategy.BackupStrategy",
     "DumpStrategy": "mbs.strategy.DumpStrategy",
+    "IncrementalOplogStrategy": "mbs.strategy.IncrementalOplogStrategy",
     "CloudBlockStorageStrategy": "mbs.strategy.CloudBlockStorageStrategy",
     "EbsVolumeStorageStrategy": "mbs.strategy.EbsVolumeStorageStrategy",
     "HybridStrategy": "mbs.strategy.HybridStrategy",
@@ -33,6 +35,9 @@ TYPE_BINDINGS = {
     "S3BucketTarget": "mbs.target.S3BucketTarget",
     "RackspaceCloudFilesTarget": "mbs.target.RackspaceCloudFilesTarget",
     "FileReference": "mbs.target.FileReference",
+    "DedupTarget": "mbs.target.DedupTarget",
+    "DedupFileReference": "mbs.target.DedupFileReference",
+    "MultipartUploadState": "mbs.target.MultipartUploadState",
     "EbsSnapshotReference": "mbs.target.EbsSnapshotReference",
     "CompositeBlockStorageSnapshotReference":
         "mbs.target.CompositeBlockStorageSnapshotReference",
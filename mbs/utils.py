@@ -1,6 +1,7 @@
 __author__ = 'abdul'
 
 import os
+import re
 import subprocess
 import socket
 import pwd
@@ -66,6 +67,19 @@ def listify(object):
 
     return [object]
 
+###############################################################################
+def document_key_attribute_name(key):
+    # document keys are the camel case version of the property names
+    try:
+        return _attribute_names[key]
+    except KeyError:
+        attr = re.sub("([A-Z])", r"_\1", key).lower()
+        _attribute_names[key] = attr
+        return attr
+
+# document key => attribute name. Keys are a small fixed set
+_attribute_names = {}
+
 ###############################################################################
 # sub-processing functions
 ###############################################################################
@@ -473,6 +487,19 @@ def list_dir_files(path):
     return [name for name in os.listdir(path) if
             os.path.isfile(os.path.join(path, name))]
 
+###############################################################################
+def dir_size(path):
+    """
+        Returns the total size in bytes of all files under path
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
 ###############################################################################
 # DM SETUP SUPPORT
 ###############################################################################